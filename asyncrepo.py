@@ -0,0 +1,263 @@
+#
+# Part of mpygit - asyncrepo.py - asyncio wrapper for repositories
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import binascii
+import concurrent.futures
+import functools
+import itertools
+import math
+from mpygit import gitutil, mpygit
+
+def take_chunk(iterator, size, prepare=None):
+    """Take the next size items of an iterator, calling prepare on each one,
+    this is what runs on the executor for async iterators
+    """
+    chunk = list(itertools.islice(iterator, size))
+    if prepare is not None:
+        for item in chunk:
+            prepare(item)
+    return chunk
+
+def load_commit(commit):
+    """Make sure a commit from the commit-graph is read and parsed, so
+    accessing it later doesn't block
+    """
+    commit.author
+
+def close_later(loop, iterator):
+    """Close an iterator on the event loop, or right away if the loop is
+    gone already
+    """
+    try:
+        loop.call_soon_threadsafe(iterator.close)
+    except RuntimeError:
+        iterator.close()
+
+class AsyncRepository:
+    """asyncio wrapper around a Repository, everything that reads from the
+    repository runs on a bounded executor instead of the event loop
+
+    Object and commit lookups made in the same event loop iteration (e.g.
+    through asyncio.gather) are batched into a single executor call, using
+    Repository.get_many, each of them succeeds or fails on its own, async
+    iterators hand over chunk_size items per executor call, so many small
+    operations don't each pay for a thread hop. Cancelling a task that is
+    waiting on a lookup or iterating drops the work not started yet, work
+    already running on the executor is finished, but its result is thrown
+    away.
+    """
+
+    def __init__(self, repo, executor=None, max_workers=4, chunk_size=64):
+        self.repo = repo
+        # Only shut down executors we created ourselves
+        self._own_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers, thread_name_prefix="mpygit")
+        self.executor = executor
+        self.chunk_size = chunk_size
+        # Lookups waiting for the next batch, as (kind, oid, future)
+        self._pending = []
+
+    async def _run(self, func, *args, **kwargs):
+        """Run a function on the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    async def close(self):
+        """Shut down the executor (if it was created by us), this doesn't
+        close the repository
+        """
+        if self._own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _lookup(self, kind, oid):
+        """Queue a lookup for the next batch, returns its future"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if len(self._pending) == 0:
+            loop.call_soon(self._flush)
+        self._pending.append((kind, oid, future))
+        return future
+
+    async def get(self, oid):
+        """Lookup an object, like Repository.__getitem__"""
+        return await self._lookup("object", oid)
+
+    def __getitem__(self, oid):
+        return self.get(oid)
+
+    async def get_commit(self, oid):
+        """Lookup a commit, see Repository.get_commit, commits from the
+        commit-graph are fully loaded, so accessing any of their fields
+        doesn't block
+        """
+        return await self._lookup("commit", oid)
+
+    def _flush(self):
+        """Send the pending lookups to the executor as one batch"""
+        # Cancelled lookups are done already
+        batch = [ (kind, oid, future) for kind, oid, future in self._pending
+                  if not future.done() ]
+        self._pending = []
+        if len(batch) == 0:
+            return
+
+        def deliver(job):
+            if job.cancelled():
+                for _, _, future in batch:
+                    future.cancel()
+                return
+            exc = job.exception()
+            results = None if exc is not None else job.result()
+            for i, (_, _, future) in enumerate(batch):
+                if future.done():
+                    continue
+                if exc is not None:
+                    future.set_exception(exc)
+                elif results[i][1] is not None:
+                    future.set_exception(results[i][1])
+                else:
+                    future.set_result(results[i][0])
+
+        loop = asyncio.get_running_loop()
+        try:
+            job = loop.run_in_executor(
+                self.executor, self._load_batch,
+                [ (kind, oid) for kind, oid, _ in batch ])
+        except Exception as exc:
+            # E.g. the executor was shut down by close(), nothing would ever
+            # resolve the lookups otherwise
+            for _, _, future in batch:
+                future.set_exception(exc)
+            return
+        job.add_done_callback(deliver)
+
+    def _load_batch(self, lookups):
+        """Load a batch of (kind, oid) lookups, returns a (result,
+        exception) pair for each of them, so that a bad lookup (e.g. an
+        ambiguous short object ID) only fails itself
+        """
+        repo = self.repo
+        results = [ None ] * len(lookups)
+        # Objects to read together, by resolved object ID
+        objects = {}
+        for i, (kind, oid) in enumerate(lookups):
+            try:
+                if kind == "commit":
+                    commit = repo.get_commit(oid)
+                    if isinstance(commit, mpygit.GraphCommit):
+                        load_commit(commit)
+                    results[i] = (commit, None)
+                    continue
+                resolved = repo._resolve(oid)
+                if resolved is None:
+                    results[i] = (None, None)
+                    continue
+                # Malformed object IDs would fail the whole get_many call
+                binascii.unhexlify(resolved)
+                objects.setdefault(resolved, []).append(i)
+            except Exception as exc:
+                results[i] = (None, exc)
+
+        try:
+            found = { oid : (obj, None)
+                      for oid, obj in repo.get_many(objects) }
+        except Exception:
+            # Find out which of them failed
+            found = {}
+            for oid in objects:
+                try:
+                    found[oid] = (repo[oid], None)
+                except Exception as exc:
+                    found[oid] = (None, exc)
+        for oid, indexes in objects.items():
+            for i in indexes:
+                results[i] = found[oid]
+        return results
+
+    async def resolve(self, rev):
+        """Resolve a revision, see Repository.resolve"""
+        return await self._run(self.repo.resolve, rev)
+
+    async def object_info(self, oid):
+        """Type and size of an object, see Repository.object_info"""
+        return await self._run(self.repo.object_info, oid)
+
+    async def tree_info(self, tree):
+        """Type and size of the entries of a tree, see Repository.tree_info"""
+        return await self._run(self.repo.tree_info, tree)
+
+    async def _iterate(self, iterator, prepare=None):
+        """Turn a blocking iterator into an async one, chunk_size items are
+        produced per executor call
+        """
+        loop = asyncio.get_running_loop()
+        # The executor's own future, the asyncio one wrapping it is already
+        # done when we get cancelled, even if the chunk is still running
+        work = None
+        try:
+            while True:
+                work = self.executor.submit(take_chunk, iterator,
+                                            self.chunk_size, prepare)
+                chunk = await asyncio.wrap_future(work)
+                for item in chunk:
+                    yield item
+                if len(chunk) < self.chunk_size:
+                    return
+        finally:
+            # A generator can't be closed while another thread is running
+            # it, so if we got cancelled mid-chunk close it once it's done
+            if work is not None and not work.done():
+                work.add_done_callback(
+                    lambda _: close_later(loop, iterator))
+            else:
+                iterator.close()
+
+    async def walk(self, start_oid, limit=math.inf, paths=None):
+        """Async version of gitutil.walk, the commits are fully loaded by
+        the executor, so accessing any of their fields doesn't block
+        """
+        iterator = gitutil.walk(self.repo, start_oid, limit, paths)
+        async for commit in self._iterate(iterator, load_commit):
+            yield commit
+
+    async def iter_diffs(self, commit1, commit2, context=3):
+        """Generate the (path, patch, status) tuples of diff_commits as the
+        executor computes them
+        """
+        iterator = ( (diff.path, "".join(diff.iter_patch(context=context)),
+                      diff.status)
+                     for diff in gitutil.iter_diffs(self.repo, commit1,
+                                                    commit2) )
+        async for diff in self._iterate(iterator):
+            yield diff
+
+    async def diff_commits(self, commit1, commit2, context=3):
+        """Async version of gitutil.diff_commits"""
+        return await self._run(gitutil.diff_commits, self.repo, commit1,
+                               commit2, context=context)
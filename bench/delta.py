@@ -0,0 +1,158 @@
+#
+# Part of mpygit - bench/delta.py -
+#  Microbenchmark for delta application and pack inflation
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import argparse
+import random
+import time
+import zlib
+from mpygit import mpygit
+
+def encode_varint(num):
+    """Encode a delta header size"""
+    out = bytearray()
+    while True:
+        b = num & 0x7f
+        num >>= 7
+        if num:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+def make_delta(base, rng, op_size):
+    """Build a delta against base that alternates between copying ranges of
+    base and inserting new literal data, like an edited generated file would
+    """
+    delta = bytearray()
+    result_len = 0
+    ops = bytearray()
+    pos = 0
+    while pos + op_size <= len(base):
+        # Copy op with 4 byte offset and 2 byte size
+        ops += bytes([0x80 | 0x0f | 0x30])
+        ops += pos.to_bytes(4, "little") + op_size.to_bytes(2, "little")
+        result_len += op_size
+        # Insert op of up to 127 bytes
+        lit = rng.randbytes(rng.randint(1, 127))
+        ops.append(len(lit))
+        ops += lit
+        result_len += len(lit)
+        pos += op_size
+    delta += encode_varint(len(base)) + encode_varint(result_len) + ops
+    return bytes(delta)
+
+def legacy_apply_delta(base_data, delta_data):
+    """The previous implementation, kept here as the point of comparison"""
+    idx = 0
+
+    def decode_varint():
+        nonlocal idx
+        num = 0
+        shift = 0
+        while True:
+            b = delta_data[idx]
+            idx += 1
+            num |= (b & 0x7f) << shift
+            shift += 7
+            if (b & 0x80) == 0:
+                break
+        return num
+
+    def decode_copy_delta(mask):
+        nonlocal idx
+        bit = 1
+        num = 0
+        shift = 0
+        while bit <= mask:
+            if (mask & bit) != 0:
+                num |= delta_data[idx] << shift
+                idx += 1
+            shift += 8
+            bit <<= 1
+        return num
+
+    decode_varint()
+    decode_varint()
+    result = b""
+    while idx < len(delta_data):
+        op = delta_data[idx]
+        idx += 1
+        if op & 0x80 != 0:
+            offs = decode_copy_delta(op & 0xf)
+            size = decode_copy_delta((op & 0x70) >> 4)
+            if size == 0:
+                size = 0x10000
+            result += base_data[offs:offs+size]
+        else:
+            result += delta_data[idx:idx+op]
+            idx += op
+    return result
+
+def legacy_inflate(buf, pos):
+    """The previous implementation, kept here as the point of comparison"""
+    deflator = zlib.decompressobj()
+    defl_data = b""
+    with memoryview(buf) as view:
+        while not deflator.eof and pos < len(view):
+            defl_data += deflator.decompress(view[pos:pos+1024])
+            pos += 1024
+    return defl_data
+
+def timeit(func, *args, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+parser = argparse.ArgumentParser(description="apply_delta/inflate benchmark")
+parser.add_argument("--size", type=int, default=4,
+                    help="Size of the base object in MiB")
+parser.add_argument("--op-size", type=int, default=4096,
+                    help="Size of each copy operation in the delta")
+parser.add_argument("--repeat", "-r", type=int, default=3,
+                    help="Number of runs, the best one is reported")
+args = parser.parse_args()
+
+rng = random.Random(0)
+base = rng.randbytes(args.size * 1024 * 1024)
+delta = make_delta(base, rng, args.op_size)
+
+old_time, old_result = timeit(legacy_apply_delta, base, delta,
+                              repeat=args.repeat)
+new_time, new_result = timeit(mpygit.apply_delta, base, delta,
+                              repeat=args.repeat)
+assert old_result == new_result
+print(f"apply_delta {len(new_result)} bytes: "
+      f"legacy {old_time:.3f}s, current {new_time:.3f}s "
+      f"({old_time / new_time:.1f}x)")
+
+# Compressible text followed by trailing data, like an object inside a pack
+text = b"".join(b"line %d of a generated file\n" % i
+                for i in range(args.size * 1024 * 1024 // 24))
+stream = zlib.compress(text) + b"\0" * 4096
+old_time, old_result = timeit(legacy_inflate, stream, 0, repeat=args.repeat)
+new_time, (new_result, _) = timeit(mpygit.inflate, stream, 0, len(text),
+                                   repeat=args.repeat)
+assert old_result == new_result
+print(f"inflate {len(new_result)} bytes: "
+      f"legacy {old_time:.3f}s, current {new_time:.3f}s "
+      f"({old_time / new_time:.1f}x)")
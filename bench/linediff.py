@@ -0,0 +1,98 @@
+#
+# Part of mpygit - bench/linediff.py -
+#  Benchmark the line diff engine against difflib
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Usage: python -m mpygit.bench.linediff [--lines 20000]
+
+import argparse
+import difflib
+import random
+import time
+from mpygit import linediff
+
+def source_file(rng, num_lines):
+    """Something that looks like source code, mostly unique lines with
+    plenty of repeated braces and blank lines
+    """
+    lines = []
+    while len(lines) < num_lines:
+        name = f"func_{len(lines)}_{rng.randrange(1 << 30):x}"
+        lines.append(f"static int {name}(int arg)\n")
+        lines.append("{\n")
+        for i in range(rng.randint(2, 12)):
+            lines.append(f"\tresult += compute({rng.randrange(1 << 20)}, "
+                         f"arg, {i});\n")
+        lines.append("\treturn result;\n")
+        lines.append("}\n")
+        lines.append("\n")
+    return lines[:num_lines]
+
+def generated_file(rng, num_lines):
+    """Generated code, lots of nearly identical lines"""
+    return [ f"    {{ {rng.randrange(16)}, {rng.randrange(4)}, 0 }},\n"
+             for _ in range(num_lines) ]
+
+def edit(rng, lines, num_edits):
+    """Scatter insertions, deletions and modifications over a file"""
+    lines = list(lines)
+    for _ in range(num_edits):
+        pos = rng.randrange(len(lines))
+        op = rng.randrange(3)
+        if op == 0:
+            lines[pos:pos] = [ f"\tinserted({rng.randrange(1 << 20)});\n" ]
+        elif op == 1:
+            del lines[pos:pos+rng.randint(1, 5)]
+        else:
+            lines[pos] = f"\tmodified({rng.randrange(1 << 20)});\n"
+    return lines
+
+def timeit(func, *args, repeat, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = list(func(*args, **kwargs))
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+parser = argparse.ArgumentParser(description="line diff benchmark")
+parser.add_argument("--lines", type=int, default=20000,
+                    help="Number of lines in each file")
+parser.add_argument("--edits", type=int, default=200,
+                    help="Number of edits between the two versions")
+parser.add_argument("--repeat", "-r", type=int, default=3,
+                    help="Number of runs, the best one is reported")
+args = parser.parse_args()
+
+rng = random.Random(0)
+for kind, make in (("source", source_file), ("generated", generated_file)):
+    old = make(rng, args.lines)
+    new = edit(rng, old, args.edits)
+    old_time, old_result = timeit(difflib.unified_diff, old, new,
+                                  repeat=args.repeat)
+    results = []
+    for algorithm in ("histogram", "myers"):
+        new_time, new_result = timeit(linediff.unified_diff, old, new,
+                                      algorithm=algorithm,
+                                      repeat=args.repeat)
+        changed = sum(line[0] in "+-" for line in new_result[2:])
+        results.append(f"{algorithm} {new_time:.3f}s "
+                       f"({old_time / new_time:.1f}x, {changed} lines)")
+    changed = sum(line[0] in "+-" for line in old_result[2:])
+    print(f"{kind} {args.lines} lines: difflib {old_time:.3f}s "
+          f"({changed} lines), " + ", ".join(results))
@@ -0,0 +1,301 @@
+#
+# Part of mpygit - bench/repogen.py -
+#  Deterministic synthetic repositories for benchmarking
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Repositories are built by feeding a generated stream to git fast-import,
+# with fixed identities and dates and a seeded random generator, so the
+# same parameters always produce the same objects
+
+import functools
+import os
+import pathlib
+import random
+import shutil
+import subprocess
+
+# Fixed environment, so that git itself doesn't add anything variable
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "Bench Author",
+    "GIT_AUTHOR_EMAIL": "author@example.com",
+    "GIT_COMMITTER_NAME": "Bench Committer",
+    "GIT_COMMITTER_EMAIL": "committer@example.com",
+    "GIT_CONFIG_NOSYSTEM": "1",
+    "HOME": os.devnull,
+}
+
+# Date of the first commit, every commit is one minute after its parent
+EPOCH = 1500000000
+
+def git(path, *args, data=None):
+    env = dict(os.environ, **GIT_ENV)
+    return subprocess.run(["git", "-C", str(path)] + list(args), input=data,
+                          env=env, check=True, capture_output=True).stdout
+
+class FastImport:
+    """Builder for a git fast-import stream"""
+
+    def __init__(self):
+        self.chunks = []
+        self.mark = 0
+        self.time = EPOCH
+
+    def _next_mark(self):
+        self.mark += 1
+        return self.mark
+
+    def blob(self, data):
+        mark = self._next_mark()
+        self.chunks.append(b"blob\nmark :%d\ndata %d\n%s\n" %
+                           (mark, len(data), data))
+        return mark
+
+    def commit(self, ref, message, files, parents=(), deleteall=False):
+        """Add a commit, files maps paths to blob marks (or None to delete
+        the file), parents are marks of earlier commits
+        """
+        mark = self._next_mark()
+        self.time += 60
+        message = message.encode()
+        out = [ b"commit %s\nmark :%d\n" % (ref.encode(), mark),
+                b"author Bench Author <author@example.com> %d +0000\n" %
+                    self.time,
+                b"committer Bench Committer <committer@example.com> %d +0000\n"
+                    % self.time,
+                b"data %d\n%s\n" % (len(message), message) ]
+        for i, parent in enumerate(parents):
+            out.append(b"%s :%d\n" % (b"from" if i == 0 else b"merge", parent))
+        if deleteall:
+            out.append(b"deleteall\n")
+        for path, blob in sorted(files.items()):
+            if blob is None:
+                out.append(b"D %s\n" % path.encode())
+            else:
+                out.append(b"M 100644 :%d %s\n" % (blob, path.encode()))
+        self.chunks.append(b"".join(out) + b"\n")
+        return mark
+
+    def run(self, path):
+        """Import the stream into the repository at path as one pack"""
+        # Small imports would be exploded into loose objects otherwise
+        git(path, "-c", "fastimport.unpackLimit=0", "fast-import", "--quiet",
+            "--done",
+            data=b"".join(self.chunks) + b"done\n")
+
+def init(path):
+    path = pathlib.Path(path)
+    path.mkdir(parents=True)
+    git(path, "init", "--quiet", "--bare", "--initial-branch=main")
+    return path
+
+def text_file(rng, lines, width=60):
+    return b"".join(b"%d %s\n" % (i, rng.randbytes(width // 2).hex().encode())
+                    for i in range(lines))
+
+def edit_lines(rng, data, count):
+    """Replace a few random lines of a text file"""
+    lines = data.split(b"\n")
+    for _ in range(count):
+        i = rng.randrange(len(lines))
+        lines[i] = b"edited %s" % rng.randbytes(16).hex().encode()
+    return b"\n".join(lines)
+
+def linear_history(path, commits=2000, files=50, seed=0):
+    """Long linear history, every commit edits a few files in a two level
+    directory structure
+    """
+    rng = random.Random(seed)
+    path = init(path)
+    fi = FastImport()
+    contents = { f"src/mod{i % 10}/file{i}.txt" : text_file(rng, 100)
+                 for i in range(files) }
+    marks = { name : fi.blob(data) for name, data in contents.items() }
+    prev = fi.commit("refs/heads/main", "initial", marks)
+    for n in range(commits - 1):
+        changes = {}
+        for name in rng.sample(sorted(contents), 3):
+            contents[name] = edit_lines(rng, contents[name], 2)
+            changes[name] = fi.blob(contents[name])
+        prev = fi.commit("refs/heads/main", f"commit {n}\n\nbody {n}\n",
+                         changes, [prev])
+    fi.run(path)
+    git(path, "repack", "-adq")
+    return path
+
+def wide_merges(path, branches=16, rounds=20, seed=0):
+    """History made of many topic branches repeatedly merged into main,
+    alternating between normal and octopus merges
+    """
+    rng = random.Random(seed)
+    path = init(path)
+    fi = FastImport()
+    main = fi.commit("refs/heads/main", "initial",
+                     { "README" : fi.blob(b"readme\n") })
+    for r in range(rounds):
+        tips = []
+        for b in range(branches):
+            tip = main
+            for c in range(3):
+                name = f"topic{b}/file{c}.txt"
+                tip = fi.commit(f"refs/heads/topic{b}",
+                                f"round {r} topic {b} commit {c}",
+                                { name : fi.blob(text_file(rng, 20)) }, [tip])
+            tips.append(tip)
+        if r % 2 == 0:
+            main = fi.commit("refs/heads/main", f"octopus merge {r}", {},
+                             [main] + tips[:8])
+            for tip in tips[8:]:
+                main = fi.commit("refs/heads/main", f"merge {r}", {},
+                                 [main, tip])
+        else:
+            for tip in tips:
+                main = fi.commit("refs/heads/main", f"merge {r}", {},
+                                 [main, tip])
+    fi.run(path)
+    git(path, "repack", "-adq")
+    return path
+
+def deep_deltas(path, commits=300, seed=0):
+    """One large file edited slightly by every commit, packed aggressively
+    so reading it means resolving delta chains up to 50 deep
+    """
+    rng = random.Random(seed)
+    path = init(path)
+    fi = FastImport()
+    data = text_file(rng, 5000)
+    prev = None
+    for n in range(commits):
+        data = edit_lines(rng, data, 5)
+        prev = fi.commit("refs/heads/main", f"edit {n}",
+                         { "generated.txt" : fi.blob(data) },
+                         [] if prev is None else [prev])
+    fi.run(path)
+    git(path, "repack", "-adfq", "--depth=50", "--window=250")
+    return path
+
+def huge_tree(path, entries=50000, commits=20, seed=0):
+    """A single directory with a huge number of entries"""
+    rng = random.Random(seed)
+    path = init(path)
+    fi = FastImport()
+    files = { f"huge/entry{i:06d}.txt" : fi.blob(b"entry %d\n" % i)
+              for i in range(entries) }
+    prev = fi.commit("refs/heads/main", "initial", files)
+    for n in range(commits - 1):
+        name = f"huge/entry{rng.randrange(entries):06d}.txt"
+        prev = fi.commit("refs/heads/main", f"edit {n}",
+                         { name : fi.blob(b"edited %d\n" % n) }, [prev])
+    fi.run(path)
+    git(path, "repack", "-adq")
+    return path
+
+def large_blobs(path, size=32 * 1024 * 1024, commits=5, seed=0):
+    """A few versions of a large text file, and a large binary one"""
+    rng = random.Random(seed)
+    path = init(path)
+    fi = FastImport()
+    data = text_file(rng, size // 64)
+    binary = rng.randbytes(size)
+    prev = fi.commit("refs/heads/main", "initial",
+                     { "large.txt" : fi.blob(data),
+                       "large.bin" : fi.blob(binary) })
+    for n in range(commits - 1):
+        data = edit_lines(rng, data, 100)
+        prev = fi.commit("refs/heads/main", f"edit {n}",
+                         { "large.txt" : fi.blob(data) }, [prev])
+    fi.run(path)
+    git(path, "repack", "-adq")
+    return path
+
+def many_packs(path, packs=50, commits_per_pack=20, loose=200, seed=0):
+    """History split over many packs, like a repository that hasn't been
+    repacked in a while, with loose objects on top
+    """
+    rng = random.Random(seed)
+    path = init(path)
+    contents = { f"file{i}.txt" : text_file(rng, 50) for i in range(20) }
+    for p in range(packs):
+        fi = FastImport()
+        # Marks don't survive between imports, continue from the branch
+        fi.time = EPOCH + p * commits_per_pack * 60
+        for n in range(commits_per_pack):
+            name = rng.choice(sorted(contents))
+            contents[name] = edit_lines(rng, contents[name], 2)
+            fi.chunks.append(b"commit refs/heads/main\n"
+                b"committer Bench Committer <committer@example.com> %d +0000\n"
+                b"data 9\npack %03d\n\n" % (fi.time + n * 60, p))
+            if n == 0 and p > 0:
+                fi.chunks.append(b"from refs/heads/main^0\n")
+            fi.chunks.append(b"M 100644 inline %s\ndata %d\n%s\n\n" %
+                             (name.encode(), len(contents[name]),
+                              contents[name]))
+        fi.run(path)
+
+    # Loose objects, written by git itself one by one
+    for n in range(loose):
+        git(path, "hash-object", "-w", "--stdin",
+            data=b"loose object %d\n" % n)
+    return path
+
+def with_commit_graph(func):
+    """Variant of a generator that also writes a commit-graph, with the
+    changed-path Bloom filters, like git gc does with
+    gc.writeCommitGraph and commitGraph.changedPaths set
+    """
+    @functools.wraps(func)
+    def generate(path, **params):
+        path = func(path, **params)
+        git(path, "commit-graph", "write", "--reachable", "--changed-paths")
+        return path
+    return generate
+
+# All repository kinds with their default parameters, scaled by a factor
+GENERATORS = {
+    "linear": (linear_history, { "commits" : 2000 }),
+    "linear_graph": (with_commit_graph(linear_history), { "commits" : 2000 }),
+    "merges": (wide_merges, { "rounds" : 20 }),
+    "merges_graph": (with_commit_graph(wide_merges), { "rounds" : 20 }),
+    "deltas": (deep_deltas, { "commits" : 300 }),
+    "huge_tree": (huge_tree, { "entries" : 50000 }),
+    "large_blobs": (large_blobs, { "size" : 32 * 1024 * 1024 }),
+    "many_packs": (many_packs, { "packs" : 50 }),
+}
+
+def generate(workdir, kinds=None, scale=1.0):
+    """Generate the requested kinds of repositories into workdir, reusing
+    the ones generated before with the same parameters, returns a dict of
+    kinds to repository paths
+    """
+    workdir = pathlib.Path(workdir)
+    repos = {}
+    for kind in kinds or GENERATORS:
+        func, params = GENERATORS[kind]
+        params = { name : max(1, int(value * scale))
+                   for name, value in params.items() }
+        suffix = "-".join(f"{name}{value}" for name, value in params.items())
+        path = workdir / f"{kind}-{suffix}.git"
+        if not path.is_dir():
+            # Generate under a temporary name, so an interrupted run doesn't
+            # leave a half built repository behind to be reused
+            tmp_path = workdir / f"{path.name}.tmp"
+            if tmp_path.exists():
+                shutil.rmtree(tmp_path)
+            func(tmp_path, **params)
+            tmp_path.rename(path)
+        repos[kind] = path
+    return repos
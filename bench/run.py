@@ -0,0 +1,204 @@
+#
+# Part of mpygit - bench/run.py -
+#  Benchmark the hot paths of mpygit on synthetic repositories
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# Usage: python -m mpygit.bench.run [--scale 0.1] [--output results.json]
+#                                   [--metadata-cache cache.sqlite]
+#
+# Every benchmark reports the number of operations, the best wall clock
+# time out of the repeated runs, the throughput derived from them, and the
+# peak Python heap usage (measured in a separate, traced run, as tracing
+# slows things down considerably)
+
+import argparse
+import binascii
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from mpygit import mpygit, gitutil
+from mpygit.bench import repogen
+
+def all_oids(repo):
+    """Hex IDs of every object in the repository, packed and loose"""
+    oids = []
+    for pack in repo.packs:
+        oids.extend(binascii.hexlify(oid).decode() for oid in pack.oids)
+    for objdir in (repo.path / "objects").glob("[0-9a-f][0-9a-f]"):
+        oids.extend(objdir.name + obj.name for obj in objdir.iterdir())
+    return oids
+
+def bench_getitem(repo):
+    oids = all_oids(repo)
+    for oid in oids:
+        repo[oid]
+    return len(oids)
+
+def bench_get_offset(repo):
+    cnt = 0
+    for pack in repo.packs:
+        for oid in pack.oids:
+            pack._get_offset(binascii.hexlify(oid).decode())
+            cnt += 1
+    return cnt
+
+def bench_get_object(repo):
+    cnt = 0
+    for pack in repo.packs:
+        for i in range(pack.count):
+            pack._get_object(None, pack._entry_offset(i))
+            cnt += 1
+    return cnt
+
+def bench_walk(repo):
+    return sum(1 for _ in gitutil.walk(repo, "main"))
+
+def bench_walk_paths(repo, limit=20):
+    # History of the first few files found in the tip's tree
+    paths = [ "/".join(path) for path in tip_files(repo, limit) ]
+    return sum(1 for path in paths
+               for _ in gitutil.walk(repo, "main", paths=[path]))
+
+def bench_walk_cursor(repo, page=50):
+    # Page through the history, resuming from a saved state every time
+    cursor = gitutil.WalkCursor(repo, "main")
+    cnt = 0
+    while True:
+        commits = cursor.take(page)
+        cnt += len(commits)
+        if len(commits) < page:
+            return cnt
+        cursor = gitutil.WalkCursor.loads(repo, cursor.dumps())
+
+def bench_diff_commits(repo, limit=50):
+    cnt = 0
+    for commit in gitutil.walk(repo, "main", limit):
+        parent = repo[commit.parents[0]] if commit.parents else None
+        gitutil.diff_commits(repo, parent, repo[commit.oid])
+        cnt += 1
+    return cnt
+
+def tip_files(repo, limit):
+    """Paths (as lists of names) of the first few files in the tip's tree"""
+    paths = []
+    def collect(tree, path):
+        for entry in tree:
+            if len(paths) >= limit:
+                return
+            if entry.isdir():
+                collect(repo[entry.oid], path + [entry.name])
+            else:
+                paths.append(path + [entry.name])
+    collect(repo[repo["main"].tree], [])
+    return paths
+
+def bench_get_latest_change(repo, limit=20):
+    # Latest change of the first few files found in the tip's tree
+    paths = tip_files(repo, limit)
+    for path in paths:
+        gitutil.get_latest_change(repo, "main", path)
+    return len(paths)
+
+BENCHMARKS = {
+    "Repository.__getitem__": bench_getitem,
+    "PackFile._get_offset": bench_get_offset,
+    "PackFile._get_object": bench_get_object,
+    "gitutil.walk": bench_walk,
+    "gitutil.walk_paths": bench_walk_paths,
+    "gitutil.WalkCursor": bench_walk_cursor,
+    "gitutil.diff_commits": bench_diff_commits,
+    "gitutil.get_latest_change": bench_get_latest_change,
+}
+
+def run(path, func, repeat, metadata_cache=None):
+    """Run one benchmark on a fresh Repository per run"""
+    best = float("inf")
+    for _ in range(repeat):
+        with mpygit.Repository(path,
+                               metadata_cache=metadata_cache) as repo:
+            start = time.perf_counter()
+            ops = func(repo)
+            best = min(best, time.perf_counter() - start)
+
+    with mpygit.Repository(path, metadata_cache=metadata_cache) as repo:
+        tracemalloc.start()
+        func(repo)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "ops": ops,
+        "seconds": best,
+        "ops_per_sec": ops / best if best > 0 else None,
+        "peak_bytes": peak,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="mpygit benchmarks")
+    parser.add_argument("--workdir", "-w", default="bench-repos",
+                        help="Where to generate the repositories")
+    parser.add_argument("--scale", "-s", type=float, default=1.0,
+                        help="Scale factor for the size of the repositories")
+    parser.add_argument("--repos", nargs="*", choices=repogen.GENERATORS,
+                        help="Kinds of repositories to benchmark on")
+    parser.add_argument("--bench", "-b", nargs="*", choices=BENCHMARKS,
+                        help="Benchmarks to run")
+    parser.add_argument("--repeat", "-r", type=int, default=3,
+                        help="Number of timed runs, the best one is reported")
+    parser.add_argument("--output", "-o",
+                        help="Write the results as JSON here (default: stdout)")
+    parser.add_argument("--metadata-cache", "-m",
+                        help="Use a persistent metadata cache at this path, "
+                             "to measure workers starting with a warm cache")
+    args = parser.parse_args()
+
+    metadata_cache = None
+    if args.metadata_cache is not None:
+        metadata_cache = mpygit.MetadataCache(args.metadata_cache)
+
+    repos = repogen.generate(args.workdir, args.repos, args.scale)
+    results = []
+    for kind, path in repos.items():
+        for name in args.bench or BENCHMARKS:
+            result = run(path, BENCHMARKS[name], args.repeat,
+                         metadata_cache)
+            result.update(repo=kind, bench=name)
+            results.append(result)
+            print(f"{kind:12} {name:28} {result['ops']:8} ops "
+                  f"{result['seconds']:9.4f}s "
+                  f"{result['peak_bytes'] / 1024 / 1024:9.1f} MiB",
+                  file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as outfile:
+            json.dump(report, outfile, indent=2)
+
+if __name__ == "__main__":
+    main()
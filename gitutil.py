@@ -17,132 +17,610 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
-import difflib
+import base64
+import binascii
+import contextlib
+import itertools
+import json
 import math
-from mpygit import mpygit
+import struct
+import threading
+import zlib
+from mpygit import linediff, mpygit
 import heapq
 
-def diff_commits(repo, commit1, commit2):
-    """Generate diffs between two commits in a repository"""
-    diffs = []
+class FileDiff:
+    """A file changed between two commits, the blobs are only loaded when
+    the patch is requested, so listing changed files stays cheap
+    """
 
-    def added_blob(path, blob):
-        if blob.is_binary:
-            diffs.append(("/".join(path), "Binary file added", "A"))
-        else:
-            patch = "".join(
-                difflib.unified_diff(
-                    [],
-                    blob.text.splitlines(keepends=True),
-                    "/dev/null",
-                    "/".join(["b"] + path),
-                )
-            )
-            diffs.append(("/".join(path), patch, "A"))
-
-    def modified_blob(path, blob1, blob2):
-        if blob1.is_binary or blob2.is_binary:
-            diffs.append(("/".join(path), "Binary file modified", "M"))
+    __slots__ = ("repo", "path", "status", "old", "new", "_parts")
+
+    # Descriptions used instead of a patch for binary files
+    BINARY = {
+        "A": "Binary file added",
+        "M": "Binary file modified",
+        "D": "Binary file deleted",
+    }
+
+    def __init__(self, repo, parts, status, old, new):
+        self.repo = repo
+        self.path = "/".join(parts)
+        self.status = status
+        # Tree entries on the two sides, None for added/deleted files
+        self.old = old
+        self.new = new
+        self._parts = parts
+
+    def iter_patch(self, blobs=None, context=3):
+        """Generate the patch line by line, blobs can map raw object IDs to
+        blobs the caller already loaded (e.g. with Repository.get_many),
+        context is the number of unchanged lines around changes, raises
+        MissingObjectError if a blob can't be read
+        """
+        def load(entry):
+            if entry is None:
+                return None
+            if blobs is not None and entry.raw_oid in blobs:
+                blob = blobs[entry.raw_oid]
+            else:
+                blob = self.repo[entry.raw_oid]
+            if not isinstance(blob, mpygit.Blob):
+                raise mpygit.MissingObjectError(entry.oid)
+            return blob
+
+        old_blob = load(self.old)
+        new_blob = load(self.new)
+        if (old_blob is not None and old_blob.is_binary) or \
+                (new_blob is not None and new_blob.is_binary):
+            yield self.BINARY[self.status]
+            return
+
+        if old_blob is None:
+            old_lines, fromfile = [], "/dev/null"
         else:
-            patch = "".join(
-                difflib.unified_diff(
-                    blob1.text.splitlines(keepends=True),
-                    blob2.text.splitlines(keepends=True),
-                    "/".join(["a"] + path),
-                    "/".join(["b"] + path),
-                )
-            )
-            diffs.append(("/".join(path), patch, "M"))
-
-    def deleted_blob(path, blob):
-        if blob.is_binary:
-            diffs.append(("/".join(path), "Binary file deleted", "D"))
+            old_lines = linediff.split_lines(old_blob.text)
+            fromfile = "/".join(["a"] + self._parts)
+        if new_blob is None:
+            new_lines, tofile = [], "/dev/null"
         else:
-            patch = "".join(
-                difflib.unified_diff(
-                    blob.text.splitlines(keepends=True),
-                    [],
-                    "/".join(["a"] + path),
-                    "/dev/null",
-                )
-            )
-            diffs.append(("/".join(path), patch, "D"))
+            new_lines = linediff.split_lines(new_blob.text)
+            tofile = "/".join(["b"] + self._parts)
+        yield from linediff.unified_diff(old_lines, new_lines, fromfile,
+                                         tofile, context)
+
+    @property
+    def patch(self):
+        return "".join(self.iter_patch())
+
+    def __repr__(self):
+        return f"{self.status} {self.path}"
 
+def iter_diffs(repo, commit1, commit2):
+    """Generate the files changed between two commits as FileDiff objects,
+    in the same order as diff_commits, as soon as the tree comparison
+    finds them, only trees are read until a patch is requested
+    """
     def added_subtree(path, tree):
         for entry in tree:
             entry_path = path + [entry.name]
             if entry.isreg():
-                added_blob(entry_path, repo[entry.oid])
+                yield FileDiff(repo, entry_path, "A", None, entry)
             elif entry.isdir():
-                added_subtree(entry_path, repo[entry.oid])
+                yield from added_subtree(entry_path, repo[entry.raw_oid])
 
     def deleted_subtree(path, tree):
         for entry in tree:
             entry_path = path + [entry.name]
             if entry.isreg():
-                deleted_blob(entry_path, repo[entry.oid])
+                yield FileDiff(repo, entry_path, "D", entry, None)
             elif entry.isdir():
-                deleted_subtree(entry_path, repo[entry.oid])
+                yield from deleted_subtree(entry_path, repo[entry.raw_oid])
 
     def diff_subtree(path, tree1, tree2):
-        for entry in tree1:  # Look for deleted blobs
-            newent = tree2[entry.name]
+        # Every entry gets looked up on the other side, so parse both trees
+        # once instead of binary searching them for every entry
+        entries1 = { entry.name : entry for entry in tree1 }
+        entries2 = { entry.name : entry for entry in tree2 }
+
+        for entry in entries1.values():  # Look for deleted blobs
+            newent = entries2.get(entry.name)
             entry_path = path + [entry.name]
             if entry.isreg():
                 if newent is None or not newent.isreg():
-                    deleted_blob(entry_path, repo[entry.oid])
+                    yield FileDiff(repo, entry_path, "D", entry, None)
             elif entry.isdir():
                 if newent is None or not newent.isdir():
-                    deleted_subtree(entry_path, repo[entry.oid])
+                    yield from deleted_subtree(entry_path, repo[entry.raw_oid])
 
-        for entry in tree2:  # Look for added or modified blobs
-            oldent = tree1[entry.name]
+        for entry in entries2.values():  # Look for added or modified blobs
+            oldent = entries1.get(entry.name)
             entry_path = path + [entry.name]
             if entry.isreg():
                 if oldent is None or not oldent.isreg():
-                    added_blob(entry_path, repo[entry.oid])
-                elif entry.oid != oldent.oid:
-                    modified_blob(entry_path, repo[oldent.oid], repo[entry.oid])
+                    yield FileDiff(repo, entry_path, "A", None, entry)
+                elif entry.raw_oid != oldent.raw_oid:
+                    yield FileDiff(repo, entry_path, "M", oldent, entry)
             elif entry.isdir():
                 if oldent is None or not oldent.isdir():
-                    added_subtree(entry_path, repo[entry.oid])
-                elif entry.oid != oldent.oid:
-                    diff_subtree(entry_path, repo[oldent.oid], repo[entry.oid])
+                    yield from added_subtree(entry_path, repo[entry.raw_oid])
+                elif entry.raw_oid != oldent.raw_oid:
+                    yield from diff_subtree(entry_path, repo[oldent.raw_oid],
+                                            repo[entry.raw_oid])
 
     if commit1 is None:
-        added_subtree([], repo[commit2.tree])
+        yield from added_subtree([], repo[commit2.tree])
     else:
-        diff_subtree([], repo[commit1.tree], repo[commit2.tree])
-    return diffs
+        yield from diff_subtree([], repo[commit1.tree], repo[commit2.tree])
+
+def diff_name_status(repo, commit1, commit2):
+    """Generate (path, status) pairs of the files changed between two
+    commits, this only compares trees and never reads any blobs, the
+    result is kept in the repository's metadata cache if it has one
+    """
+    metadata_cache = repo.metadata_cache
+    if metadata_cache is None:
+        for diff in iter_diffs(repo, commit1, commit2):
+            yield diff.path, diff.status
+        return
+
+    key = ("" if commit1 is None else commit1.tree) + ":" + commit2.tree
+    value = metadata_cache.get("name-status", key)
+    if value is None:
+        changes = [ (diff.path, diff.status)
+                    for diff in iter_diffs(repo, commit1, commit2) ]
+        metadata_cache.put("name-status", key, json.dumps(changes).encode())
+    else:
+        changes = json.loads(value)
+    for path, status in changes:
+        yield path, status
+
+# Blob data loaded at a time for computing patches
+DIFF_BATCH_BYTES = 8 * 1024 * 1024
+
+# Repositories opened by diff workers, by path, as [stat information of
+# their pack directory when they were opened, repository, number of batches
+# using it, replaced by a newer one], workers can be threads sharing them
+worker_repos = {}
+worker_repos_lock = threading.Lock()
+
+@contextlib.contextmanager
+def worker_repo(repo_path, reopen=False):
+    """Use the Repository of diff workers for a path, it is reopened when
+    packs were added or removed since (e.g. by a repack), the one it
+    replaces is only closed once no other batch is using it anymore
+    """
+    with worker_repos_lock:
+        entry = worker_repos.get(repo_path)
+        if entry is None or reopen or mpygit.stat_key(
+                entry[1].path / "objects" / "pack") != entry[0]:
+            if entry is not None:
+                entry[3] = True
+                if entry[2] == 0:
+                    entry[1].close()
+            repo = mpygit.Repository(repo_path)
+            entry = worker_repos[repo_path] = \
+                [ mpygit.stat_key(repo.path / "objects" / "pack"), repo, 0,
+                  False ]
+        entry[2] += 1
+    try:
+        yield entry[1]
+    finally:
+        with worker_repos_lock:
+            entry[2] -= 1
+            if entry[3] and entry[2] == 0:
+                entry[1].close()
+
+def diff_worker(repo_path, diffs, context, batch_bytes):
+    """Compute the patches of a batch of (path parts, status, old entry,
+    new entry) tuples in a worker (a process, or a thread), the repository
+    is opened once and shared by the batches, and reopened if a blob is
+    missing from it, as the packs can change within the timestamp
+    granularity of the filesystem
+    """
+    def patches(reopen):
+        with worker_repo(repo_path, reopen) as repo:
+            return list(iter_patches(repo, [ FileDiff(repo, *diff)
+                                             for diff in diffs ],
+                                     context, len(diffs), batch_bytes))
+
+    try:
+        return patches(False)
+    except mpygit.MissingObjectError:
+        return patches(True)
+
+def iter_patches(repo, diffs, context=3, batch_size=32,
+                 batch_bytes=DIFF_BATCH_BYTES):
+    """Generate the patches of a list of FileDiffs, their blobs are read in
+    pack order with Repository.get_many, in batches of at most batch_size
+    files and batch_bytes of blob data (a single larger file gets a batch
+    of its own), so only one batch of blobs is in memory at a time
+    """
+    def blob_size(entry):
+        if entry is None:
+            return 0
+        info = repo.object_info(entry.raw_oid)
+        return 0 if info is None else info.size
+
+    def patches(batch):
+        blobs = dict(repo.get_many({ entry.raw_oid for diff in batch
+                                     for entry in (diff.old, diff.new)
+                                     if entry is not None }))
+        for diff in batch:
+            yield "".join(diff.iter_patch(blobs, context))
+
+    batch, size = [], 0
+    for diff in diffs:
+        # Object sizes only take reading headers
+        diff_size = blob_size(diff.old) + blob_size(diff.new)
+        if len(batch) > 0 and (len(batch) == batch_size or
+                               size + diff_size > batch_bytes):
+            yield from patches(batch)
+            batch, size = [], 0
+        batch.append(diff)
+        size += diff_size
+    if len(batch) > 0:
+        yield from patches(batch)
+
+def diff_commits(repo, commit1, commit2, executor=None, batch_size=32,
+                 context=3, batch_bytes=DIFF_BATCH_BYTES):
+    """Generate diffs between two commits in a repository, with context
+    lines of context around changes
+
+    The blobs are loaded in batches of batch_size files and batch_bytes of
+    data (see iter_patches), with an executor (e.g. a
+    concurrent.futures.ProcessPoolExecutor, or a ThreadPoolExecutor) the
+    batches of batch_size files are loaded and diffed by its workers, which
+    open the repository themselves by path, the result is the same as
+    without one
+    """
+    diffs = list(iter_diffs(repo, commit1, commit2))
+
+    if executor is not None:
+        batches = [ [ (diff._parts, diff.status, diff.old, diff.new)
+                      for diff in diffs[i:i+batch_size] ]
+                    for i in range(0, len(diffs), batch_size) ]
+        # map keeps the order of the batches
+        patches = itertools.chain.from_iterable(
+            executor.map(diff_worker, itertools.repeat(str(repo.path)),
+                         batches, itertools.repeat(context),
+                         itertools.repeat(batch_bytes)))
+        return [ (diff.path, patch, diff.status)
+                 for diff, patch in zip(diffs, patches) ]
+
+    return [ (diff.path, patch, diff.status) for diff, patch in
+             zip(diffs, iter_patches(repo, diffs, context, batch_size,
+                                     batch_bytes)) ]
+
+# Commit times can be off by this much (clock skew) without time based
+# cutoffs giving wrong answers, they are only used without generation
+# numbers from the commit-graph
+CLOCK_SKEW = 86400
+
+def walk(repo, start_oid, limit=math.inf, paths=None):
+    """Walk the history newest first, commits are only parsed in full when
+    something other than their parents, tree or commit time is accessed,
+    if they are in the commit-graph
+
+    With paths (a list of paths like "dir/file"), only the commits changing
+    them are generated, see walk_paths
+    """
+    if paths is not None:
+        yield from walk_paths(repo, start_oid, limit, paths)
+        return
+
+    cursor = WalkCursor(repo, start_oid)
+    yield from itertools.islice(cursor, None if limit == math.inf else limit)
+
+class WalkCursor:
+    """Resumable walk of the history newest first, this is what walk uses,
+    the state can be saved as a string with dumps and picked up later with
+    loads, so e.g. the next page of a log doesn't have to walk through the
+    previous pages again
+
+    Commits with the same commit time come out in the order they were
+    found, so a resumed walk continues exactly like the original would
+    have. To keep the state small, commits seen already are only
+    remembered while they could still be reached, going by the generation
+    numbers from the commit-graph, or failing that the commit times (with
+    CLOCK_SKEW to spare). If more than MAX_SAVED_COMMITS would still have
+    to be saved, the state only has the start and the position, and loads
+    walks through the previous pages again.
+    """
+
+    VERSION = 2
+
+    # Layout of the header of saved states: version, flags, start commit,
+    # position, insertion counter, number of heap and visited entries
+    HEADER = struct.Struct(">BB20sQQII")
+    HEAP_ENTRY = struct.Struct(">20sQ")
+    VISITED_ENTRY = struct.Struct(">20sIq")
+
+    # Flag of states that only have the start and the position
+    RESTART = 1
+
+    # Stands for an unknown generation number in saved states
+    NO_GENERATION = 0xffffffff
 
-def walk(repo, start_oid, limit=math.inf):
+    # Saving more commits than this falls back to a restart, this keeps
+    # saved states under 3 KiB
+    MAX_SAVED_COMMITS = 64
+
+    # Saved states larger than this (uncompressed) are rejected by loads
+    MAX_STATE_SIZE = 64 * 1024
+
+    def __init__(self, repo, start_oid=None):
+        self.repo = repo
+        # Number of commits generated so far
+        self.position = 0
+        # Max-heap of (commit time, -insertion counter, commit)
+        self._heap = []
+        self._counter = 0
+        # (generation number or None, commit time) of the commits seen
+        # already
+        self._visited = {}
+        self._start = None
+        if start_oid is not None:
+            commit = repo.get_commit(start_oid)
+            self._start = commit.oid
+            self._push(commit)
+
+    def _push(self, commit, counter=None):
+        if counter is None:
+            counter = self._counter
+            self._counter += 1
+        self._heap.append((commit.commit_time, -counter, commit))
+        heapq._siftdown_max(self._heap, 0, len(self._heap) - 1)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self._heap) > 0:
+            commit_time, _, commit = heapq._heappop_max(self._heap)
+            if commit.oid in self._visited:
+                continue
+            self._visited[commit.oid] = \
+                (getattr(commit, "generation", None), commit_time)
+            for parent in commit.parents:
+                if parent not in self._visited:
+                    self._push(self.repo.get_commit(parent))
+            self.position += 1
+            return commit
+        raise StopIteration
+
+    def take(self, num):
+        """Get the next num commits (or less at the end) as a list"""
+        return list(itertools.islice(self, num))
+
+    def skip(self, num):
+        """Skip the next num commits, commits in the commit-graph are not
+        parsed
+        """
+        for _ in itertools.islice(self, num):
+            pass
+
+    def _prune(self):
+        """Forget what can't matter for the rest of the walk"""
+        # Commits seen already might still be in the heap as duplicates
+        self._heap = [ item for item in self._heap
+                       if item[2].oid not in self._visited ]
+        heapq._heapify_max(self._heap)
+
+        # Anything reachable from here on is an ancestor of a commit in the
+        # heap, so it has a lower generation number than all of them, and
+        # (unless the clocks were off) an older commit time
+        generations = [ getattr(commit, "generation", None)
+                        for _, _, commit in self._heap ]
+        if len(generations) == 0:
+            self._visited = {}
+        elif None in generations:
+            bound = max(commit_time for commit_time, _, _ in self._heap) + \
+                CLOCK_SKEW
+            self._visited = { oid : (generation, commit_time)
+                              for oid, (generation, commit_time)
+                              in self._visited.items()
+                              if commit_time <= bound }
+        else:
+            bound = max(generations)
+            self._visited = { oid : (generation, commit_time)
+                              for oid, (generation, commit_time)
+                              in self._visited.items()
+                              if generation is None or generation < bound }
+
+    def dumps(self):
+        """Save the state of the walk as a URL safe string"""
+        self._prune()
+        start = b"\0" * 20 if self._start is None \
+            else binascii.unhexlify(self._start)
+        if len(self._heap) + len(self._visited) > self.MAX_SAVED_COMMITS:
+            data = self.HEADER.pack(self.VERSION, self.RESTART, start,
+                                    self.position, 0, 0, 0)
+            return base64.urlsafe_b64encode(zlib.compress(data)).decode()
+
+        data = bytearray(self.HEADER.pack(self.VERSION, 0, start,
+                                          self.position, self._counter,
+                                          len(self._heap),
+                                          len(self._visited)))
+        for _, neg_counter, commit in self._heap:
+            data += self.HEAP_ENTRY.pack(binascii.unhexlify(commit.oid),
+                                         -neg_counter)
+        for oid, (generation, commit_time) in self._visited.items():
+            data += self.VISITED_ENTRY.pack(
+                binascii.unhexlify(oid),
+                self.NO_GENERATION if generation is None else generation,
+                commit_time)
+        return base64.urlsafe_b64encode(zlib.compress(data)).decode()
+
+    @classmethod
+    def loads(cls, repo, state):
+        """Restore a walk saved with dumps, raises ValueError if the state
+        is invalid, e.g. corrupted, too large, or for another repository
+        """
+        try:
+            deflator = zlib.decompressobj()
+            data = deflator.decompress(base64.urlsafe_b64decode(state),
+                                       cls.MAX_STATE_SIZE)
+            if not deflator.eof:
+                raise ValueError("walk state is truncated or too large")
+            version, flags, start, position, counter, num_heap, \
+                num_visited = cls.HEADER.unpack_from(data)
+        except (binascii.Error, zlib.error, struct.error) as exc:
+            raise ValueError("invalid walk state") from exc
+        if version != cls.VERSION:
+            raise ValueError(f"unsupported walk state version {version}")
+        if len(data) != cls.HEADER.size + num_heap * cls.HEAP_ENTRY.size + \
+                num_visited * cls.VISITED_ENTRY.size:
+            raise ValueError("walk state has the wrong length")
+
+        def get_commit(oid_bytes):
+            oid = binascii.hexlify(oid_bytes).decode()
+            commit = repo.get_commit(oid)
+            if not isinstance(commit, (mpygit.Commit, mpygit.GraphCommit)):
+                raise ValueError(f"walk state has unknown commit {oid}")
+            return commit
+
+        if flags & cls.RESTART:
+            cursor = cls(repo)
+            if position > 0:
+                commit = get_commit(start)
+                cursor._start = commit.oid
+                cursor._push(commit)
+                cursor.skip(position)
+                if cursor.position != position:
+                    raise ValueError("walk state is past the end of the "
+                                     "history")
+            return cursor
+
+        cursor = cls(repo)
+        if start != b"\0" * 20:
+            cursor._start = binascii.hexlify(start).decode()
+        cursor.position = position
+        pos = cls.HEADER.size
+        for _ in range(num_heap):
+            oid_bytes, heap_counter = cls.HEAP_ENTRY.unpack_from(data, pos)
+            cursor._push(get_commit(oid_bytes), heap_counter)
+            pos += cls.HEAP_ENTRY.size
+        for _ in range(num_visited):
+            oid_bytes, generation, commit_time = \
+                cls.VISITED_ENTRY.unpack_from(data, pos)
+            if generation == cls.NO_GENERATION:
+                generation = None
+            cursor._visited[binascii.hexlify(oid_bytes).decode()] = \
+                (generation, commit_time)
+            pos += cls.VISITED_ENTRY.size
+        cursor._counter = counter
+        return cursor
+
+def walk_paths(repo, start_oid, limit, paths):
+    """Walk the commits changing any of a list of paths newest first, with
+    git's default history simplification: a commit is shown if it differs
+    from all of its parents in the paths, and only the first parent that
+    doesn't differ is followed, the changed-path Bloom filters of the
+    commit-graph are used to skip tree comparisons where possible
+    """
     def heappush_max(heap, item):
-        """Push item onto heap, maintaining the max-heap invariant."""
         heap.append(item)
         heapq._siftdown_max(heap, 0, len(heap) - 1)
 
-    # Priority-queue to always have the newest commit
-    commits = [ repo[start_oid] ]
-    # Avoid duplicates when two histories converge
+    path_parts = [ path.strip("/").split("/") for path in paths ]
+    # Bloom filters have the changed paths and their leading directories,
+    # so a path didn't change if any of them is missing
+    bloom_keys = [ [ "/".join(parts[:i]) for i in range(1, len(parts) + 1) ]
+                   for parts in path_parts ]
+    graph = repo.commit_graph
+
+    # Modes and object IDs the paths have at each root tree we have seen,
+    # like git a mode change alone is a change too
+    path_oids_cache = {}
+
+    def path_oids(tree):
+        oids = path_oids_cache.get(tree)
+        if oids is None:
+            oids = []
+            for parts in path_parts:
+                oid = binascii.unhexlify(tree)
+                entry = None
+                for name in parts:
+                    cur = repo[oid]
+                    entry = cur[name] if isinstance(cur, mpygit.Tree) \
+                        else None
+                    if entry is None:
+                        break
+                    oid = entry.raw_oid
+                oids.append(None if entry is None
+                            else (entry.mode, entry.raw_oid))
+            oids = path_oids_cache[tree] = tuple(oids)
+        return oids
+
+    def maybe_changed(commit):
+        """False if the Bloom filter of the commit shows the paths are the
+        same as in its first parent
+        """
+        if graph is None:
+            return True
+        pos = graph.find(binascii.unhexlify(commit.oid))
+        if pos is None:
+            return True
+        bloom = graph.changed_paths(pos)
+        if bloom is None:
+            return True
+        return any(all(bloom.might_contain(key) for key in keys)
+                   for keys in bloom_keys)
+
+    commits = [ repo.get_commit(start_oid) ]
     visited = set()
 
-    # Process next commit
     tot = 0
     while len(commits) > 0 and tot < limit:
-        cur = heapq._heappop_max(commits)
-        # Skip commit if already visited
-        if cur.oid in visited:
+        commit = heapq._heappop_max(commits)
+        if commit.oid in visited:
             continue
-        # Mark the current commit as visited
-        visited.add(cur.oid)
-        # Add parents of the current commit
-        for parent in cur.parents:
-            heappush_max(commits, repo[parent])
-        # Yield current commit
-        tot += 1
-        yield cur
+        visited.add(commit.oid)
+
+        if len(commit.parents) == 0:
+            # Root commits are shown if they have any of the paths
+            if any(oid is not None for oid in path_oids(commit.tree)):
+                tot += 1
+                yield commit
+            continue
+
+        treesame = None
+        parents = []
+        for nth, parent_oid in enumerate(commit.parents):
+            parent = repo.get_commit(parent_oid)
+            if (nth == 0 and not maybe_changed(commit)) or \
+                    path_oids(commit.tree) == path_oids(parent.tree):
+                treesame = parent
+                break
+            parents.append(parent)
+
+        if treesame is not None:
+            heappush_max(commits, treesame)
+        else:
+            for parent in parents:
+                heappush_max(commits, parent)
+            tot += 1
+            yield commit
 
 def get_latest_change(repo, start_oid, path):
+    """Find the latest commit changing a path, the answer is kept in the
+    repository's metadata cache if it has one
+    """
+    metadata_cache = repo.metadata_cache
+    if metadata_cache is None:
+        return find_latest_change(repo, start_oid, path)
+    start = repo.get_commit(start_oid)
+    key = start.oid + ":" + "/".join(path)
+    value = metadata_cache.get("latest-change", key)
+    if value is not None:
+        return repo.get_commit(value.decode()) if value else None
+    commit = find_latest_change(repo, start.oid, path)
+    metadata_cache.put("latest-change", key,
+                       b"" if commit is None else commit.oid.encode())
+    return commit
+
+def find_latest_change(repo, start_oid, path):
     def treesame(c1, c2, path):
         t1 = repo[c1.tree]
         t2 = repo[c2.tree]
@@ -153,17 +631,17 @@ def get_latest_change(repo, start_oid, path):
             e2 = t2[cur]
             if e1 is None or e2 is None:
                 return False
-            if e1.oid == e2.oid:
+            if e1.raw_oid == e2.raw_oid:
                 return True
-            t1 = repo[e1.oid]
-            t2 = repo[e2.oid]
+            t1 = repo[e1.raw_oid]
+            t2 = repo[e2.raw_oid]
         return False
 
     def heappush_max(heap, item):
         heap.append(item)
         heapq._siftdown_max(heap, 0, len(heap) - 1)
 
-    commits = [ repo[start_oid] ]
+    commits = [ repo.get_commit(start_oid) ]
     visited = set()
 
     while len(commits) > 0:
@@ -174,7 +652,7 @@ def get_latest_change(repo, start_oid, path):
 
         non_treesame = []
         for parent_oid in commit.parents:
-            parent = repo[parent_oid]
+            parent = repo.get_commit(parent_oid)
             if treesame(commit, parent, path):
                 heappush_max(commits, parent)
                 non_treesame = []
@@ -185,3 +663,333 @@ def get_latest_change(repo, start_oid, path):
             heappush_max(commits, parent)
         if len(commit.parents) == 0 or len(non_treesame) > 0:
             return commit
+
+def get_latest_changes(repo, start_oid, dir_path):
+    """Find the latest change to every entry of a directory with a single
+    history walk, returns a dict of entry names to commits, this gives the
+    same answers as calling get_latest_change for each entry, they are
+    kept in the repository's metadata cache if it has one
+    """
+    metadata_cache = repo.metadata_cache
+    if metadata_cache is None:
+        return find_latest_changes(repo, start_oid, dir_path)
+    start = repo.get_commit(start_oid)
+    key = start.oid + ":" + "/".join(dir_path)
+    value = metadata_cache.get("latest-changes", key)
+    if value is not None:
+        return { name : repo.get_commit(oid)
+                 for name, oid in json.loads(value).items() }
+    result = find_latest_changes(repo, start.oid, dir_path)
+    metadata_cache.put("latest-changes", key, json.dumps(
+        { name : commit.oid for name, commit in result.items() }).encode())
+    return result
+
+def find_latest_changes(repo, start_oid, dir_path):
+    """get_latest_changes without the metadata cache"""
+    def dir_oid(commit):
+        """Raw object ID of the directory at a commit, or None"""
+        oid = binascii.unhexlify(commit.tree)
+        for cur in dir_path:
+            tree = repo[oid]
+            if not isinstance(tree, mpygit.Tree):
+                return None
+            entry = tree[cur]
+            if entry is None:
+                return None
+            oid = entry.raw_oid
+        return oid
+
+    # Entries of every directory version we have seen, many commits share them
+    entries_cache = {}
+
+    def dir_entries(oid):
+        entries = entries_cache.get(oid)
+        if entries is None:
+            tree = repo[oid]
+            if isinstance(tree, mpygit.Tree):
+                entries = { entry.name : entry.raw_oid for entry in tree }
+            else:
+                entries = {}
+            entries_cache[oid] = entries
+        return entries
+
+    def heappush_max(heap, item):
+        heap.append(item)
+        heapq._siftdown_max(heap, 0, len(heap) - 1)
+
+    start = repo.get_commit(start_oid)
+    start_dir = dir_oid(start)
+    if start_dir is None:
+        return {}
+
+    # Entries we still have to find the latest change for
+    unresolved = set(dir_entries(start_dir))
+    result = {}
+
+    # Entries each queued commit is responsible for, and entries each
+    # visited commit has already been processed for
+    pending = { start.oid : set(unresolved) }
+    visited = {}
+    commits = [ start ]
+
+    while len(commits) > 0 and len(unresolved) > 0:
+        commit = heapq._heappop_max(commits)
+        names = pending.pop(commit.oid, None)
+        if names is None:
+            continue
+        done = visited.setdefault(commit.oid, set())
+        names = (names - done) & unresolved
+        if len(names) == 0:
+            continue
+        done |= names
+
+        cur_dir = dir_oid(commit)
+        cur_entries = dir_entries(cur_dir)
+        for parent_oid in commit.parents:
+            if len(names) == 0:
+                break
+            parent = repo.get_commit(parent_oid)
+            parent_dir = dir_oid(parent)
+            if parent_dir is None:
+                continue
+            if parent_dir == cur_dir:
+                # The whole directory is the same, no need to look at entries
+                treesame = names
+            else:
+                parent_entries = dir_entries(parent_dir)
+                treesame = { name for name in names
+                             if parent_entries.get(name) == cur_entries[name] }
+            if len(treesame) == 0:
+                continue
+            # Follow the first treesame parent for every entry
+            if parent.oid not in pending:
+                pending[parent.oid] = set()
+                heappush_max(commits, parent)
+            pending[parent.oid] |= treesame
+            names = names - treesame
+
+        # Entries that aren't treesame to any parent were changed here
+        for name in names:
+            result[name] = commit
+        unresolved -= names
+
+    return result
+
+def reachable_commits(repo, start_oid):
+    """Find the commits reachable from a commit, using the reachability
+    bitmap index where possible, returns the bitmap (an integer) of commits
+    in the bitmapped pack, and the set of other commits, which have to be
+    found by walking the history
+    """
+    def heappush_max(heap, item):
+        heap.append(item)
+        heapq._siftdown_max(heap, 0, len(heap) - 1)
+
+    bitmap = repo.bitmap
+    bits = 0
+    others = set()
+
+    # Walk newest first, so bitmaps of recent commits cover as much of the
+    # history as possible before we get there
+    commits = [ repo.get_commit(start_oid) ]
+    visited = set()
+    while len(commits) > 0:
+        commit = heapq._heappop_max(commits)
+        if commit.oid in visited:
+            continue
+        visited.add(commit.oid)
+
+        if bitmap is not None:
+            oid_bytes = binascii.unhexlify(commit.oid)
+            pos = bitmap.position(oid_bytes)
+        else:
+            pos = None
+        if pos is not None:
+            # Covered by a bitmap we already have, so is its history
+            if (bits >> pos) & 1:
+                continue
+            commit_bits = bitmap.get(oid_bytes)
+            if commit_bits is not None:
+                bits |= commit_bits
+                continue
+            bits |= 1 << pos
+        else:
+            others.add(commit.oid)
+
+        for parent in commit.parents:
+            heappush_max(commits, repo.get_commit(parent))
+
+    if bitmap is not None:
+        bits &= bitmap.commits
+    return bits, others
+
+def count_commits(repo, oid):
+    """Count the commits reachable from a commit (git rev-list --count)"""
+    bits, others = reachable_commits(repo, oid)
+    return bits.bit_count() + len(others)
+
+def ahead_behind(repo, oid1, oid2):
+    """Count the commits reachable from oid1 but not oid2 (ahead), and the
+    ones reachable from oid2 but not oid1 (behind)
+    """
+    bits1, others1 = reachable_commits(repo, oid1)
+    bits2, others2 = reachable_commits(repo, oid2)
+    ahead = (bits1 & ~bits2).bit_count() + len(others1 - others2)
+    behind = (bits2 & ~bits1).bit_count() + len(others2 - others1)
+    return ahead, behind
+
+# Generation number of commits not in the commit-graph, they are newer
+# than all the commits in it
+GENERATION_INFINITY = float("inf")
+
+def generation(commit):
+    """Generation number of a commit, or GENERATION_INFINITY"""
+    gen = getattr(commit, "generation", None)
+    return GENERATION_INFINITY if gen is None else gen
+
+def cannot_reach(commit, target):
+    """Can we tell that a commit (other than target) can't reach target,
+    from the generation numbers, or failing that from the commit times
+    """
+    gen, target_gen = generation(commit), generation(target)
+    if target_gen == GENERATION_INFINITY:
+        # The commit-graph has the parents of everything in it, so commits
+        # in it can't reach ones outside of it
+        if gen != GENERATION_INFINITY:
+            return True
+        return commit.commit_time < target.commit_time - CLOCK_SKEW
+    return gen <= target_gen
+
+def reaches(repo, start_oid, target, memo):
+    """Can a commit reach target, memo caches the answers for every commit
+    looked at, so it can be shared between searches for the same target
+    """
+    commits = {}
+    stack = [ start_oid ]
+    while len(stack) > 0:
+        oid = stack[-1]
+        if oid in memo:
+            stack.pop()
+            continue
+        if oid == target.oid:
+            memo[oid] = True
+            stack.pop()
+            continue
+        commit = commits.get(oid)
+        if commit is None:
+            commit = commits[oid] = repo.get_commit(oid)
+            if cannot_reach(commit, target):
+                memo[oid] = False
+                stack.pop()
+                continue
+
+        # Answer from the parents, looking at the unknown ones first
+        result = False
+        for parent in commit.parents:
+            known = memo.get(parent)
+            if known is None:
+                stack.append(parent)
+                break
+            if known:
+                result = True
+                break
+        else:
+            memo[oid] = result
+            del commits[oid]
+            stack.pop()
+            continue
+        if result:
+            memo[oid] = True
+            del commits[oid]
+            stack.pop()
+    return memo[start_oid]
+
+def is_ancestor(repo, oid1, oid2):
+    """Is the first commit an ancestor of (or the same as) the second one"""
+    target = repo.get_commit(oid1)
+    start = repo.get_commit(oid2)
+    return reaches(repo, start.oid, target, {})
+
+def branches_containing(repo, oid):
+    """Names of the branches that contain a commit, with a single search
+    shared between all of them
+    """
+    target = repo.get_commit(oid)
+    memo = {}
+    return sorted(name for name, head in repo.heads.items()
+                  if reaches(repo, head, target, memo))
+
+def merge_bases(repo, oid1, oid2):
+    """Find the best common ancestors of two commits (git merge-base
+    --all), newest first
+
+    Both sides are painted down their history, ordered by generation number
+    (or commit time if there is none), until only commits reachable from an
+    already found common ancestor remain
+    """
+    PARENT1, PARENT2, STALE = 1, 2, 4
+
+    one = repo.get_commit(oid1)
+    two = repo.get_commit(oid2)
+    if one.oid == two.oid:
+        return [ one ]
+
+    flags = {}
+    heap = []
+    counter = 0
+    # Number of heap entries of each commit, and of non-stale entries
+    queued = {}
+    nonstale = 0
+
+    def push(commit):
+        nonlocal counter, nonstale
+        heap.append(((generation(commit), commit.commit_time), -counter,
+                     commit))
+        heapq._siftdown_max(heap, 0, len(heap) - 1)
+        counter += 1
+        queued[commit.oid] = queued.get(commit.oid, 0) + 1
+        if not flags[commit.oid] & STALE:
+            nonstale += 1
+
+    flags[one.oid] = PARENT1
+    flags[two.oid] = PARENT2
+    push(one)
+    push(two)
+
+    results = []
+    result_oids = set()
+    while nonstale > 0:
+        _, _, commit = heapq._heappop_max(heap)
+        commit_flags = flags[commit.oid]
+        queued[commit.oid] -= 1
+        if not commit_flags & STALE:
+            nonstale -= 1
+
+        if commit_flags == PARENT1 | PARENT2:
+            if commit.oid not in result_oids:
+                result_oids.add(commit.oid)
+                results.append(commit)
+            # Everything below a common ancestor is stale
+            commit_flags |= STALE
+
+        for parent_oid in commit.parents:
+            old_flags = flags.get(parent_oid, 0)
+            if old_flags & commit_flags == commit_flags:
+                continue
+            flags[parent_oid] = old_flags | commit_flags
+            if not old_flags & STALE and commit_flags & STALE:
+                nonstale -= queued.get(parent_oid, 0)
+            push(repo.get_commit(parent_oid))
+
+    # Drop common ancestors reachable from other ones
+    results = [ result for result in results
+                if not any(other.oid != result.oid and
+                           is_ancestor(repo, result.oid, other.oid)
+                           for other in results) ]
+    results.sort(key=lambda commit: commit.commit_time, reverse=True)
+    return results
+
+def merge_base(repo, oid1, oid2):
+    """Find the best common ancestor of two commits, or None"""
+    results = merge_bases(repo, oid1, oid2)
+    return results[0] if len(results) > 0 else None
@@ -0,0 +1,427 @@
+#
+# Part of mpygit - linediff.py - Line based diff engine
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# This implements the histogram diff algorithm (as in git diff
+# --histogram), which falls back to Myers' O(ND) algorithm for regions
+# where every line is too common to anchor on, changes are then moved where
+# git would put them, the output follows the unified format of git, opcodes
+# are in the same format as difflib's
+#
+# The result is the same as git diff --histogram --no-indent-heuristic,
+# except for regions that fall back to Myers' algorithm (those with only
+# very common lines, and everything left once the work budget is used up),
+# git's own implementation of it has heuristics of its own, so there the
+# two can pick different (but equally valid) diffs
+
+# Lines occurring more often than this are never used as anchors
+MAX_CHAIN_LENGTH = 64
+
+# Myers' algorithm settles for the furthest point it reached after this many
+# edits, and continues from there, this bounds its time and memory use on
+# inputs that have little in common, at the cost of a non-minimal diff
+DEFAULT_MAX_COST = 256
+
+# Every region the histogram algorithm splits the input into costs time in
+# proportion to its size, on inputs with many changes that adds up to
+# quadratic time, once the sizes of the regions looked at add up to this,
+# the remaining regions are left to Myers' algorithm (bounded by max_cost)
+DEFAULT_MAX_WORK = 1 << 22
+
+def intern_lines(a, b):
+    """Map the lines of both sides to small integers, equal lines get the
+    same integer, so comparing them later is cheap
+    """
+    ids = {}
+    a_ids = [ ids.setdefault(line, len(ids)) for line in a ]
+    b_ids = [ ids.setdefault(line, len(ids)) for line in b ]
+    return a_ids, b_ids
+
+def myers(a, b, a_lo, a_hi, b_lo, b_hi, max_cost):
+    """Find the matching blocks of a[a_lo:a_hi] and b[b_lo:b_hi] with
+    Myers' algorithm, returns a list of (i, j, size) tuples, after every
+    max_cost edits the search is cut short at the furthest point reached,
+    and restarted from there
+    """
+    blocks = []
+    while a_lo < a_hi or b_lo < b_hi:
+        x, y = myers_search(a, b, a_lo, a_hi, b_lo, b_hi, max_cost, blocks)
+        a_lo += x
+        b_lo += y
+    return blocks
+
+def myers_search(a, b, a_lo, a_hi, b_lo, b_hi, max_cost, blocks):
+    """Search for the shortest edit script with at most max_cost edits,
+    adds the matching blocks up to the end (or the furthest point reached)
+    to blocks, and returns that point
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    max_d = min(n + m, max_cost)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    # Furthest reaching x for every diagonal k in -d..d after each round d,
+    # stored at index k + d
+    trace = []
+
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset+k-1] < v[offset+k+1]):
+                x = v[offset+k+1]
+            else:
+                x = v[offset+k-1] + 1
+            y = x - k
+            while x < n and y < m and a[a_lo+x] == b[b_lo+y]:
+                x += 1
+                y += 1
+            v[offset+k] = x
+            if x >= n and y >= m:
+                trace.append(v[offset-d:offset+d+1])
+                blocks.extend(myers_blocks(trace, a_lo, b_lo, n, m))
+                return n, m
+        trace.append(v[offset-d:offset+d+1])
+
+    # Too costly, settle for the furthest point inside both sides
+    x, y = max(((v[offset+k], v[offset+k] - k)
+                for k in range(-max_d, max_d + 1, 2)
+                if v[offset+k] <= n and 0 <= v[offset+k] - k <= m),
+               key=sum)
+    blocks.extend(myers_blocks(trace, a_lo, b_lo, x, y))
+    return x, y
+
+def myers_blocks(trace, a_lo, b_lo, x, y):
+    """Walk back through the trace of Myers' algorithm to recover the
+    matching blocks
+    """
+    blocks = []
+    for d in range(len(trace) - 1, 0, -1):
+        prev = trace[d-1]
+        k = x - y
+        if k == -d or (k != d and prev[k-1+d-1] < prev[k+1+d-1]):
+            prev_k = k + 1
+            prev_x = prev[prev_k+d-1]
+            mid_x = prev_x
+        else:
+            prev_k = k - 1
+            prev_x = prev[prev_k+d-1]
+            mid_x = prev_x + 1
+        if x > mid_x:
+            blocks.append((a_lo + mid_x, b_lo + mid_x - k, x - mid_x))
+        x, y = prev_x, prev_x - prev_k
+    if x > 0:
+        blocks.append((a_lo, b_lo, x))
+    blocks.reverse()
+    return blocks
+
+def histogram(a, b, max_cost, max_work):
+    """Find the matching blocks of a and b with the histogram algorithm,
+    returns a sorted list of (i, j, size) tuples, after looking at max_work
+    lines Myers' algorithm takes over
+    """
+    blocks = []
+    work = 0
+
+    # NOTE: unlike its other algorithms, git doesn't trim the common prefix
+    # and suffix for the histogram diff, doing it would change which lines
+    # get picked as anchors
+    regions = [ (0, len(a), 0, len(b)) ]
+    while len(regions) > 0:
+        a_lo, a_hi, b_lo, b_hi = regions.pop()
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+        work += a_hi - a_lo + b_hi - b_lo
+        if work > max_work:
+            blocks.extend(myers(a, b, a_lo, a_hi, b_lo, b_hi, max_cost))
+            continue
+
+        # Occurrences of every line on the left side
+        positions = {}
+        for i in range(a_lo, a_hi):
+            positions.setdefault(a[i], []).append(i)
+
+        # Find the longest common region with the least frequent lines
+        best = None
+        best_count = MAX_CHAIN_LENGTH + 1
+        common = False
+        j = b_lo
+        while j < b_hi:
+            occurrences = positions.get(b[j])
+            if occurrences is None:
+                j += 1
+                continue
+            common = True
+            next_j = j + 1
+            if len(occurrences) > best_count:
+                j = next_j
+                continue
+            skip_to = -1
+            for i in occurrences:
+                # Occurrences inside the match found from an earlier one
+                # would only find a part of it
+                if i < skip_to:
+                    continue
+                # Extend the match both ways
+                i_start, j_start = i, j
+                while i_start > a_lo and j_start > b_lo \
+                        and a[i_start-1] == b[j_start-1]:
+                    i_start -= 1
+                    j_start -= 1
+                i_end, j_end = i + 1, j + 1
+                while i_end < a_hi and j_end < b_hi and a[i_end] == b[j_end]:
+                    i_end += 1
+                    j_end += 1
+                count = min(len(positions[a[k]])
+                            for k in range(i_start, i_end))
+                size = i_end - i_start
+                # Lines occurring MAX_CHAIN_LENGTH + 1 times are looked at,
+                # but never picked, as that falls back to Myers
+                if count < best_count or (count == best_count and
+                                          best is not None and
+                                          size > best[2]):
+                    best = (i_start, j_start, size)
+                    best_count = count
+                next_j = max(next_j, j_end)
+                skip_to = i_end
+            j = next_j
+
+        if best is not None:
+            i, j, size = best
+            blocks.append(best)
+            regions.append((a_lo, i, b_lo, j))
+            regions.append((i + size, a_hi, j + size, b_hi))
+        elif common:
+            # Only lines too common to anchor on, let Myers handle it
+            blocks.extend(myers(a, b, a_lo, a_hi, b_lo, b_hi, max_cost))
+
+    blocks.sort()
+    return blocks
+
+def diff_lines(a, b, algorithm="histogram", max_cost=DEFAULT_MAX_COST,
+               max_work=DEFAULT_MAX_WORK):
+    """Compare two lists of lines, returns (tag, i1, i2, j1, j2) opcodes
+    like difflib.SequenceMatcher.get_opcodes, algorithm is histogram or
+    myers, Myers' algorithm stops looking for a minimal diff after max_cost
+    edits, and the histogram algorithm hands over to it after looking at
+    max_work lines, which bounds the time spent on very different inputs
+    """
+    a, b = intern_lines(a, b)
+    if algorithm == "histogram":
+        blocks = histogram(a, b, max_cost, max_work)
+    elif algorithm == "myers":
+        blocks = myers(a, b, 0, len(a), 0, len(b), max_cost)
+    else:
+        raise ValueError(f"unknown diff algorithm {algorithm}")
+
+    # Mark the changed lines on both sides, with a sentinel at the end
+    a_changed = [ True ] * len(a) + [ False ]
+    b_changed = [ True ] * len(b) + [ False ]
+    for i, j, size in blocks:
+        a_changed[i:i+size] = [ False ] * size
+        b_changed[j:j+size] = [ False ] * size
+    compact(a, a_changed, b_changed)
+    compact(b, b_changed, a_changed)
+
+    # Both sides have the same number of unchanged lines, they pair up
+    opcodes = []
+    i = j = 0
+    while i < len(a) or j < len(b):
+        i1, j1 = i, j
+        while not a_changed[i] and not b_changed[j] and i < len(a):
+            i += 1
+            j += 1
+        if i > i1:
+            opcodes.append(("equal", i1, i, j1, j))
+        i1, j1 = i, j
+        while a_changed[i]:
+            i += 1
+        while b_changed[j]:
+            j += 1
+        if i > i1 and j > j1:
+            opcodes.append(("replace", i1, i, j1, j))
+        elif i > i1:
+            opcodes.append(("delete", i1, i, j1, j))
+        elif j > j1:
+            opcodes.append(("insert", i1, i, j1, j))
+    return opcodes
+
+def compact(lines, changed, other):
+    """Slide groups of changed lines to where git puts them (this is
+    xdl_change_compact without the indent heuristic): as far down as
+    possible, merging them with adjacent groups where they can, unless
+    they can be lined up with a change on the other side
+    """
+    def group_end(chg, start):
+        end = start
+        while chg[end]:
+            end += 1
+        return end
+
+    def group_start(chg, end):
+        start = end
+        while start > 0 and chg[start-1]:
+            start -= 1
+        return start
+
+    num = len(lines)
+    g_start, g_end = 0, group_end(changed, 0)
+    o_start, o_end = 0, group_end(other, 0)
+    while True:
+        if g_end > g_start:
+            while True:
+                size = g_end - g_start
+                end_matching_other = -1
+
+                # Slide up as far as possible, the groups on the other side
+                # move along as unchanged lines go from one to the other
+                while g_start > 0 and lines[g_start-1] == lines[g_end-1]:
+                    g_start -= 1
+                    g_end -= 1
+                    changed[g_start] = True
+                    changed[g_end] = False
+                    g_start = group_start(changed, g_start)
+                    o_end = o_start - 1
+                    o_start = group_start(other, o_end)
+                earliest_end = g_end
+                if o_end > o_start:
+                    end_matching_other = g_end
+
+                # Then down as far as possible
+                while g_end < num and lines[g_start] == lines[g_end]:
+                    changed[g_start] = False
+                    changed[g_end] = True
+                    g_start += 1
+                    g_end = group_end(changed, g_end + 1)
+                    o_start = o_end + 1
+                    o_end = group_end(other, o_start)
+                    if o_end > o_start:
+                        end_matching_other = g_end
+
+                # Merging with other groups might allow sliding further
+                if g_end - g_start == size:
+                    break
+
+            if g_end != earliest_end and end_matching_other != -1:
+                # Line up with the change on the other side
+                while o_end == o_start:
+                    g_start -= 1
+                    g_end -= 1
+                    changed[g_start] = True
+                    changed[g_end] = False
+                    g_start = group_start(changed, g_start)
+                    o_end = o_start - 1
+                    o_start = group_start(other, o_end)
+
+        if g_end == num:
+            break
+        g_start = g_end + 1
+        g_end = group_end(changed, g_start)
+        o_start = o_end + 1
+        o_end = group_end(other, o_start)
+
+def group_opcodes(opcodes, n):
+    """Group opcodes into hunks with n lines of context, like
+    difflib.SequenceMatcher.get_grouped_opcodes
+    """
+    if len(opcodes) == 0:
+        return
+    opcodes = list(opcodes)
+    # Trim the context before the first and after the last change
+    tag, i1, i2, j1, j2 = opcodes[0]
+    if tag == "equal":
+        opcodes[0] = (tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2)
+    tag, i1, i2, j1, j2 = opcodes[-1]
+    if tag == "equal":
+        opcodes[-1] = (tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n))
+
+    group = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        # Split at equal runs too long to be context for both sides
+        if tag == "equal" and i2 - i1 > 2 * n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if len(group) > 0 and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+def format_range(start, stop):
+    """Format a hunk range, git leaves out the length if it is 1, and an
+    empty range is given by the line before it
+    """
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    if length == 0:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+def is_funcname(line):
+    """Does a line look like the start of a function (or class, etc.),
+    this is git's default rule
+    """
+    return len(line) > 0 and (line[0].isalpha() or line[0] in "_$")
+
+def split_lines(text):
+    """Split text into lines with their line endings, git only ends lines at
+    newlines, unlike str.splitlines, which also splits at form feeds,
+    carriage returns and other separators
+    """
+    lines = text.split("\n")
+    last = lines.pop()
+    lines = [ line + "\n" for line in lines ]
+    if last != "":
+        lines.append(last)
+    return lines
+
+def format_lines(prefix, lines):
+    for line in lines:
+        if line.endswith("\n"):
+            yield prefix + line
+        else:
+            yield prefix + line + "\n"
+            yield "\\ No newline at end of file\n"
+
+def unified_diff(a, b, fromfile="", tofile="", n=3, algorithm="histogram",
+                 max_cost=DEFAULT_MAX_COST, max_work=DEFAULT_MAX_WORK):
+    """Generate a unified diff of two lists of lines (with their line
+    endings), in git's format, n is the number of context lines
+    """
+    started = False
+    # Hunk headers show the last function name before the hunk
+    searched, funcname = 0, ""
+    for group in group_opcodes(diff_lines(a, b, algorithm, max_cost,
+                                          max_work), n):
+        if not started:
+            yield f"--- {fromfile}\n"
+            yield f"+++ {tofile}\n"
+            started = True
+        first, last = group[0], group[-1]
+        for i in range(first[1] - 1, searched - 1, -1):
+            if is_funcname(a[i]):
+                funcname = " " + a[i][:80].rstrip()
+                break
+        searched = first[1]
+        yield f"@@ -{format_range(first[1], last[2])} " \
+              f"+{format_range(first[3], last[4])} @@{funcname}\n"
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                yield from format_lines(" ", a[i1:i2])
+                continue
+            yield from format_lines("-", a[i1:i2])
+            yield from format_lines("+", b[j1:j2])
@@ -17,24 +17,142 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+import array
 import binascii
+import bisect
+import collections
 import configparser
+import functools
+import io
 import mmap
+import os
 import pathlib
 import re
+import sqlite3
 import struct
+import sys
+import threading
+import time
+import types
 import zlib
 
+# Revision syntax we understand, a base name with ~N and ^N suffixes
+HEX_OID = re.compile(r"[0-9a-fA-F]{40}")
+HEX_PREFIX = re.compile(r"[0-9a-fA-F]{1,40}")
+REVISION = re.compile(r"([^~^]+)((?:[~^][0-9]*)*)")
+REVISION_SUFFIX = re.compile(r"([~^])([0-9]*)")
+
+class AmbiguousOidError(Exception):
+    """An abbreviated object ID matches more than one object"""
+
+    def __init__(self, prefix, candidates):
+        super().__init__(f"short object ID {prefix} is ambiguous")
+        self.prefix = prefix
+        self.candidates = candidates
+
+class MissingObjectError(LookupError):
+    """An object that has to exist (e.g. one a tree refers to) is missing"""
+
+    def __init__(self, oid):
+        super().__init__(f"object {oid} is missing")
+        self.oid = oid
+
 class Blob:
+    __slots__ = ("oid", "data", "size", "_text")
+
     def __init__(self, oid, data):
         self.oid = oid
         self.data = data
         self.size = len(data)
-        try:
-            self.text = data.decode("utf-8")
-            self.is_binary = False
-        except:
-            self.is_binary = True
+        # None until we tried decoding, False if the blob is binary
+        self._text = None
+
+    def _decode(self):
+        if self._text is None:
+            try:
+                self._text = self.data.decode("utf-8")
+            except UnicodeDecodeError:
+                self._text = False
+        return self._text
+
+    @property
+    def is_binary(self):
+        """Is this blob binary (as in not valid UTF-8)"""
+        return self._decode() is False
+
+    @property
+    def text(self):
+        """Contents of the blob decoded as UTF-8"""
+        text = self._decode()
+        if text is False:
+            raise AttributeError("binary blob has no text")
+        return text
+
+class BlobStream(io.RawIOBase):
+    """File-like reader of the contents of a blob, the data is inflated in
+    chunks as it is read, so the whole blob is never in memory at once
+    """
+
+    def __init__(self, size, chunks, file=None):
+        super().__init__()
+        # Size of the whole blob, known from the object header
+        self.size = size
+        self._chunks = chunks
+        self._file = file
+        self._buf = b""
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        """Make sure there is buffered data, returns False at the end"""
+        if self.closed:
+            raise ValueError("I/O operation on closed blob stream")
+        while self._pos == len(self._buf):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return False
+            self._buf = chunk
+            self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.readall()
+        if not self._fill() or size == 0:
+            return b""
+        data = self._buf[self._pos:self._pos+size]
+        self._pos += len(data)
+        return data
+
+    def readall(self):
+        parts = []
+        while self._fill():
+            parts.append(self._buf[self._pos:])
+            self._pos = len(self._buf)
+        return b"".join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def __iter__(self):
+        """Generate the contents in chunks, as they are inflated"""
+        while self._fill():
+            chunk = self._buf[self._pos:]
+            self._pos = len(self._buf)
+            yield chunk
+
+    def close(self):
+        if not self.closed:
+            # Stop the generator inflating the data, if there is one
+            if hasattr(self._chunks, "close"):
+                self._chunks.close()
+            if self._file is not None:
+                self._file.close()
+        super().close()
 
 S_IFMT = 0o170000
 S_IFDIR = 0o040000  # directory
@@ -43,10 +161,17 @@ S_IFLNK = 0o120000  # symbolic link
 S_IFMOD = 0o160000  # submodule
 
 class TreeEntry:
-    def __init__(self, name, mode, oid):
+    __slots__ = ("name", "mode", "raw_oid")
+
+    def __init__(self, name, mode, raw_oid):
         self.name = name
         self.mode = mode
-        self.oid = oid
+        self.raw_oid = raw_oid
+
+    @property
+    def oid(self):
+        """Hex object ID of the entry"""
+        return binascii.hexlify(self.raw_oid).decode()
 
     def isdir(self):
         """Is this entry a directory"""
@@ -67,26 +192,82 @@ class TreeEntry:
         return f"({self.name} {self.mode:o} {self.oid})"
 
 class Tree:
+    """Tree object, entries are parsed from the raw data on demand"""
+
+    __slots__ = ("oid", "_data", "_offsets")
+
     def __init__(self, oid, data):
         self.oid = oid
-        self._entries = {}
-
-        while len(data) > 0:
-            meta, rest = data.split(b"\x00", 1)
-            meta = meta.decode("utf-8", errors='ignore')
-            mode, name = meta.split(" ", 1)
-            self._entries[name] = \
-                TreeEntry(name, int(mode, 8), binascii.hexlify(rest[:20]).decode())
-            data = rest[20:]
+        self._data = data
+        # Offsets of the entries, only computed when looking up by name
+        self._offsets = None
+
+    def _entry_offsets(self):
+        if self._offsets is None:
+            data = self._data
+            offsets = array.array("I")
+            pos = 0
+            while pos < len(data):
+                offsets.append(pos)
+                pos = data.index(b"\x00", pos) + 21
+            self._offsets = offsets
+        return self._offsets
+
+    def _parse_entry(self, pos):
+        """Parse the entry at an offset, returns the raw name, the mode, and
+        the offset of the object ID
+        """
+        data = self._data
+        sep = data.index(b" ", pos)
+        end = data.index(b"\x00", sep)
+        return data[sep+1:end], int(data[pos:sep], 8), end + 1
+
+    def _sort_key(self, pos):
+        # Git sorts trees as if directory names had a trailing slash
+        name, mode, _ = self._parse_entry(pos)
+        if (mode & S_IFMT) == S_IFDIR:
+            return name + b"/"
+        return name
+
+    def _make_entry(self, pos):
+        name, mode, oid_pos = self._parse_entry(pos)
+        return TreeEntry(name.decode("utf-8", errors='ignore'), mode,
+                         self._data[oid_pos:oid_pos+20])
 
     def __getitem__(self, key):
-        return self._entries.get(key, None)
+        """Lookup an entry by name, using a binary search over the sorted
+        entries, only the entries probed during the search get parsed
+        """
+        name = key.encode("utf-8")
+        if b"/" in name:
+            return None
+        offsets = self._entry_offsets()
+        for probe in (name, name + b"/"):
+            lo = 0
+            hi = len(offsets)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._sort_key(offsets[mid]) < probe:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(offsets) and self._sort_key(offsets[lo]) == probe:
+                return self._make_entry(offsets[lo])
+        return None
 
     def __iter__(self):
-        return iter(self._entries.values())
+        data = self._data
+        pos = 0
+        while pos < len(data):
+            entry = self._make_entry(pos)
+            yield entry
+            pos = data.index(b"\x00", pos) + 21
+
+    def __len__(self):
+        return len(self._entry_offsets())
 
     def __repr__(self):
-        return f"Tree{repr(self._entries.values())}"
+        return f"Tree{repr(list(self))}"
 
 class CommitStamp:
     def __init__(self, val):
@@ -101,32 +282,62 @@ class CommitStamp:
         return f"{self.name} <{self.email}>"
 
 class Commit:
+    """Commit object, the tree and parents are parsed up front, the author,
+    committer and message only when accessed
+    """
+
+    __slots__ = ("oid", "tree", "parents", "_data", "_author", "_committer",
+                 "_message")
+
     def __init__(self, oid, data):
         self.oid = oid
-
-        data_str = data.decode("utf-8", errors='ignore')
-        lines = data_str.split("\n")
-        if lines[-1] == "":
-            lines.pop(-1)
+        self._data = data
+        self._author = None
+        self._committer = None
+        self._message = None
 
         # Create list for parent commits
         self.parents = []
 
-        # Parse metadata
-        for i, line in enumerate(lines):
-            if line == "":
-                self.message = "\n".join(lines[i+1:])
-                break
+        # Parse the metadata we always need
+        end = data.find(b"\n\n")
+        header = data if end < 0 else data[:end]
+        for line in header.split(b"\n"):
+            key, _, val = line.partition(b" ")
+            if key == b"tree":
+                self.tree = val.decode()
+            elif key == b"parent":
+                self.parents.append(val.decode())
+            elif key == b"author":
+                self._author = val
+            elif key == b"committer":
+                self._committer = val
 
-            key, val = line.split(" ", 1)
-            if key == "tree":
-                self.tree = val
-            elif key == "parent":
-                self.parents.append(val)
-            elif key == "author":
-                self.author = CommitStamp(val)
-            elif key == "committer":
-                self.committer = CommitStamp(val)
+    @property
+    def author(self):
+        if isinstance(self._author, bytes):
+            self._author = \
+                CommitStamp(self._author.decode("utf-8", errors='ignore'))
+        return self._author
+
+    @property
+    def committer(self):
+        if isinstance(self._committer, bytes):
+            self._committer = \
+                CommitStamp(self._committer.decode("utf-8", errors='ignore'))
+        return self._committer
+
+    @property
+    def message(self):
+        if self._message is None:
+            end = self._data.find(b"\n\n")
+            message = "" if end < 0 else \
+                self._data[end+2:].decode("utf-8", errors='ignore')
+            # Drop the newline terminating the object
+            if message.endswith("\n"):
+                message = message[:-1]
+            self._message = message
+        return self._message
 
     @property
     def short_oid(self):
@@ -136,16 +347,662 @@ class Commit:
     def subject(self):
         return self.message.split("\n", maxsplit=1)[0]
 
+    @property
+    def commit_time(self):
+        return self.committer.timestamp
+
     def __lt__(self, other):
-        return self.committer.timestamp < other.committer.timestamp
+        return self.commit_time < other.commit_time
 
     def __repr__(self):
         return f"{self.author} {self.subject}"
 
+class GraphCommit:
+    """Commit backed by the commit-graph, the parents, root tree, commit time
+    and generation number are available without reading the object itself,
+    anything else is loaded from the repository on first access
+    """
+
+    def __init__(self, repo, oid, tree, parents, commit_time, generation):
+        self._repo = repo
+        self._commit = None
+        self.oid = oid
+        self.tree = tree
+        self.parents = parents
+        self.commit_time = commit_time
+        self.generation = generation
+
+    def __getattr__(self, name):
+        # Only called for attributes not set in the constructor
+        if name.startswith("__") or name == "_commit":
+            raise AttributeError(name)
+        if self._commit is None:
+            self._commit = self._repo[self.oid]
+        return getattr(self._commit, name)
+
+    def __lt__(self, other):
+        return self.commit_time < other.commit_time
+
+    def __repr__(self):
+        return f"{self.author} {self.subject}"
+
+# Largest piece of compressed input handed to zlib at once
+INFLATE_CHUNK = 1 << 16
+
+def inflate(buf, pos, size):
+    """Inflate a zlib stream of known inflated size starting at pos in buf,
+    the compressed size is not stored anywhere, so the end of the stream is
+    found by zlib itself, returns the data and the offset after the stream
+    """
+    deflator = zlib.decompressobj()
+    chunks = []
+    with memoryview(buf) as view:
+        # Deflate never expands data by more than this (see compressBound in
+        # zlib), so small objects get inflated with a single call
+        step = min(size + (size >> 12) + (size >> 14) + 64, INFLATE_CHUNK)
+        end = len(view)
+        while not deflator.eof:
+            assert pos < end
+            chunk = view[pos:pos+step]
+            chunks.append(deflator.decompress(chunk))
+            pos += len(chunk)
+        # Whatever zlib didn't need was past the end of our stream
+        pos -= len(deflator.unused_data)
+    data = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+    assert len(data) == size
+    return data, pos
+
+def inflate_chunks(read, size, deflator=None, data=b""):
+    """Generate the inflated data of a zlib stream in pieces of at most
+    INFLATE_CHUNK bytes, read(n) is called for more compressed data, a
+    stream that was already started can be continued by passing its
+    deflator and the data it has produced so far
+    """
+    if deflator is None:
+        deflator = zlib.decompressobj()
+    total = len(data)
+    if len(data) > 0:
+        yield data
+    while not deflator.eof:
+        if deflator.unconsumed_tail:
+            data = deflator.decompress(deflator.unconsumed_tail,
+                                       INFLATE_CHUNK)
+        else:
+            chunk = read(INFLATE_CHUNK)
+            assert len(chunk) > 0
+            data = deflator.decompress(chunk, INFLATE_CHUNK)
+        if len(data) > 0:
+            total += len(data)
+            yield data
+    assert total == size
+
+def inflate_prefix(buf, pos, size):
+    """Inflate at most size bytes from the start of a zlib stream starting
+    at pos in buf, without inflating the rest of it
+    """
+    deflator = zlib.decompressobj()
+    data = b""
+    while len(data) < size and not deflator.eof:
+        # A block header alone can be a few hundred bytes, so this might
+        # take a few rounds
+        chunk = buf[pos:pos+256]
+        assert len(chunk) > 0
+        pos += len(chunk)
+        data += deflator.decompress(chunk, size - len(data))
+        while deflator.unconsumed_tail and len(data) < size:
+            data += deflator.decompress(deflator.unconsumed_tail,
+                                        size - len(data))
+    return data
+
+def decode_varint(data, idx):
+    """Decode a little-endian base 128 integer as used in delta headers,
+    returns the integer and the index after it
+    """
+    num = 0
+    shift = 0
+    while True:
+        b = data[idx]
+        idx += 1
+        num |= (b & 0x7f) << shift
+        shift += 7
+        if (b & 0x80) == 0:
+            return num, idx
+
+def apply_delta(base_data, delta_data):
+    """Apply a delta to the provided base data"""
+
+    # Read base length and verify it
+    base_len, idx = decode_varint(delta_data, 0)
+    assert base_len == len(base_data)
+
+    # Read expected result length
+    result_len, idx = decode_varint(delta_data, idx)
+
+    # The result is written in place into a BytesIO grown to its full size
+    # up front, all copies go through memoryviews so each byte is copied
+    # exactly once, and (in CPython) getvalue() hands out the buffer of a
+    # BytesIO written to exactly its size without copying it again, objects
+    # end up being shared through the caches, so they have to be immutable
+    result = io.BytesIO()
+    if result_len > 0:
+        result.seek(result_len - 1)
+        result.write(b"\0")
+        result.seek(0)
+    out = 0
+    base_view = memoryview(base_data)
+    delta_view = memoryview(delta_data)
+    delta_len = len(delta_data)
+
+    while idx < delta_len:
+        # Read opcode
+        op = delta_data[idx]
+        idx += 1
+        if op & 0x80 != 0:
+            # Copy from base object, the offset and size are stored as
+            # little-endian integers with only the bytes set in op present
+            offs = 0
+            for shift in (0, 8, 16, 24):
+                if op & (1 << (shift >> 3)):
+                    offs |= delta_data[idx] << shift
+                    idx += 1
+            size = 0
+            for shift in (0, 8, 16):
+                if op & (0x10 << (shift >> 3)):
+                    size |= delta_data[idx] << shift
+                    idx += 1
+            if size == 0:
+                # NOTE: this is a "lovely" undocumented special case I
+                # found out about after banging my head into the table
+                # for 5 hours, than finally deciding to read the sources
+                size = 0x10000
+            assert offs+size <= base_len
+            assert out+size <= result_len
+            result.write(base_view[offs:offs+size])
+            out += size
+        else:
+            # Add from delta data
+            assert op != 0
+            assert idx+op <= delta_len
+            assert out+op <= result_len
+            result.write(delta_view[idx:idx+op])
+            idx += op
+            out += op
+
+    # Verify result length, than return result
+    assert out == result_len
+    return result.getvalue()
+
+class OidTable:
+    """Sequence view of a sorted table of raw 20 byte object IDs, this is
+    what allows searching the index formats with the bisect module
+    """
+
+    def __init__(self, buf, base, count):
+        self.buf = buf
+        self.base = base
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        # Behave like a sequence, iterating or indexing from the end must
+        # not read past the table into the rest of the index
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError("object ID table index out of range")
+        off = self.base + idx * 20
+        return self.buf[off:off+20]
+
+    def __iter__(self):
+        for idx in range(self.count):
+            yield self[idx]
+
+def bsearch_oid(oids, fanout, oid_bytes):
+    """Find the index of a raw object ID in a sorted table using the
+    fan-out table to narrow down the search, or None if it's not present
+    """
+    first = oid_bytes[0]
+    lo = fanout[first - 1] if first > 0 else 0
+    hi = fanout[first]
+    idx = bisect.bisect_left(oids, oid_bytes, lo, hi)
+    if idx < hi and oids[idx] == oid_bytes:
+        return idx
+    return None
+
+class LRUCache:
+    """Least recently used cache, bounded by the total size of the cached
+    values, as reported by the caller when inserting them, it is safe to
+    share between threads
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def find(self, key):
+        """Lookup a cached value, or None, only hits are counted"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get(self, key):
+        """Lookup a cached value, or None on a miss"""
+        value = self.find(key)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+        return value
+
+    def put(self, key, value, size):
+        """Insert a value, evicting the least recently used entries until we
+        fit into the limit again
+        """
+        # Values larger than the whole cache are never worth caching
+        if size > self.limit:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.limit:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    @property
+    def stats(self):
+        """Counters for monitoring the effectiveness of the cache"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "size": self.size,
+                "limit": self.limit,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+class DeltaBaseCache(LRUCache):
+    """Cache of inflated (type, data) delta base objects, this is modeled
+    after git's own delta_base_cache
+    """
+
+    # Same default as git's core.deltaBaseCacheLimit
+    DEFAULT_LIMIT = 96 * 1024 * 1024
+
+    def __init__(self, limit=DEFAULT_LIMIT):
+        super().__init__(limit)
+
+class ObjectCache:
+    """Cache of parsed objects keyed by object ID, objects are immutable so
+    they can be handed out to any number of users, every object type has
+    its own LRU with a budget in bytes of raw object data
+    """
+
+    DEFAULT_LIMITS = {
+        "commit": 8 * 1024 * 1024,
+        "tree": 32 * 1024 * 1024,
+        "blob": 16 * 1024 * 1024,
+    }
+
+    def __init__(self, limits=None):
+        limits = dict(self.DEFAULT_LIMITS, **(limits or {}))
+        self._caches = { Commit: LRUCache(limits["commit"]),
+                         Tree: LRUCache(limits["tree"]),
+                         Blob: LRUCache(limits["blob"]) }
+        # Misses can't be attributed to a type, we only learn it by loading
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, oid):
+        """Lookup a parsed object, or None on a miss"""
+        for cache in self._caches.values():
+            obj = cache.find(oid)
+            if obj is not None:
+                return obj
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, obj):
+        """Insert a parsed object into the LRU of its type"""
+        cache = self._caches.get(type(obj))
+        if cache is None:
+            return
+        if isinstance(obj, Blob):
+            size = obj.size
+        else:
+            size = len(obj._data)
+        cache.put(obj.oid, obj, size)
+
+    def clear(self):
+        for cache in self._caches.values():
+            cache.clear()
+
+    @property
+    def stats(self):
+        """Counters for every object type, plus the total number of misses"""
+        stats = { obj_class.__name__.lower() : cache.stats
+                  for obj_class, cache in self._caches.items() }
+        for type_stats in stats.values():
+            del type_stats["misses"]
+        stats["misses"] = self.misses
+        return stats
+
+class MetadataCache:
+    """Persistent cache of metadata derived from objects, in an SQLite
+    database that any number of threads and processes can share, so that
+    freshly started workers don't have to recompute everything
+
+    Entries are keyed by the object IDs they were derived from (tree
+    comparisons, get_latest_change answers), as objects are immutable
+    entries never go stale, the same database can even be shared by
+    repositories with common history. The total size of the entries is
+    kept under the limit by evicting the least recently used ones, this
+    happens automatically as entries are added. Commits themselves are not
+    cached, reading one from a pack costs about as much as an SQLite lookup.
+    """
+
+    DEFAULT_LIMIT = 256 * 1024 * 1024
+    # Access times are only refreshed when they are older than this many
+    # seconds, so that hits rarely have to write to the database
+    ATIME_RESOLUTION = 3600
+    # Compaction shrinks the cache to this fraction of the limit
+    COMPACT_TARGET = 0.75
+
+    def __init__(self, path, limit=DEFAULT_LIMIT, timeout=30):
+        self.path = pathlib.Path(path)
+        self.limit = limit
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        # Bytes added since we last checked the size of the cache
+        self._added = 0
+        # One connection per thread and process, as (pid, connection) here
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                          kind TEXT NOT NULL,
+                          key TEXT NOT NULL,
+                          value BLOB NOT NULL,
+                          size INTEGER NOT NULL,
+                          atime INTEGER NOT NULL,
+                          PRIMARY KEY (kind, key)
+                      ) WITHOUT ROWID""")
+        db.execute("""CREATE INDEX IF NOT EXISTS entries_atime
+                      ON entries (atime)""")
+
+    def _db(self):
+        """Connection of the calling thread, connections can't be carried
+        over to a forked process, so those get a new one
+        """
+        pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn[0] != pid:
+            db = sqlite3.connect(self.path, timeout=self.timeout,
+                                 isolation_level=None,
+                                 check_same_thread=False)
+            db.execute("PRAGMA synchronous=NORMAL")
+            conn = self._local.conn = (pid, db)
+            with self._lock:
+                self._connections.append(conn)
+        return conn[1]
+
+    def get(self, kind, key):
+        """Lookup an entry, or None on a miss"""
+        try:
+            db = self._db()
+            row = db.execute("SELECT value, atime FROM entries "
+                             "WHERE kind = ? AND key = ?",
+                             (kind, key)).fetchone()
+            if row is not None:
+                now = int(time.time())
+                if row[1] < now - self.ATIME_RESOLUTION:
+                    db.execute("UPDATE entries SET atime = ? "
+                               "WHERE kind = ? AND key = ?", (now, kind, key))
+        except sqlite3.OperationalError:
+            # Locked for too long, the cache is not worth failing for
+            row = None
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if row is None else row[0]
+
+    def put(self, kind, key, value):
+        """Insert an entry, compacting the cache every time about a
+        sixteenth of the limit was added
+        """
+        size = len(key) + len(value)
+        if size > self.limit:
+            return
+        try:
+            self._db().execute("INSERT OR REPLACE INTO entries "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               (kind, key, value, size, int(time.time())))
+        except sqlite3.OperationalError:
+            return
+        with self._lock:
+            self._added += size
+            check = self._added > self.limit // 16
+            if check:
+                self._added = 0
+        if check:
+            self.compact()
+
+    def compact(self, vacuum=False):
+        """Evict the least recently used entries if the cache is over the
+        limit, vacuum also returns the freed space to the file system
+        """
+        try:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                total, = db.execute("SELECT COALESCE(SUM(size), 0) "
+                                    "FROM entries").fetchone()
+                if total > self.limit:
+                    excess = total - int(self.limit * self.COMPACT_TARGET)
+                    evicted = []
+                    for kind, key, size in db.execute(
+                            "SELECT kind, key, size FROM entries "
+                            "ORDER BY atime"):
+                        if excess <= 0:
+                            break
+                        evicted.append((kind, key))
+                        excess -= size
+                    db.executemany("DELETE FROM entries "
+                                   "WHERE kind = ? AND key = ?", evicted)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            if vacuum:
+                db.execute("VACUUM")
+                db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.OperationalError:
+            # Another process is busy with the database, it can wait
+            pass
+
+    def clear(self):
+        self._db().execute("DELETE FROM entries")
+
+    def close(self):
+        """Close the connections opened by this process"""
+        pid = os.getpid()
+        with self._lock:
+            for conn_pid, db in self._connections:
+                if conn_pid == pid:
+                    db.close()
+            self._connections = []
+        self._local = threading.local()
+
+    @property
+    def stats(self):
+        """Counters for monitoring the effectiveness of the cache"""
+        entries, size = self._db().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "size": size,
+                "limit": self.limit,
+            }
+
+def find_oid_range(oids, fanout, lo, hi):
+    """Generate the raw object IDs between lo and hi (inclusive) from a
+    sorted table, this is how abbreviated object IDs are looked up
+    """
+    start = fanout[lo[0] - 1] if lo[0] > 0 else 0
+    end = fanout[hi[0]]
+    idx = bisect.bisect_left(oids, lo, start, end)
+    while idx < end:
+        oid_bytes = oids[idx]
+        if oid_bytes > hi:
+            break
+        yield oid_bytes
+        idx += 1
+
+def read_chunk_table(buf, off, num_chunks):
+    """Read the chunk table of a chunked file format (multi-pack-index,
+    commit-graph), returns a dict of chunk IDs to (start, end) offsets
+    """
+    chunks = {}
+    # The table has a terminating entry, a chunk ends where the next starts
+    entries = [ struct.unpack(">4sQ", buf[off+i*12:off+i*12+12])
+                for i in range(num_chunks + 1) ]
+    for (chunk_id, start), (_, end) in zip(entries, entries[1:]):
+        chunks[chunk_id] = start, end
+    return chunks
+
+class Instrumentation:
+    """Collects counts and timings from the hot paths of Repository and
+    PackFile, when they are created with one, events are aggregated into
+    stats, and passed on to any subscribed callbacks
+
+    Events and their fields:
+     - lookup_packed, lookup_loose, lookup_missing: seconds
+     - index_search: seconds
+     - inflate: seconds, bytes (inflated)
+     - apply_delta: seconds, bytes (result)
+     - delta_chain: depth (number of deltas resolved for one object)
+     - parse_commit, parse_tree, parse_blob: seconds, bytes (raw data)
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """Call callback(event, fields) for every event, where fields is a
+        dict of the event's fields, this is called on the thread doing the
+        lookup, so it should be quick
+        """
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        self._callbacks.remove(callback)
+
+    def record(self, event, **fields):
+        """Record an event, every field is summed up, and its maximum kept"""
+        with self._lock:
+            stat = self._stats.get(event)
+            if stat is None:
+                stat = self._stats[event] = { "count" : 0 }
+            stat["count"] += 1
+            for name, value in fields.items():
+                stat[name] = stat.get(name, 0) + value
+                max_name = "max_" + name
+                if value > stat.get(max_name, value - 1):
+                    stat[max_name] = value
+        for callback in self._callbacks:
+            callback(event, fields)
+
+    @property
+    def stats(self):
+        """Snapshot of the aggregated events"""
+        with self._lock:
+            return { event : dict(stat) for event, stat in self._stats.items() }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+# Object type codes, as used in pack files
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+# Object type names, as used in loose object headers
+OBJ_NAMES = {
+    b"commit": OBJ_COMMIT,
+    b"tree": OBJ_TREE,
+    b"blob": OBJ_BLOB,
+    b"tag": OBJ_TAG,
+}
+OBJ_TYPE_NAMES = { obj_type : name.decode()
+                   for name, obj_type in OBJ_NAMES.items() }
+
+# Type and size of an object, the type is its name (e.g. "blob")
+ObjectInfo = collections.namedtuple("ObjectInfo", ("type", "size"))
+
+def make_object(oid, obj_type, obj_data, instrumentation=None):
+    """Construct an object of the right class from its raw data"""
+    if instrumentation is not None:
+        start = time.perf_counter()
+        obj = make_object(oid, obj_type, obj_data)
+        if obj is not None:
+            instrumentation.record("parse_" + type(obj).__name__.lower(),
+                                   seconds=time.perf_counter() - start,
+                                   bytes=len(obj_data))
+        return obj
+
+    if obj_type == OBJ_COMMIT:
+        return Commit(oid, obj_data)
+    elif obj_type == OBJ_TREE:
+        return Tree(oid, obj_data)
+    elif obj_type == OBJ_BLOB:
+        return Blob(oid, obj_data)
+    return None
+
 class PackFile:
-    def __init__(self, idxpath, packpath):
+    def __init__(self, idxpath, packpath, delta_base_cache=None,
+                 instrumentation=None):
         self.idxpath = pathlib.Path(idxpath)
         self.packpath = pathlib.Path(packpath)
+        # Delta bases are potentially shared with other packs of the repo
+        if delta_base_cache is None:
+            delta_base_cache = DeltaBaseCache()
+        self.delta_base_cache = delta_base_cache
+        self.instrumentation = instrumentation
 
         # Load pack index
         # Please note that for now we only support the v2 idx format
@@ -158,301 +1015,1119 @@ class PackFile:
             self.fanout = struct.unpack(">256I", idxfile.read(256 * 4))
             # Memory map index file
             self.idxmm = mmap.mmap(idxfile.fileno(), 0, access=mmap.ACCESS_READ)
+        # Sorted table of the raw object IDs in the pack
+        self.oids = OidTable(self.idxmm, 1032, self.fanout[-1])
 
-    def __del__(self):
-        self.idxmm.close()
+        # Memory map the pack itself, the mapping stays valid after the file
+        # is closed, so we don't keep a file descriptor around per pack
+        with self.packpath.open("rb") as packfile:
+            # Check magic number
+            assert packfile.read(4) == b"PACK"
+            self.packmm = mmap.mmap(packfile.fileno(), 0, access=mmap.ACCESS_READ)
 
-    def _get_offset(self, oid):
-        """Resolve an object ID into an offset into the file"""
-        oid_bytes = binascii.unhexlify(oid)
+        # Loaded on demand, only needed for reachability bitmaps
+        self._bitmap = False
+        self._pack_positions = None
 
-        # Find previous fanout entry
-        prev_cnt = self.fanout[oid_bytes[0] - 1] if oid_bytes[0] > 0 else 0
-        # Count of hashes starting with our first byte
-        cnt = self.fanout[oid_bytes[0]] - prev_cnt
-        if cnt == 0:
-            return None
+    def close(self):
+        """Unmap the index and pack files"""
+        self.idxmm.close()
+        self.packmm.close()
+        if self._bitmap:
+            self._bitmap.close()
 
-        # Binary search the index file for our hash
-        def hash_offs(idx):
-            return 1032 + (prev_cnt + idx) * 20
-
-        def entry_off(idx):
-            return 1032 + self.fanout[-1] * 24 + (prev_cnt + idx) * 4
-
-        def bigentry_off(idx):
-            return 1032 + self.fanout[-1] * 28 + idx * 8
-
-        def compare_hash(h1, h2):
-            i = 0
-            while i < 20:
-                if h1[i] < h2[i]:
-                    return -1
-                elif h1[i] > h2[i]:
-                    return 1
-                i += 1
-            return 0
-
-        def bsearch_hash():
-            left = 0
-            right = cnt - 1
-            while left <= right:
-                mid = (left + right) // 2
-                hoff = hash_offs(mid)
-                result = compare_hash(self.idxmm[hoff:hoff+20], oid_bytes)
-                if result < 0:
-                    left = mid + 1
-                elif result > 0:
-                    right = mid - 1
-                else:
-                    return mid
-            return None
+    def __del__(self):
+        # Might get here with a partially constructed object
+        if hasattr(self, "packmm"):
+            self.close()
 
-        # Find entry index
-        entry_idx = bsearch_hash()
-        if entry_idx is None:
-            return None
+    @property
+    def count(self):
+        """Number of objects in the pack"""
+        return self.fanout[-1]
 
-        # Get packfile offset for entry
-        eoff = entry_off(entry_idx)
+    @property
+    def bitmap(self):
+        """The pack's reachability bitmap index, or None"""
+        if self._bitmap is False:
+            bitmap_path = self.packpath.with_suffix(".bitmap")
+            self._bitmap = PackBitmap(bitmap_path, self) \
+                if bitmap_path.is_file() else None
+        return self._bitmap
+
+    @property
+    def pack_positions(self):
+        """Array mapping index entries to their position in pack order,
+        which is the order bits in reachability bitmaps are in
+        """
+        if self._pack_positions is not None:
+            return self._pack_positions
+
+        cnt = self.fanout[-1]
+        rev_path = self.packpath.with_suffix(".rev")
+        if rev_path.is_file():
+            # The reverse index stores the index entries in pack order
+            data = rev_path.read_bytes()
+            assert data[0:4] == b"RIDX"
+            order = array.array("I", data[12:12+cnt*4])
+            if sys.byteorder == "little":
+                order.byteswap()
+        else:
+            offsets = [ self._entry_offset(i) for i in range(cnt) ]
+            order = sorted(range(cnt), key=offsets.__getitem__)
+
+        positions = array.array("I", bytes(cnt * 4))
+        for pos, entry_idx in enumerate(order):
+            positions[entry_idx] = pos
+        self._pack_positions = positions
+        return positions
+
+    def _find_entry(self, oid_bytes):
+        """Find the index of a raw object ID in the pack index"""
+        return bsearch_oid(self.oids, self.fanout, oid_bytes)
+
+    def _entry_offset(self, entry_idx):
+        """Get the pack file offset of the object at an index entry"""
+        cnt = self.fanout[-1]
+        eoff = 1032 + cnt * 24 + entry_idx * 4
         off, = struct.unpack(">I", self.idxmm[eoff:eoff+4])
         if off > 0x7fffffff:
-            boff = bigentry_off(off & 0x7fffffff)
+            boff = 1032 + cnt * 28 + (off & 0x7fffffff) * 8
             off, = struct.unpack(">Q", self.idxmm[boff:boff+8])
-
         return off
 
-    def _get_object(self, oid, obj_offs=None):
-        """Read the raw underlying data of an object"""
+    def lookup(self, oid_bytes):
+        """Find the pack and offset of an object, or None, this is the same
+        interface as provided by the multi-pack indexes
+        """
+        entry_idx = self._find_entry(oid_bytes)
+        if entry_idx is None:
+            return None
+        return self, self._entry_offset(entry_idx)
+
+    def _get_offset(self, oid):
+        """Resolve an object ID into an offset into the file"""
+        entry_idx = self._find_entry(binascii.unhexlify(oid))
+        if entry_idx is None:
+            return None
+        return self._entry_offset(entry_idx)
+
+    def _get_base(self, obj_offs, depth):
+        """Read a delta base object, going through the delta base cache"""
+        key = (self.packpath, obj_offs)
+        base = self.delta_base_cache.get(key)
+        if base is None:
+            base = self._get_object(None, obj_offs=obj_offs, depth=depth)
+            self.delta_base_cache.put(key, base, len(base[1]))
+        elif self.instrumentation is not None:
+            # The chain ends at the cached base
+            self.instrumentation.record("delta_chain", depth=depth)
+        return base
+
+    def _inflate(self, pos, size):
+        """Inflate data from the pack, see inflate"""
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return inflate(self.packmm, pos, size)
+        start = time.perf_counter()
+        result = inflate(self.packmm, pos, size)
+        instrumentation.record("inflate", seconds=time.perf_counter() - start,
+                               bytes=size)
+        return result
+
+    def _apply_delta(self, base_data, delta_data):
+        """Apply a delta, see apply_delta"""
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return apply_delta(base_data, delta_data)
+        start = time.perf_counter()
+        result = apply_delta(base_data, delta_data)
+        instrumentation.record("apply_delta",
+                               seconds=time.perf_counter() - start,
+                               bytes=len(result))
+        return result
+
+    def _read_header(self, obj_offs):
+        """Decode the header of the object at an offset, returns its type,
+        its (for deltas the delta's) size, the offset of its compressed data
+        and, for deltas, the offset of the delta base
+        """
+        packmm = self.packmm
+
+        # Decode the variable length object header
+        pos = obj_offs
+        b = packmm[pos]
+        pos += 1
+        obj_type = (b & 0x70) >> 4
+        obj_size = b & 0xf
+        shift = 4
+        while b & 0x80:
+            b = packmm[pos]
+            pos += 1
+            obj_size |= (b & 0x7f) << shift
+            shift += 7
+
+        base_offs = None
+        if obj_type == OBJ_OFS_DELTA:
+            # Read negative object offset
+            # NOTE: this is encoded in a completely unspecified way, that
+            # all blogposts get wrong, and the git documentation doesn't
+            # mention at all, the real decoding algorithm can be found in
+            # "builtin/index-pack.c" in the git source tree
+            b = packmm[pos]
+            pos += 1
+            offset = b & 0x7f
+            while (b & 0x80) != 0:
+                offset += 1
+                b = packmm[pos]
+                pos += 1
+                offset <<= 7
+                offset |= b & 0x7f
+            base_offs = obj_offs - offset
+        elif obj_type == OBJ_REF_DELTA:
+            entry_idx = self._find_entry(packmm[pos:pos+20])
+            pos += 20
+            assert entry_idx is not None
+            base_offs = self._entry_offset(entry_idx)
+
+        return obj_type, obj_size, pos, base_offs
+
+    def _get_object(self, oid, obj_offs=None, depth=0):
+        """Read the raw underlying data of an object, depth is the number of
+        deltas depending on this object in the chain being resolved
+        """
         if obj_offs is None:
             obj_offs = self._get_offset(oid)
             if obj_offs is None:
                 return None
 
-        def decode_obj_header(packfile):
-            """Decode the variable length object header"""
-            b = packfile.read(1)[0]
-            obj_type = (b & 0x70) >> 4
-            obj_size = b & 0xf
-            shift = 4
-            while b & 0x80:
-                b = packfile.read(1)[0]
-                obj_size |= (b & 0x7f) << shift
-                shift += 7
+        obj_type, obj_size, pos, base_offs = self._read_header(obj_offs)
+
+        # De-deltify object if needed
+        if base_offs is not None:
+            # Read base object
+            base_type, base_data = self._get_base(base_offs, depth + 1)
+            # Apply deltas
+            obj_type = base_type
+            delta_data, _ = self._inflate(pos, obj_size)
+            assert obj_size == len(delta_data)
+            obj_data = self._apply_delta(base_data, delta_data)
+        else:
+            # Just simple compressed data
+            obj_data, _ = self._inflate(pos, obj_size)
+            assert obj_size == len(obj_data)
+            if depth > 0 and self.instrumentation is not None:
+                self.instrumentation.record("delta_chain", depth=depth)
+
+        return obj_type, obj_data
+
+    def _object_info(self, obj_offs):
+        """Type and size of the object at an offset, only object and delta
+        headers are inflated, see Repository.object_info
+        """
+        obj_type, obj_size, pos, base_offs = self._read_header(obj_offs)
+        if base_offs is None:
             return obj_type, obj_size
 
-        def decompress_stream(stream):
-            """Decompress zlib data from a stream without knowing the
-            compressed size of said data
-            """
-            CHUNK_SIZE = 1024
-            deflator = zlib.decompressobj()
-            defl_data = b""
-            while True:
-                chunk = stream.read(CHUNK_SIZE)
-                if chunk is None:
-                    break
-
-                # This is ugly, but as soon as we hit invalid data we break,
-                # this is the only way to decompress data without knowing its
-                # length using python's zlib library
-                try:
-                    defl_data += deflator.decompress(chunk)
-                    defl_data += deflator.flush()
-                except:
-                    break
-            return defl_data
-
-        def apply_delta(base_data, delta_data):
-            """Apply a delta to the provided base data
-            """
-
-            # Current index into the delta buffer
-            idx = 0
-
-            def decode_varint():
-                """Decode a variable length integer
-                """
-                nonlocal delta_data
-                nonlocal idx
-                num = 0
-                shift = 0
-                while True:
-                    b = delta_data[idx]
-                    idx += 1
-                    num |= (b & 0x7f) << shift
-                    shift += 7
-                    if (b & 0x80) == 0:
-                        break
-                return num
-
-
-            # Read base length and verify it
-            base_len = decode_varint()
-            assert base_len == len(base_data)
-
-            # Read expected result length
-            result_len = decode_varint()
-
-            def decode_copy_delta(mask):
-                """Decode a copy delta operand based on the provided mask
-                """
-                nonlocal delta_data
-                nonlocal idx
-                bit = 1
-                num = 0
-                shift = 0
-                while bit <= mask:
-                    if (mask & bit) != 0:
-                        num |= delta_data[idx] << shift
-                        idx += 1
-                    shift += 8
-                    bit <<= 1
-                return num
-
-            result = b""
-            while idx < len(delta_data):
-                # Read opcode
-                op = delta_data[idx]
-                idx += 1
-                if op & 0x80 != 0:
-                    # Copy from base object
-                    offs = decode_copy_delta(op & 0xf)
-                    size = decode_copy_delta((op & 0x70) >> 4)
-                    assert offs < len(base_data)
-                    assert offs+size <= len(base_data)
-                    if size == 0:
-                        # NOTE: this is a "lovely" undocumented special case I
-                        # found out about after banging my head into the table
-                        # for 5 hours, than finally deciding to read the sources
-                        size = 0x10000;
-                    result += base_data[offs:offs+size]
-                else:
-                    # Add from delta data
-                    assert op != 0
-                    assert idx < len(delta_data)
-                    assert idx+op <= len(delta_data)
-                    result += delta_data[idx:idx+op]
-                    idx += op
-
-            # Verify result length, than return result
-            assert result_len == len(result)
-            return result
-
-        with self.packpath.open("rb") as packfile:
-            packfile.seek(obj_offs)
-            obj_type, obj_size = decode_obj_header(packfile)
-
-            # De-deltify object if needed
-            if obj_type == 6:
-                # Read negative object offset
-                # NOTE: this is encoded in a completely unspecified way, that
-                # all blogposts get wrong, and the git documentation doesn't
-                # mention at all, the real decoding algorithm can be found in
-                # "builtin/index-pack.c" in the git source tree
-                b = packfile.read(1)[0]
-                offset = b & 0x7f
-                while (b & 0x80) != 0:
-                    offset += 1
-                    b = packfile.read(1)[0]
-                    offset <<= 7
-                    offset |= b & 0x7f
-                # Read base object
-                base_type, base_data = \
-                    self._get_object(None, obj_offs=obj_offs-offset)
-                # Apply deltas
-                obj_type = base_type
-                delta_data = decompress_stream(packfile)
-                assert obj_size == len(delta_data)
-                obj_data = apply_delta(base_data, delta_data)
-            elif obj_type == 7:
-                # Read base object
-                base_oid = binascii.hexlify(packfile.read(20)).decode()
-                base_type, base_data = self._get_object(base_oid)
-                # Apply deltas
-                obj_type = base_type
-                delta_data = decompress_stream(packfile)
-                assert obj_size == len(delta_data)
-                obj_data = apply_delta(base_data, delta_data)
-            else:
-                # Just simple compressed data
-                obj_data = decompress_stream(packfile)
-                assert obj_size == len(obj_data)
-
-            return obj_type, obj_data
+        # The size of the result is the second varint of the delta
+        delta_hdr = inflate_prefix(self.packmm, pos, 20)
+        _, idx = decode_varint(delta_hdr, 0)
+        obj_size, _ = decode_varint(delta_hdr, idx)
+
+        # Deltas always have the type of their base, so follow the chain
+        while base_offs is not None:
+            base = self.delta_base_cache.get((self.packpath, base_offs))
+            if base is not None:
+                return base[0], obj_size
+            obj_type, _, _, base_offs = self._read_header(base_offs)
+        return obj_type, obj_size
+
+    def _open_object(self, obj_offs):
+        """Open the object at an offset for streaming, returns its type and
+        a BlobStream, deltified objects have to be resolved in memory
+        """
+        obj_type, obj_size, pos, base_offs = self._read_header(obj_offs)
+        if base_offs is not None:
+            obj_type, obj_data = self._get_object(None, obj_offs=obj_offs)
+            return obj_type, BlobStream(len(obj_data), iter((obj_data,)))
+
+        packmm = self.packmm
+        def read(n):
+            nonlocal pos
+            # NOTE: slicing copies, but a memoryview would keep the pack
+            # from being closed while the stream is open
+            chunk = packmm[pos:pos+n]
+            pos += len(chunk)
+            return chunk
+
+        return obj_type, BlobStream(obj_size, inflate_chunks(read, obj_size))
 
     def __getitem__(self, oid):
         """Read an object from the pack file"""
         obj = self._get_object(oid)
         if obj is None:
             return None
-        obj_type, obj_data = obj
+        return make_object(oid, *obj, self.instrumentation)
+
+def ewah_decode(buf, off):
+    """Decode an EWAH compressed bitmap (as used by git's bitmap indexes)
+    into a Python integer with bit i set for position i, returns the
+    integer and the offset after the bitmap
+    """
+    _, word_cnt = struct.unpack(">II", buf[off:off+8])
+    words = array.array("Q", buf[off+8:off+8+word_cnt*8])
+    if sys.byteorder == "little":
+        words.byteswap()
+
+    # Expand run length words into their literal equivalent
+    out = array.array("Q")
+    idx = 0
+    while idx < word_cnt:
+        rlw = words[idx]
+        idx += 1
+        run_bit = rlw & 1
+        run_len = (rlw >> 1) & 0xffffffff
+        lit_cnt = rlw >> 33
+        if run_len:
+            out.extend([0xffffffffffffffff if run_bit else 0] * run_len)
+        out.extend(words[idx:idx+lit_cnt])
+        idx += lit_cnt
+
+    # Words are in native byte order, with the lowest bit coming first
+    return int.from_bytes(out.tobytes(), sys.byteorder), \
+        off + 8 + word_cnt * 8 + 4
+
+class PackBitmap:
+    """Reader for a pack's reachability bitmap index (.bitmap), bitmaps are
+    Python integers with a bit set for the pack position of every object
+    reachable from a commit
+    """
+
+    def __init__(self, path, pack):
+        self.path = pathlib.Path(path)
+        self.pack = pack
+
+        with self.path.open("rb") as bitmapfile:
+            self.mm = mmap.mmap(bitmapfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Parse header, we only support version 1
+        assert self.mm[0:4] == b"BITM"
+        version, flags, entry_cnt = struct.unpack(">HHI", self.mm[4:12])
+        assert version == 1
+
+        # Objects of each type
+        off = 32
+        self.commits, off = ewah_decode(self.mm, off)
+        self.trees, off = ewah_decode(self.mm, off)
+        self.blobs, off = ewah_decode(self.mm, off)
+        self.tags, off = ewah_decode(self.mm, off)
+
+        # Bitmapped commits, their bitmaps are decoded on demand, every entry
+        # may be XOR-ed against a previous one
+        self._entries = []
+        self._by_entry_idx = {}
+        for i in range(entry_cnt):
+            entry_idx, xor_off, _ = struct.unpack(">IBB", self.mm[off:off+6])
+            self._entries.append((off + 6, xor_off))
+            self._by_entry_idx[entry_idx] = i
+            _, word_cnt = struct.unpack(">II", self.mm[off+6:off+14])
+            off += 6 + 8 + word_cnt * 8 + 4
+        self._decoded = {}
+
+    def close(self):
+        self.mm.close()
+
+    def __del__(self):
+        if hasattr(self, "mm"):
+            self.close()
+
+    def _decode_entry(self, i):
+        # Find the entries along the XOR chain we haven't decoded yet
+        chain = []
+        bitmap = 0
+        while True:
+            decoded = self._decoded.get(i)
+            if decoded is not None:
+                bitmap = decoded
+                break
+            chain.append(i)
+            off, xor_off = self._entries[i]
+            if xor_off == 0:
+                break
+            i -= xor_off
+        # Then apply them starting from the oldest
+        for i in reversed(chain):
+            off, _ = self._entries[i]
+            bitmap ^= ewah_decode(self.mm, off)[0]
+            self._decoded[i] = bitmap
+        return bitmap
+
+    def position(self, oid_bytes):
+        """Bit position of an object in this pack, or None"""
+        entry_idx = self.pack._find_entry(oid_bytes)
+        if entry_idx is None:
+            return None
+        return self.pack.pack_positions[entry_idx]
+
+    def get(self, oid_bytes):
+        """Reachability bitmap of a commit, or None if it has none"""
+        entry_idx = self.pack._find_entry(oid_bytes)
+        if entry_idx is None:
+            return None
+        i = self._by_entry_idx.get(entry_idx)
+        if i is None:
+            return None
+        return self._decode_entry(i)
+
+class MultiPackIndex:
+    """Reader for git's multi-pack-index, which indexes the objects of
+    many packs in one sorted table
+    """
+
+    def __init__(self, path, packs):
+        self.path = pathlib.Path(path)
+
+        with self.path.open("rb") as midxfile:
+            self.mm = mmap.mmap(midxfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Parse header, we only support version 1 with SHA-1 object IDs
+        assert self.mm[0:4] == b"MIDX"
+        version, oid_version, num_chunks, num_base, num_packs = \
+            struct.unpack(">BBBBI", self.mm[4:12])
+        assert version == 1 and oid_version == 1 and num_base == 0
+
+        chunks = read_chunk_table(self.mm, 12, num_chunks)
+        self.chunks = chunks
+
+        # Map pack-int-ids to our pack objects, packs that went away since
+        # the multi-pack-index was written are mapped to None
+        pnam, _ = chunks[b"PNAM"]
+        names = []
+        pos = pnam
+        for _ in range(num_packs):
+            end = self.mm.find(b"\x00", pos)
+            names.append(self.mm[pos:end].decode())
+            pos = end + 1
+        by_name = { pack.idxpath.name : pack for pack in packs }
+        self.packs = [ by_name.get(name) for name in names ]
+
+        oidf, _ = chunks[b"OIDF"]
+        self.fanout = struct.unpack(">256I", self.mm[oidf:oidf+256*4])
+        self.oids = OidTable(self.mm, chunks[b"OIDL"][0], self.fanout[-1])
+        self.ooff, _ = chunks[b"OOFF"]
+        self.loff, _ = chunks.get(b"LOFF", (None, None))
+
+    def close(self):
+        self.mm.close()
+
+    def __del__(self):
+        if hasattr(self, "mm"):
+            self.close()
 
-        if obj_type == 1:
-            return Commit(oid, obj_data)
-        elif obj_type == 2:
-            return Tree(oid, obj_data)
-        elif obj_type == 3:
-            return Blob(oid, obj_data)
+    @property
+    def covered(self):
+        """Packs indexed by the multi-pack-index"""
+        return [ pack for pack in self.packs if pack is not None ]
 
+    def lookup(self, oid_bytes):
+        """Find the pack and offset of an object, or None"""
+        entry_idx = bsearch_oid(self.oids, self.fanout, oid_bytes)
+        if entry_idx is None:
+            return None
+        eoff = self.ooff + entry_idx * 8
+        pack_id, off = struct.unpack(">II", self.mm[eoff:eoff+8])
+        if off & 0x80000000:
+            boff = self.loff + (off & 0x7fffffff) * 8
+            off, = struct.unpack(">Q", self.mm[boff:boff+8])
+        pack = self.packs[pack_id]
+        if pack is None:
+            return None
+        return pack, off
+
+class MergedPackIndex:
+    """In-memory equivalent of a multi-pack-index, merged from the index
+    files of a list of packs, so an object lookup is a single search no
+    matter how many packs a repository has
+    """
+
+    def __init__(self, packs):
+        self.packs = packs
+
+        # Collect all entries and sort them, duplicates are resolved in favor
+        # of the first pack containing the object
+        entries = []
+        for pack_no, pack in enumerate(packs):
+            oids = pack.oids
+            entries.extend((oids[i], pack_no, i) for i in range(len(oids)))
+        entries.sort()
+
+        oids = bytearray()
+        self.pack_nos = array.array("I")
+        self.entry_idxs = array.array("I")
+        fanout = [0] * 256
+        prev = None
+        for oid, pack_no, entry_idx in entries:
+            if oid == prev:
+                continue
+            prev = oid
+            oids += oid
+            self.pack_nos.append(pack_no)
+            self.entry_idxs.append(entry_idx)
+            fanout[oid[0]] += 1
+        # Make the fan-out table cumulative, like in the on-disk formats
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+        self.fanout = fanout
+        self.oids = OidTable(bytes(oids), 0, len(self.pack_nos))
+
+    def lookup(self, oid_bytes):
+        """Find the pack and offset of an object, or None"""
+        entry_idx = bsearch_oid(self.oids, self.fanout, oid_bytes)
+        if entry_idx is None:
+            return None
+        pack = self.packs[self.pack_nos[entry_idx]]
+        return pack, pack._entry_offset(self.entry_idxs[entry_idx])
+
+def murmur3(data, seed, signed=False):
+    """32-bit MurmurHash3 of bytes, with signed the bytes are sign extended
+    first, like version 1 changed-path Bloom filters (mistakenly) do
+    """
+    def byte(b):
+        return b | 0xffffff00 if signed and b >= 0x80 else b
+
+    def rotl(x, r):
+        return ((x << r) | (x >> (32 - r))) & 0xffffffff
+
+    c1 = 0xcc9e2d51
+    c2 = 0x1b873593
+    h = seed
+    nblocks = len(data) // 4
+    for i in range(0, nblocks * 4, 4):
+        k = (byte(data[i]) | (byte(data[i+1]) << 8) |
+             (byte(data[i+2]) << 16) | (byte(data[i+3]) << 24)) & 0xffffffff
+        k = rotl((k * c1) & 0xffffffff, 15)
+        h ^= (k * c2) & 0xffffffff
+        h = (rotl(h, 13) * 5 + 0xe6546b64) & 0xffffffff
+
+    tail = data[nblocks*4:]
+    k = 0
+    if len(tail) == 3:
+        k ^= byte(tail[2]) << 16
+    if len(tail) >= 2:
+        k ^= byte(tail[1]) << 8
+    if len(tail) >= 1:
+        k ^= byte(tail[0])
+        k = rotl((k & 0xffffffff) * c1 & 0xffffffff, 15)
+        h ^= (k * c2) & 0xffffffff
+
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+class BloomFilter:
+    """Changed-path Bloom filter of a commit from the commit-graph, paths
+    (and their leading directories) changed compared to the first parent
+    are in the filter
+    """
+
+    __slots__ = ("data", "num_hashes", "version")
+
+    SEED1 = 0x293ae76f
+    SEED2 = 0x7e646e2c
+
+    def __init__(self, data, num_hashes, version):
+        self.data = data
+        self.num_hashes = num_hashes
+        self.version = version
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _hashes(path, version):
+        key = path.encode()
+        return murmur3(key, BloomFilter.SEED1, version == 1), \
+            murmur3(key, BloomFilter.SEED2, version == 1)
+
+    def might_contain(self, path):
+        """Was a path possibly changed, False means definitely not"""
+        hash1, hash2 = self._hashes(path, self.version)
+        data = self.data
+        num_bits = len(data) * 8
+        for i in range(self.num_hashes):
+            bit = ((hash1 + i * hash2) & 0xffffffff) % num_bits
+            if not data[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+class CommitGraph:
+    """Reader for one layer of git's commit-graph, layers of a split
+    commit-graph chain are linked through base
+    """
+
+    # Parent position meaning "no parent"
+    PARENT_NONE = 0x70000000
+
+    def __init__(self, path, base=None):
+        self.path = pathlib.Path(path)
+        self.base = base
+
+        with self.path.open("rb") as graphfile:
+            self.mm = mmap.mmap(graphfile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Parse header, we only support version 1 with SHA-1 object IDs
+        assert self.mm[0:4] == b"CGPH"
+        version, oid_version, num_chunks, num_base = \
+            struct.unpack(">BBBB", self.mm[4:8])
+        assert version == 1 and oid_version == 1
+        assert num_base == (0 if base is None else base.num_layers)
+
+        chunks = read_chunk_table(self.mm, 8, num_chunks)
+        self.chunks = chunks
+
+        oidf, _ = chunks[b"OIDF"]
+        self.fanout = struct.unpack(">256I", self.mm[oidf:oidf+256*4])
+        self.oids = OidTable(self.mm, chunks[b"OIDL"][0], self.fanout[-1])
+        self.cdat, _ = chunks[b"CDAT"]
+        self.edge, _ = chunks.get(b"EDGE", (None, None))
+
+        # Changed-path Bloom filters are optional
+        self.bidx, _ = chunks.get(b"BIDX", (None, None))
+        bdat, _ = chunks.get(b"BDAT", (None, None))
+        if self.bidx is not None and bdat is not None:
+            self.bloom_version, self.bloom_hashes, _ = \
+                struct.unpack(">III", self.mm[bdat:bdat+12])
+            self.bdat = bdat + 12
+        else:
+            self.bdat = None
+
+        # Commits are numbered globally across the layers of a chain, with
+        # the commits of the base layers first
+        self.num_layers = 1 if base is None else base.num_layers + 1
+        self.base_count = 0 if base is None else base.count
+        self.count = self.base_count + self.fanout[-1]
+
+    @classmethod
+    def load(cls, objdir):
+        """Load the commit-graph of an object directory, or its split
+        commit-graph chain, returns None if the repository has neither
+        """
+        infodir = pathlib.Path(objdir) / "info"
+        if (infodir / "commit-graph").is_file():
+            return cls(infodir / "commit-graph")
+        chain_path = infodir / "commit-graphs" / "commit-graph-chain"
+        if not chain_path.is_file():
+            return None
+        graph = None
+        for graph_hash in chain_path.read_text().split():
+            graph = cls(infodir / "commit-graphs" / f"graph-{graph_hash}.graph",
+                        graph)
+        return graph
+
+    def close(self):
+        self.mm.close()
+        if self.base is not None:
+            self.base.close()
+
+    def __del__(self):
+        if hasattr(self, "mm"):
+            self.mm.close()
+
+    def find(self, oid_bytes):
+        """Find the global position of a raw commit ID, or None"""
+        idx = bsearch_oid(self.oids, self.fanout, oid_bytes)
+        if idx is not None:
+            return self.base_count + idx
+        if self.base is not None:
+            return self.base.find(oid_bytes)
         return None
 
+    def _layer(self, pos):
+        """Find the layer containing a global position"""
+        layer = self
+        while pos < layer.base_count:
+            layer = layer.base
+        return layer
+
+    def oid_at(self, pos):
+        """Raw commit ID at a global position"""
+        layer = self._layer(pos)
+        return layer.oids[pos - layer.base_count]
+
+    def entry(self, pos):
+        """Read the commit data at a global position, returns the raw root
+        tree ID, the list of parent positions, the generation number
+        (topological level) and the commit time
+        """
+        layer = self._layer(pos)
+        mm = layer.mm
+        off = layer.cdat + (pos - layer.base_count) * 36
+        tree = mm[off:off+20]
+        parent1, parent2, gen_hi, time_lo = \
+            struct.unpack(">IIII", mm[off+20:off+36])
+
+        parents = []
+        if parent1 != self.PARENT_NONE:
+            parents.append(parent1)
+        if parent2 & 0x80000000:
+            # Octopus merge, the rest of the parents are in the edge list,
+            # with the last one having its most significant bit set
+            eoff = layer.edge + (parent2 & 0x7fffffff) * 4
+            while True:
+                parent, = struct.unpack(">I", mm[eoff:eoff+4])
+                parents.append(parent & 0x7fffffff)
+                if parent & 0x80000000:
+                    break
+                eoff += 4
+        elif parent2 != self.PARENT_NONE:
+            parents.append(parent2)
+
+        generation = gen_hi >> 2
+        commit_time = ((gen_hi & 0x3) << 32) | time_lo
+        return tree, parents, generation, commit_time
+
+    def changed_paths(self, pos):
+        """Changed-path Bloom filter of the commit at a global position, it
+        has the paths changed compared to the first parent, returns None if
+        the commit has no filter
+        """
+        layer = self._layer(pos)
+        if layer.bdat is None or layer.bloom_version not in (1, 2):
+            return None
+        mm = layer.mm
+        off = layer.bidx + (pos - layer.base_count) * 4
+        end, = struct.unpack(">I", mm[off:off+4])
+        start = 0
+        if pos > layer.base_count:
+            start, = struct.unpack(">I", mm[off-4:off])
+        if start == end:
+            # The filter was not computed
+            return None
+        return BloomFilter(mm[layer.bdat+start:layer.bdat+end],
+                           layer.bloom_hashes, layer.bloom_version)
+
+    def get(self, repo, oid):
+        """Get a GraphCommit for a commit ID, or None if it's not covered"""
+        pos = self.find(binascii.unhexlify(oid))
+        if pos is None:
+            return None
+        tree, parents, generation, commit_time = self.entry(pos)
+        return GraphCommit(repo, oid, binascii.hexlify(tree).decode(),
+                           [ binascii.hexlify(self.oid_at(parent)).decode()
+                             for parent in parents ],
+                           commit_time, generation)
+
+def stat_key(path):
+    """Stat information that changes whenever a file is rewritten or
+    replaced, or None if the file doesn't exist
+    """
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+class RefDatabase:
+    """References of a repository, packed-refs and the loose refs under
+    refs/heads and refs/tags (nested ones included) are read once and kept
+    in memory
+
+    Each access revalidates what it needs, packed-refs and the loose ref
+    directories of the namespace asked for, by comparing their stat
+    information, at most once per access and once every check_interval
+    seconds, looking up single refs reads just their file unless the
+    namespace was checked recently. git updates refs by renaming a new file
+    into place, which changes the directory, updates are missed if a ref
+    file is rewritten in place, or if the directory changes again within
+    the timestamp granularity of the filesystem without its size changing
+    """
+
+    NAMESPACES = ("refs/heads", "refs/tags")
+
+    # Symbolic refs pointing to symbolic refs are followed this deep
+    MAX_SYMREF_DEPTH = 5
+
+    # Seconds changes on disk may go unnoticed for
+    DEFAULT_CHECK_INTERVAL = 0.05
+
+    def __init__(self, path, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # When packed-refs (None) and each namespace were last checked
+        self._checked = {}
+        # packed-refs contents
+        self._packed_key = None
+        self._packed = {}
+        self._packed_peeled = types.MappingProxyType({})
+        # Loose ref directories of each namespace,
+        # name -> (stat key, refs, subdirectories)
+        self._dirs = { name : {} for name in self.NAMESPACES }
+        # Loose refs of each namespace
+        self._loose = { name : {} for name in self.NAMESPACES }
+        # HEAD contents
+        self._head_key = None
+        self._head = None
+        # Short name -> object ID views of the namespaces, built on demand
+        self._views = {}
+
+    def _read_packed_refs(self):
+        """Parse packed-refs, returns the refs and the peeled object IDs of
+        annotated tags keyed by the tag object ID
+        """
+        packed, peeled = {}, {}
+        packed_refs_path = self.path / "packed-refs"
+        if not packed_refs_path.exists():
+            return packed, peeled
+
+        last_oid = None
+        for line in packed_refs_path.read_text().split("\n"):
+            # Skip empty lines and comments
+            if line == "" or line[0] == "#":
+                continue
+            # Peel lines apply to the ref right before them
+            if line[0] == "^":
+                assert last_oid is not None
+                peeled[last_oid] = line[1:].strip()
+                continue
+            last_oid, key = line.split(" ", 1)
+            packed[key] = last_oid
+        return packed, peeled
+
+    def _scan_dir(self, name, cached, dirs):
+        """Collect the loose refs of a directory into dirs, re-reading only
+        the directories that changed since they were cached, returns if
+        anything changed
+        """
+        key = stat_key(self.path / name)
+        if key is None:
+            return False
+
+        changed = False
+        entry = cached.get(name)
+        if entry is not None and entry[0] == key:
+            _, refs, subdirs = entry
+        else:
+            refs, subdirs = {}, []
+            for entry in (self.path / name).iterdir():
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif not entry.name.endswith(".lock"):
+                    try:
+                        refs[name + "/" + entry.name] = \
+                            entry.read_text().strip()
+                    except FileNotFoundError:
+                        # Deleted while we were listing the directory
+                        pass
+            changed = True
+
+        dirs[name] = (key, refs, subdirs)
+        for subdir in subdirs:
+            changed |= self._scan_dir(name + "/" + subdir, cached, dirs)
+        return changed
+
+    def _fresh(self, what, now):
+        """Was packed-refs (None) or a namespace checked in the access that
+        started at now, or less than check_interval before it
+        """
+        last = self._checked.get(what)
+        return last is not None and (last == now or
+                                     now - last < self.check_interval)
+
+    def _due(self, what, now):
+        """Should packed-refs (None) or a namespace be checked now, if so
+        it is marked as checked
+        """
+        if self._fresh(what, now):
+            return False
+        self._checked[what] = now
+        return True
+
+    def _refresh_packed(self, now):
+        if not self._due(None, now):
+            return
+        key = stat_key(self.path / "packed-refs")
+        if key != self._packed_key:
+            packed, peeled = self._read_packed_refs()
+            self._packed = packed
+            self._packed_peeled = types.MappingProxyType(peeled)
+            self._packed_key = key
+            self._views.clear()
+
+    def _refresh_namespace(self, namespace, now):
+        if not self._due(namespace, now):
+            return
+        cached = self._dirs[namespace]
+        dirs = {}
+        changed = self._scan_dir(namespace, cached, dirs)
+        # Catch deleted directories
+        changed |= dirs.keys() != cached.keys()
+        self._dirs[namespace] = dirs
+        if changed:
+            loose = {}
+            for _, refs, _ in dirs.values():
+                loose.update(refs)
+            self._loose[namespace] = loose
+            # Symbolic refs can point across namespaces, rebuild everything
+            self._views.clear()
+
+    def _read_loose(self, name):
+        """Read a single loose ref file, or None"""
+        if ".." in name.split("/"):
+            return None
+        try:
+            return (self.path / name).read_text().strip()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return None
+
+    def _read_ref(self, name, now):
+        """Value of a ref, an object ID or a symbolic ref, or None, loose
+        refs come from the namespace's cached contents if they were checked
+        recently, otherwise just the one file is read
+        """
+        for namespace in self.NAMESPACES:
+            if name.startswith(namespace + "/"):
+                if self._fresh(namespace, now):
+                    val = self._loose[namespace].get(name)
+                else:
+                    val = self._read_loose(name)
+                # NOTE: packed refs do *not* take precedence over unpacked
+                # ones
+                if val is not None:
+                    return val
+                break
+        return self._packed.get(name)
+
+    def _resolve(self, name, now):
+        """Object ID a ref points to, following symbolic refs, or None"""
+        val = self._read_ref(name, now)
+        depth = 0
+        while val is not None and val.startswith("ref:") \
+                and depth < self.MAX_SYMREF_DEPTH:
+            val = self._read_ref(val[4:].strip(), now)
+            depth += 1
+        if val is not None and val.startswith("ref:"):
+            return None
+        return val
+
+    def _view(self, namespace):
+        """Read-only mapping of the short names of a namespace to object
+        IDs, revalidated first
+        """
+        now = time.monotonic()
+        self._refresh_packed(now)
+        self._refresh_namespace(namespace, now)
+        view = self._views.get(namespace)
+        if view is None:
+            prefix = namespace + "/"
+            names = [ name for name in self._packed
+                      if name.startswith(prefix) ]
+            names.extend(self._loose[namespace])
+            view = {}
+            for name in names:
+                oid = self._resolve(name, now)
+                if oid is not None:
+                    view[name[len(prefix):]] = oid
+            view = self._views[namespace] = types.MappingProxyType(view)
+        return view
+
+    def get(self, name):
+        """Object ID a full ref name (e.g. refs/heads/master) points to"""
+        return self.lookup((name,))
+
+    def lookup(self, names):
+        """Object ID of the first of a sequence of full ref names that
+        exists, or None, revalidating only once
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refresh_packed(now)
+            for name in names:
+                oid = self._resolve(name, now)
+                if oid is not None:
+                    return oid
+            return None
+
+    @property
+    def heads(self):
+        """Read-only mapping of branch names to object IDs"""
+        with self._lock:
+            return self._view("refs/heads")
+
+    @property
+    def tags(self):
+        """Read-only mapping of tag names to object IDs"""
+        with self._lock:
+            return self._view("refs/tags")
+
+    @property
+    def peeled(self):
+        """Read-only mapping of annotated tag object IDs to the object IDs
+        they point to, as recorded in packed-refs
+        """
+        with self._lock:
+            self._refresh_packed(time.monotonic())
+            return self._packed_peeled
+
+    @property
+    def head(self):
+        """Contents of HEAD"""
+        with self._lock:
+            key = stat_key(self.path / "HEAD")
+            if key != self._head_key:
+                self._head = (self.path / "HEAD").read_text()
+                self._head_key = key
+            return self._head
+
 class Repository:
-    def __init__(self, path):
+    """A git repository
+
+    Repository objects are safe to share between threads: the pack files,
+    indexes and commit-graph are read-only memory maps that are read
+    without locking, the lazily loaded indexes are initialized under a
+    lock, and the caches (DeltaBaseCache, ObjectCache) and the ref database
+    lock internally.
+    Parsed objects are immutable once constructed, their lazily computed
+    fields always compute the same value, so racing threads are harmless.
+    The only thing callers have to synchronize themselves is close().
+    """
+
+    def __init__(self, path,
+                 delta_base_cache_limit=DeltaBaseCache.DEFAULT_LIMIT,
+                 object_cache=None, instrumentation=None,
+                 metadata_cache=None,
+                 ref_check_interval=RefDatabase.DEFAULT_CHECK_INTERVAL):
         # Save repo path
         self.path = pathlib.Path(path)
         # Check for non-bare repo
         if (self.path / ".git").is_dir():
             self.path = self.path / ".git"
+        # References, cached in memory, and revalidated at most every
+        # ref_check_interval seconds
+        self.refs = RefDatabase(self.path, ref_check_interval)
+        # Delta base cache shared by all packs
+        self.delta_base_cache = DeltaBaseCache(delta_base_cache_limit)
+        # Optional cache of parsed objects (an ObjectCache)
+        self.object_cache = object_cache
+        # Optional hot path instrumentation (an Instrumentation)
+        self.instrumentation = instrumentation
+        # Optional persistent cache (a MetadataCache), this is owned by the
+        # caller and not closed with the repository, it may be shared
+        self.metadata_cache = metadata_cache
         # Read packs
         self.packs = []
         packdir = self.path / "objects" / "pack"
         for idxpath in packdir.glob("*.idx"):
             pack_name = idxpath.name[:-4] + ".pack"
-            self.packs.append(PackFile(idxpath, packdir / pack_name))
+            self.packs.append(PackFile(idxpath, packdir / pack_name,
+                                       self.delta_base_cache,
+                                       instrumentation))
+        self._indexes = None
+        self._commit_graph = False
+        self._bitmap = False
+        # Only guards the lazy initialization above, reads are lock-free
+        self._lock = threading.Lock()
 
     @property
-    def config(self):
-        config = configparser.ConfigParser()
-        config.read(self.path / "config")
-        return config
+    def bitmap(self):
+        """Reachability bitmap index of the repository, or None, git only
+        writes one for a single pack (usually after a full repack)
+        """
+        if self._bitmap is False:
+            with self._lock:
+                if self._bitmap is False:
+                    self._bitmap = next((pack.bitmap for pack in self.packs
+                                         if pack.bitmap is not None), None)
+        return self._bitmap
 
-    def _read_packed_refs(self, tgt_dict, want):
-        packed_refs_path = self.path / "packed-refs"
+    @property
+    def commit_graph(self):
+        """The repository's commit-graph, or None if it doesn't have one"""
+        if self._commit_graph is False:
+            with self._lock:
+                if self._commit_graph is False:
+                    self._commit_graph = \
+                        CommitGraph.load(self.path / "objects")
+        return self._commit_graph
 
-        # Return if packed references file is empty
-        if not packed_refs_path.exists():
-            return
+    @property
+    def indexes(self):
+        """Object indexes to search for packed objects, the multi-pack-index
+        if present, and a merged index for the packs it doesn't cover, so
+        that an object lookup costs one search for every repository layout
+        """
+        indexes = self._indexes
+        if indexes is not None:
+            return indexes
+        with self._lock:
+            if self._indexes is not None:
+                return self._indexes
+            indexes = []
+            uncovered = self.packs
+            midx_path = self.path / "objects" / "pack" / "multi-pack-index"
+            if midx_path.is_file():
+                midx = MultiPackIndex(midx_path, self.packs)
+                covered = set(midx.covered)
+                uncovered = [ pack for pack in self.packs
+                              if pack not in covered ]
+                indexes.append(midx)
+            if len(uncovered) > 1:
+                indexes.append(MergedPackIndex(uncovered))
+            else:
+                indexes.extend(uncovered)
+            self._indexes = indexes
+        return indexes
+
+    def _find_packed(self, oid_bytes):
+        """Find the pack and offset of a packed object, or None"""
+        for index in self.indexes:
+            found = index.lookup(oid_bytes)
+            if found is not None:
+                return found
+        return None
 
-        for line in packed_refs_path.read_text().split("\n"):
-            # Skip empty lines and comments, and peel lines (we don't care
-            # about tags for now)
-            if line == "" or line[0] == "#" or line[0] == "^":
-                continue
+    def close(self):
+        """Release the resources (memory maps) held by the repository, this
+        must not be called while other threads are still using it
+        """
+        for index in self._indexes or ():
+            if isinstance(index, MultiPackIndex):
+                index.close()
+        self._indexes = None
+        self._bitmap = False
+        if self._commit_graph:
+            self._commit_graph.close()
+        self._commit_graph = False
+        for pack in self.packs:
+            pack.close()
+        self.packs = []
+        self.delta_base_cache.clear()
+        if self.object_cache is not None:
+            self.object_cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-            # Add packed reference if desired
-            val, key = line.split(" ", 1)
-            if key.startswith(want):
-                realkey = key[len(want):]
-                # NOTE: packed refs do *not* take precedence over unpacked ones
-                if realkey not in tgt_dict:
-                    tgt_dict[realkey] = val
+    @property
+    def config(self):
+        config = configparser.ConfigParser()
+        config.read(self.path / "config")
+        return config
 
     @property
     def tags(self):
         """List of tags"""
-        tags = { ref.name : ref.read_text().strip()
-                 for ref in (self.path / "refs" / "tags").iterdir() }
-        self._read_packed_refs(tags, "refs/tags/")
-        return tags
+        return self.refs.tags
 
     @property
     def heads(self):
         """List of heads (aka branches)"""
-        heads = { ref.name : ref.read_text().strip()
-                 for ref in (self.path / "refs" / "heads").iterdir() }
-        self._read_packed_refs(heads, "refs/heads/")
-        return heads
+        return self.refs.heads
 
     @property
     def HEAD(self):
@@ -460,7 +2135,7 @@ class Repository:
 
         # Please note that this is a symbolic reference so it might contain
         # either an object ID, or a pointer to an actual reference
-        sym_ref = (self.path / "HEAD").read_text()
+        sym_ref = self.refs.head
 
         m = re.match(r"ref:\s*(\S*)", sym_ref)
         if m is not None:
@@ -469,36 +2144,355 @@ class Repository:
             assert refval.startswith("refs/heads/")
             return refval[11:]
         else:
-            return sym_ref
+            return sym_ref.strip()
+
+    def _resolve(self, oid):
+        """Resolve a revision into an object ID, full object IDs are passed
+        through as is, raw object IDs are accepted too
+        """
+        if isinstance(oid, bytes):
+            return binascii.hexlify(oid).decode()
+        if len(oid) != 40:
+            return self.resolve(oid)
+        return oid
+
+    def _lookup_ref(self, name):
+        """Resolve a reference name, with the same precedence git uses, or
+        return None
+        """
+        if name == "HEAD":
+            head = self.HEAD
+            return head if HEX_OID.fullmatch(head) else self.heads.get(head)
+        return self.refs.lookup((name, "refs/" + name, "refs/tags/" + name,
+                                 "refs/heads/" + name))
+
+    def find_prefix(self, prefix):
+        """Find the object IDs starting with a hex prefix, searching the
+        pack indexes by range and the matching loose object directory,
+        returns a sorted list of object IDs
+        """
+        prefix = prefix.lower()
+        assert HEX_PREFIX.fullmatch(prefix)
+        lo = binascii.unhexlify(prefix.ljust(40, "0"))
+        hi = binascii.unhexlify(prefix.ljust(40, "f"))
+
+        found = set()
+        for index in self.indexes:
+            for oid_bytes in find_oid_range(index.oids, index.fanout, lo, hi):
+                found.add(binascii.hexlify(oid_bytes).decode())
+
+        if len(prefix) >= 2:
+            loose_dir = self.path / "objects" / prefix[:2]
+            if loose_dir.is_dir():
+                found.update(prefix[:2] + obj.name
+                             for obj in loose_dir.iterdir()
+                             if obj.name.startswith(prefix[2:]))
+        return sorted(found)
+
+    def peel(self, oid):
+        """Follow annotated tags until reaching a non-tag object"""
+        peeled = self.refs.peeled.get(oid)
+        if peeled is not None:
+            return peeled
+        while True:
+            obj_type, obj_data, _ = self._read_raw(oid)
+            if obj_type != OBJ_TAG:
+                return oid
+            assert obj_data.startswith(b"object ")
+            oid = obj_data[7:47].decode()
+
+    def resolve(self, rev):
+        """Resolve a revision into an object ID, or None if it doesn't name
+        anything, this supports (abbreviated) object IDs, HEAD, branch and
+        tag names, and any number of ~N and ^N suffixes, raises
+        AmbiguousOidError if an abbreviated object ID is ambiguous
+        """
+        m = REVISION.fullmatch(rev)
+        if m is None:
+            return None
+        base, suffixes = m.groups()
+
+        if len(base) == 40 and HEX_OID.fullmatch(base):
+            oid = base.lower()
+        else:
+            oid = self._lookup_ref(base)
+            if oid is None and len(base) >= 4 and HEX_PREFIX.fullmatch(base):
+                candidates = self.find_prefix(base)
+                if len(candidates) > 1:
+                    raise AmbiguousOidError(base, candidates)
+                if candidates:
+                    oid = candidates[0]
+            if oid is None:
+                return None
+
+        for op, num in REVISION_SUFFIX.findall(suffixes):
+            num = 1 if num == "" else int(num)
+            oid = self.peel(oid)
+            if op == "^" and num == 0:
+                continue
+            commit = self.get_commit(oid)
+            if not isinstance(commit, (Commit, GraphCommit)):
+                return None
+            if op == "~":
+                for _ in range(num):
+                    if len(commit.parents) == 0:
+                        return None
+                    commit = self.get_commit(commit.parents[0])
+                oid = commit.oid
+            else:
+                if num > len(commit.parents):
+                    return None
+                oid = commit.parents[num - 1]
+        return oid
+
+    def get_commit(self, oid):
+        """Lookup a commit, for commits in the commit-graph this returns a
+        GraphCommit without reading the commit object itself
+        """
+        oid = self._resolve(oid)
+        if oid is None:
+            return None
+        if self.commit_graph is not None:
+            commit = self.commit_graph.get(self, oid)
+            if commit is not None:
+                return commit
+        return self[oid]
 
     def __getitem__(self, oid):
         """Lookup an object ID in the repository"""
 
         # De-alias branch name here
-        if len(oid) != 40:
-            oid = self.heads[oid]
+        oid = self._resolve(oid)
+        if oid is None:
+            return None
+
+        if self.object_cache is None:
+            return self._load(oid)
+        obj = self.object_cache.get(oid)
+        if obj is None:
+            obj = self._load(oid)
+            if obj is not None:
+                self.object_cache.put(obj)
+        return obj
+
+    def get_many(self, oids):
+        """Lookup many objects at once, generates (oid, object) pairs with
+        the oids as passed in, in the order the objects are read rather than
+        the order given, object is None for missing objects
+
+        Packed objects are read in pack order, and objects that are delta
+        bases of other objects in the batch are kept in the delta base
+        cache, so each of them is only inflated once
+        """
+        object_cache = self.object_cache
+        packed, loose = [], []
+        for key in oids:
+            oid = self._resolve(key)
             if oid is None:
+                yield key, None
+                continue
+            if object_cache is not None:
+                obj = object_cache.get(oid)
+                if obj is not None:
+                    yield key, obj
+                    continue
+            found = self._find_packed(binascii.unhexlify(oid))
+            if found is None:
+                loose.append((key, oid))
+            else:
+                pack, obj_offs = found
+                packed.append((pack.packpath, obj_offs, pack, key, oid))
+        packed.sort(key=lambda item: item[:2])
+
+        bases = set()
+        for packpath, obj_offs, pack, _, _ in packed:
+            base_offs = pack._read_header(obj_offs)[3]
+            if base_offs is not None:
+                bases.add((packpath, base_offs))
+
+        for packpath, obj_offs, pack, key, oid in packed:
+            if (packpath, obj_offs) in bases:
+                obj_type, obj_data = pack._get_base(obj_offs, 0)
+            else:
+                obj_type, obj_data = pack._get_object(oid, obj_offs)
+            obj = make_object(oid, obj_type, obj_data, self.instrumentation)
+            if object_cache is not None and obj is not None:
+                object_cache.put(obj)
+            yield key, obj
+
+        for key, oid in loose:
+            yield key, self[oid]
+
+    def _load(self, oid):
+        """Read and parse an object"""
+        instrumentation = self.instrumentation
+        if instrumentation is None:
+            return self._load_object(oid)[0]
+        start = time.perf_counter()
+        obj, where = self._load_object(oid)
+        instrumentation.record("lookup_" + where,
+                               seconds=time.perf_counter() - start)
+        return obj
+
+    def _open_loose(self, oid):
+        """Open a loose object and inflate just enough of it to parse its
+        header, returns the file, the deflator, the type, the size and the
+        data inflated so far, or None if there is no such loose object
+        """
+        obj_path = self.path / "objects" / oid[:2] / oid[2:]
+        try:
+            obj_file = obj_path.open("rb")
+        except FileNotFoundError:
+            return None
+
+        deflator = zlib.decompressobj()
+        data = b""
+        while b"\x00" not in data and not deflator.eof:
+            chunk = obj_file.read(64)
+            assert len(chunk) > 0
+            data += deflator.decompress(chunk)
+        obj_hdr, data = data.split(b"\x00", 1)
+        obj_type, obj_size = obj_hdr.split(b" ")
+        return obj_file, deflator, OBJ_NAMES.get(obj_type), int(obj_size), \
+            data
+
+    def contains(self, oid):
+        """Is an object in the repository, without reading it"""
+        oid = self._resolve(oid)
+        if oid is None:
+            return False
+        if self._find_packed(binascii.unhexlify(oid)) is not None:
+            return True
+        return (self.path / "objects" / oid[:2] / oid[2:]).is_file()
+
+    def object_info(self, oid):
+        """Type and size of an object as an ObjectInfo, or None, this only
+        reads object headers, for deltified objects the header of the delta
+        """
+        oid = self._resolve(oid)
+        if oid is None:
+            return None
+
+        found = self._find_packed(binascii.unhexlify(oid))
+        if found is not None:
+            pack, obj_offs = found
+            obj_type, obj_size = pack._object_info(obj_offs)
+        else:
+            loose = self._open_loose(oid)
+            if loose is None:
                 return None
+            obj_file, _, obj_type, obj_size, _ = loose
+            obj_file.close()
+        return ObjectInfo(OBJ_TYPE_NAMES[obj_type], obj_size)
+
+    def tree_info(self, tree):
+        """Type and size of every entry of a tree (or tree object ID), as a
+        dict of names to ObjectInfo, submodules are left out as their
+        commits are not in this repository, entries are looked up in pack
+        order for locality
+        """
+        if not isinstance(tree, Tree):
+            tree = self[tree]
+            if not isinstance(tree, Tree):
+                return None
+
+        packed, loose = [], []
+        for entry in tree:
+            if (entry.mode & S_IFMT) == S_IFMOD:
+                continue
+            found = self._find_packed(entry.raw_oid)
+            if found is None:
+                loose.append(entry)
+            else:
+                pack, obj_offs = found
+                packed.append((pack.packpath, obj_offs, pack, entry.name))
+
+        result = {}
+        packed.sort(key=lambda item: item[:2])
+        for _, obj_offs, pack, name in packed:
+            obj_type, obj_size = pack._object_info(obj_offs)
+            result[name] = ObjectInfo(OBJ_TYPE_NAMES[obj_type], obj_size)
+        for entry in loose:
+            result[entry.name] = self.object_info(entry.raw_oid)
+        return result
+
+    def open_blob(self, oid):
+        """Open a blob for reading as a file-like BlobStream, without
+        reading it into memory, blobs stored as deltas are the exception,
+        returns None if there is no such blob
+        """
+        oid = self._resolve(oid)
+        if oid is None:
+            return None
+
+        if self.object_cache is not None:
+            obj = self.object_cache.get(oid)
+            if isinstance(obj, Blob):
+                return BlobStream(obj.size, iter((obj.data,)))
+
+        found = self._find_packed(binascii.unhexlify(oid))
+        if found is not None:
+            pack, obj_offs = found
+            obj_type, stream = pack._open_object(obj_offs)
+            if obj_type != OBJ_BLOB:
+                stream.close()
+                return None
+            return stream
+
+        loose = self._open_loose(oid)
+        if loose is None:
+            return None
+        obj_file, deflator, obj_type, obj_size, data = loose
+        if obj_type != OBJ_BLOB:
+            obj_file.close()
+            return None
+        return BlobStream(obj_size,
+                          inflate_chunks(obj_file.read, obj_size, deflator,
+                                         data),
+                          obj_file)
+
+    def _load_object(self, oid):
+        """Read and parse an object, returns the object and where it was
+        found (packed, loose or missing)
+        """
+        obj_type, obj_data, where = self._read_raw(oid)
+        if obj_type is None:
+            return None, where
+        return make_object(oid, obj_type, obj_data, self.instrumentation), \
+            where
+
+    def _read_raw(self, oid):
+        """Read the type and raw data of an object, returns them and where
+        the object was found (packed, loose or missing)
+        """
+        instrumentation = self.instrumentation
+
+        # Look for object in packs first, most objects live there
+        if instrumentation is None:
+            found = self._find_packed(binascii.unhexlify(oid))
+        else:
+            start = time.perf_counter()
+            found = self._find_packed(binascii.unhexlify(oid))
+            instrumentation.record("index_search",
+                                   seconds=time.perf_counter() - start)
+        if found is not None:
+            pack, obj_offs = found
+            return (*pack._get_object(oid, obj_offs), "packed")
 
         # Expected location on disk
         obj_path = self.path / "objects" / oid[:2] / oid[2:]
 
-        if not obj_path.is_file():
-            # Look for object in packs
-            for pack in self.packs:
-                obj = pack[oid]
-                if obj is not None:
-                    return obj
-        else:
+        if obj_path.is_file():
             # Found object on disk
-            obj_hdr, obj_data = zlib.decompress(obj_path.read_bytes()).split(b"\x00", 1)
+            if instrumentation is not None:
+                start = time.perf_counter()
+            obj_raw = zlib.decompress(obj_path.read_bytes())
+            if instrumentation is not None:
+                instrumentation.record("inflate",
+                                       seconds=time.perf_counter() - start,
+                                       bytes=len(obj_raw))
+            obj_hdr, obj_data = obj_raw.split(b"\x00", 1)
             obj_type, obj_size = obj_hdr.split(b" ")
+            return OBJ_NAMES.get(obj_type), obj_data, "loose"
 
-            if obj_type == b"blob":
-                return Blob(oid, obj_data)
-            elif obj_type == b"tree":
-                return Tree(oid, obj_data)
-            elif obj_type == b"commit":
-                return Commit(oid, obj_data)
-
-        return None
+        return None, None, "missing"
@@ -0,0 +1,93 @@
+#
+# Part of mpygit - tests/conftest.py - Repositories shared by the tests
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+# The tests import mpygit as a package, run them from the directory
+# containing it: python -m pytest mpygit/tests
+#
+# The repositories are generated with the benchmark generators at a small
+# scale, and git itself is the reference the results are checked against
+
+import pytest
+from mpygit.bench import repogen
+
+def git(path, *args, data=None):
+    """Run git in a repository, returns its output as a string"""
+    return repogen.git(path, *args, data=data).decode()
+
+def git_bytes(path, *args, data=None):
+    """Run git in a repository, returns its output as bytes"""
+    return repogen.git(path, *args, data=data)
+
+def git_oids(path):
+    """Hex IDs of every object in a repository, according to git"""
+    return git(path, "cat-file", "--batch-all-objects",
+               "--batch-check=%(objectname)").split()
+
+def git_objects(path):
+    """Type and contents of every object in a repository, according to git,
+    as a dict of hex IDs to (type, data)
+    """
+    out = git_bytes(path, "cat-file", "--batch-all-objects", "--batch")
+    objects = {}
+    pos = 0
+    while pos < len(out):
+        end = out.index(b"\n", pos)
+        oid, obj_type, size = out[pos:end].decode().split()
+        pos = end + 1
+        objects[oid] = (obj_type, out[pos:pos+int(size)])
+        pos += int(size) + 1
+    return objects
+
+@pytest.fixture(scope="session")
+def linear_repo(tmp_path_factory):
+    return repogen.linear_history(tmp_path_factory.mktemp("repos") /
+                                  "linear.git", commits=60, files=20)
+
+@pytest.fixture(scope="session")
+def merges_repo(tmp_path_factory):
+    return repogen.wide_merges(tmp_path_factory.mktemp("repos") /
+                               "merges.git", branches=6, rounds=4)
+
+@pytest.fixture(scope="session")
+def deltas_repo(tmp_path_factory):
+    return repogen.deep_deltas(tmp_path_factory.mktemp("repos") /
+                               "deltas.git", commits=40)
+
+@pytest.fixture(scope="session")
+def many_packs_repo(tmp_path_factory):
+    return repogen.many_packs(tmp_path_factory.mktemp("repos") /
+                              "many_packs.git", packs=5, commits_per_pack=6,
+                              loose=20)
+
+# Histories to walk, generated with and without a commit-graph
+HISTORIES = {
+    "linear": (repogen.linear_history, { "commits" : 60, "files" : 20 }),
+    "merges": (repogen.wide_merges, { "branches" : 6, "rounds" : 4 }),
+}
+
+@pytest.fixture(scope="session",
+                params=[ (kind, graph) for kind in HISTORIES
+                         for graph in (False, True) ],
+                ids=lambda param: param[0] + ("-graph" if param[1] else ""))
+def history_repo(request, tmp_path_factory):
+    kind, graph = request.param
+    func, params = HISTORIES[kind]
+    if graph:
+        func = repogen.with_commit_graph(func)
+    return func(tmp_path_factory.mktemp("repos") / f"{kind}.git", **params)
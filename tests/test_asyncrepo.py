@@ -0,0 +1,119 @@
+#
+# Part of mpygit - tests/test_asyncrepo.py - asyncio wrapper
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import binascii
+import pytest
+import threading
+from mpygit import asyncrepo, mpygit
+from mpygit.tests.conftest import git
+
+def run_with(path, func):
+    async def main():
+        with mpygit.Repository(path) as repo:
+            async with asyncrepo.AsyncRepository(repo) as arepo:
+                return await func(repo, arepo)
+    return asyncio.run(main())
+
+def test_bad_lookups_only_fail_themselves(linear_repo):
+    head = git(linear_repo, "rev-parse", "main").strip()
+    commits = git(linear_repo, "rev-list", "main").split()
+    # Prefixes of two different objects
+    oids = git(linear_repo, "cat-file", "--batch-all-objects",
+               "--batch-check=%(objectname)").split()
+    ambiguous = next(a[:4] for a, b in zip(oids, oids[1:])
+                     if a[:4] == b[:4])
+
+    async def lookups(repo, arepo):
+        return await asyncio.gather(arepo.get(head), arepo.get("zz" * 20),
+                                    arepo.get(ambiguous),
+                                    arepo.get_commit(commits[1]),
+                                    arepo.get_commit("zz" * 20),
+                                    arepo.get("0" * 40),
+                                    return_exceptions=True)
+
+    obj, malformed, amb, commit, bad_commit, missing = \
+        run_with(linear_repo, lookups)
+    assert obj.oid == head
+    assert isinstance(malformed, binascii.Error)
+    assert isinstance(amb, mpygit.AmbiguousOidError)
+    assert commit.oid == commits[1]
+    assert isinstance(bad_commit, Exception)
+    assert missing is None
+
+def test_lookups_are_batched(history_repo):
+    commits = git(history_repo, "rev-list", "main").split()
+    calls = []
+
+    async def lookups(repo, arepo):
+        load_batch = arepo._load_batch
+        def counting(batch):
+            calls.append(len(batch))
+            return load_batch(batch)
+        arepo._load_batch = counting
+        found = await asyncio.gather(*(arepo.get_commit(oid)
+                                       for oid in commits))
+        # Commits from the commit-graph are loaded already
+        return [ (commit.oid, commit.message) for commit in found ]
+
+    found = run_with(history_repo, lookups)
+    assert calls == [ len(commits) ]
+    assert [ oid for oid, _ in found ] == commits
+
+def test_cancelling_iteration_closes_iterator():
+    started = threading.Event()
+    release = threading.Event()
+    closed = threading.Event()
+
+    def slow():
+        try:
+            started.set()
+            release.wait(10)
+            while True:
+                yield None
+        finally:
+            closed.set()
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        async with asyncrepo.AsyncRepository(None) as arepo:
+            async def consume():
+                async for _ in arepo._iterate(slow()):
+                    pass
+            task = asyncio.create_task(consume())
+            await loop.run_in_executor(None, started.wait, 10)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            # The chunk is still being produced, closing has to wait for it
+            assert not closed.is_set()
+            release.set()
+            return await loop.run_in_executor(None, closed.wait, 10)
+
+    assert asyncio.run(main())
+
+def test_lookups_after_close_fail(linear_repo):
+    head = git(linear_repo, "rev-parse", "main").strip()
+
+    async def lookups(repo, arepo):
+        await arepo.close()
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(arepo.get(head), 10)
+
+    run_with(linear_repo, lookups)
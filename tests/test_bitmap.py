@@ -0,0 +1,162 @@
+#
+# Part of mpygit - tests/test_bitmap.py - Reachability bitmaps
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import binascii
+import itertools
+import struct
+import pytest
+from mpygit import gitutil, mpygit
+from mpygit.bench import repogen
+from mpygit.tests.conftest import git
+
+def add_commit(path, parent, ref):
+    """Add a commit on top of parent as a loose object, and point ref at it"""
+    tree = git(path, "rev-parse", parent + "^{tree}").strip()
+    oid = git(path, "commit-tree", tree, "-p", parent, "-m",
+              f"on top of {parent}").strip()
+    git(path, "update-ref", ref, oid)
+    return oid
+
+@pytest.fixture(scope="module",
+                params=[ (kind, rev) for kind in ("linear", "merges")
+                         for rev in (True, False) ],
+                ids=lambda param: param[0] + ("-rev" if param[1] else ""))
+def bitmap_repo(request, tmp_path_factory):
+    """Repository with a bitmapped pack of all the history, with or without
+    a reverse index, and a second pack without a bitmap with newer commits
+    """
+    kind, rev = request.param
+    path = tmp_path_factory.mktemp("repos") / f"{kind}.git"
+    if kind == "linear":
+        repogen.linear_history(path, commits=300, files=20)
+    else:
+        repogen.wide_merges(path, branches=6, rounds=8)
+    git(path, "-c", f"pack.writeReverseIndex={str(rev).lower()}",
+        "repack", "-adbq")
+
+    # New commits on main, and on a side branch forking from older history
+    add_commit(path, "main", "refs/heads/main")
+    add_commit(path, "main", "refs/heads/main")
+    add_commit(path, "main~10", "refs/heads/side")
+    add_commit(path, "side", "refs/heads/side")
+    git(path, "repack", "-dq")
+    assert len(list(path.glob("objects/pack/*.pack"))) == 2
+    assert len(list(path.glob("objects/pack/*.bitmap"))) == 1
+    return path
+
+def ewah(bit_size, words):
+    """EWAH bitmap with the given (already compressed) words"""
+    return struct.pack(">II", bit_size, len(words)) + \
+        b"".join(struct.pack(">Q", word) for word in words) + \
+        struct.pack(">I", 0)
+
+def rlw(run_bit, run_len, lit_cnt):
+    return run_bit | (run_len << 1) | (lit_cnt << 33)
+
+def test_ewah_decode():
+    ones = (1 << 64) - 1
+    # Two words of ones and a literal, then a word of zeros and a literal
+    buf = b"junk" + ewah(320, [ rlw(1, 2, 1), 0x5, rlw(0, 1, 1), 0x1 ]) + \
+        b"after"
+    bits, off = mpygit.ewah_decode(buf, 4)
+    assert bits == ones | (ones << 64) | (0x5 << 128) | (1 << 256)
+    assert buf[off:] == b"after"
+    # Nothing but a run of zeros
+    assert mpygit.ewah_decode(ewah(128, [ rlw(0, 2, 0) ]), 0)[0] == 0
+
+def bitmapped_pack(repo):
+    bitmap = repo.bitmap
+    assert bitmap is not None
+    return bitmap.pack
+
+def objects_by_position(pack):
+    """Hex object IDs of a pack in pack order"""
+    objects = [ None ] * len(pack.oids)
+    for entry_idx, pos in enumerate(pack.pack_positions):
+        objects[pos] = binascii.hexlify(pack.oids[entry_idx]).decode()
+    return objects
+
+def oids_of(objects, bits):
+    return { oid for pos, oid in enumerate(objects) if (bits >> pos) & 1 }
+
+def test_pack_positions_match_offsets(bitmap_repo):
+    with mpygit.Repository(bitmap_repo) as repo:
+        pack = bitmapped_pack(repo)
+        out = git(bitmap_repo, "show-index",
+                  data=pack.packpath.with_suffix(".idx").read_bytes())
+        offsets = { line.split()[1] : int(line.split()[0])
+                    for line in out.splitlines() }
+        assert objects_by_position(pack) == sorted(offsets,
+                                                   key=offsets.__getitem__)
+
+def test_type_bitmaps_match_git(bitmap_repo):
+    with mpygit.Repository(bitmap_repo) as repo:
+        bitmap = repo.bitmap
+        objects = objects_by_position(bitmap.pack)
+        types = dict(line.split() for line in
+                     git(bitmap_repo, "cat-file", "--batch-check="
+                         "%(objectname) %(objecttype)",
+                         data="\n".join(objects).encode()).splitlines())
+        for obj_type, bits in (("commit", bitmap.commits),
+                               ("tree", bitmap.trees),
+                               ("blob", bitmap.blobs),
+                               ("tag", bitmap.tags)):
+            assert oids_of(objects, bits) == \
+                { oid for oid in objects if types[oid] == obj_type }
+
+def test_commit_bitmaps_match_rev_list(bitmap_repo):
+    with mpygit.Repository(bitmap_repo) as repo:
+        bitmap = repo.bitmap
+        pack = bitmap.pack
+        objects = objects_by_position(pack)
+        xored = sum(1 for _, xor_off in bitmap._entries if xor_off != 0)
+        assert xored > 0
+        # Newest first, so XOR chains are decoded from scratch
+        for entry_idx, i in sorted(bitmap._by_entry_idx.items(),
+                                   key=lambda item: -item[1]):
+            oid = binascii.hexlify(pack.oids[entry_idx]).decode()
+            expected = set(git(bitmap_repo, "rev-list", "--objects",
+                               "--no-object-names", oid).split())
+            assert oids_of(objects, bitmap.get(pack.oids[entry_idx])) == \
+                expected, oid
+        # Objects without a bitmap of their own
+        tree = bytes.fromhex(git(bitmap_repo, "rev-parse",
+                                 "main~2^{tree}").strip())
+        assert bitmap.get(tree) is None
+        assert bitmap.get(bytes(20)) is None
+
+def test_count_commits_matches_git(bitmap_repo):
+    refs = git(bitmap_repo, "for-each-ref", "--format=%(refname)").split()
+    revs = refs + [ "main~1", "main~2", "main~7", "side~1" ]
+    with mpygit.Repository(bitmap_repo) as repo:
+        for rev in revs:
+            oid = repo.resolve(rev)
+            assert gitutil.count_commits(repo, oid) == \
+                int(git(bitmap_repo, "rev-list", "--count", oid)), rev
+
+def test_ahead_behind_matches_git(bitmap_repo):
+    refs = git(bitmap_repo, "for-each-ref", "--format=%(refname)").split()
+    revs = refs[:6] + [ "main~2", "side~1" ]
+    with mpygit.Repository(bitmap_repo) as repo:
+        for rev1, rev2 in itertools.combinations(revs, 2):
+            oid1, oid2 = repo.resolve(rev1), repo.resolve(rev2)
+            out = git(bitmap_repo, "rev-list", "--left-right", "--count",
+                      f"{oid1}...{oid2}")
+            assert gitutil.ahead_behind(repo, oid1, oid2) == \
+                tuple(map(int, out.split())), (rev1, rev2)
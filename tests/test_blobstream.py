@@ -0,0 +1,137 @@
+#
+# Part of mpygit - tests/test_blobstream.py - Streaming blob reader
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import io
+import random
+import pytest
+from mpygit import mpygit
+from mpygit.bench import repogen
+from mpygit.tests.conftest import git, git_bytes
+
+def blobs(path):
+    """Hex IDs of the blobs of a repository, with the base of the ones
+    stored as deltas (or None)
+    """
+    out = git(path, "cat-file", "--batch-all-objects", "--batch-check="
+              "%(objectname) %(objecttype) %(deltabase)")
+    result = {}
+    for line in out.splitlines():
+        oid, obj_type, base = line.split()
+        if obj_type == "blob":
+            result[oid] = None if base == "0" * 40 else base
+    return result
+
+def is_loose(path, oid):
+    return (path / "objects" / oid[:2] / oid[2:]).is_file()
+
+@pytest.fixture(scope="module")
+def large_loose_repo(tmp_path_factory):
+    """Repository with loose blobs spanning many inflate chunks"""
+    path = repogen.init(tmp_path_factory.mktemp("repos") / "loose.git")
+    rng = random.Random(0)
+    for data in (rng.randbytes(300 * 1024), repogen.text_file(rng, 5000)):
+        git(path, "hash-object", "-w", "--stdin", data=data)
+    return path
+
+def sample_blobs(path, kind):
+    """Some of the blobs of a repository, the packed ones stored whole,
+    those stored as deltas, or the loose ones
+    """
+    found = []
+    for oid, base in blobs(path).items():
+        loose = is_loose(path, oid)
+        if (kind == "loose") == loose and \
+                (kind == "delta") == (not loose and base is not None):
+            found.append(oid)
+    assert len(found) > 0
+    return found[:10]
+
+CASES = [ ("many_packs_repo", "packed"), ("many_packs_repo", "loose"),
+          ("deltas_repo", "packed"), ("deltas_repo", "delta"),
+          ("large_loose_repo", "loose") ]
+
+@pytest.fixture(params=CASES, ids=lambda case: f"{case[0]}-{case[1]}")
+def blob_case(request):
+    fixture, kind = request.param
+    path = request.getfixturevalue(fixture)
+    return path, sample_blobs(path, kind)
+
+def test_read_matches_git(blob_case):
+    path, oids = blob_case
+    with mpygit.Repository(path) as repo:
+        for oid in oids:
+            expected = git_bytes(path, "cat-file", "blob", oid)
+            with repo.open_blob(oid) as stream:
+                assert stream.size == len(expected)
+                assert stream.read() == expected
+                assert stream.read() == b""
+
+def test_small_reads(blob_case):
+    path, oids = blob_case
+    with mpygit.Repository(path) as repo:
+        for oid in oids[:3]:
+            expected = git_bytes(path, "cat-file", "blob", oid)
+            with repo.open_blob(oid) as stream:
+                parts = []
+                while True:
+                    part = stream.read(4093)
+                    if part == b"":
+                        break
+                    assert len(part) <= 4093
+                    parts.append(part)
+                assert stream.read(0) == b""
+            assert b"".join(parts) == expected
+
+def test_readinto_and_iteration(blob_case):
+    path, oids = blob_case
+    with mpygit.Repository(path) as repo:
+        for oid in oids[:3]:
+            expected = git_bytes(path, "cat-file", "blob", oid)
+            with repo.open_blob(oid) as stream:
+                buf = bytearray(1000)
+                num = stream.readinto(buf)
+                head = bytes(buf[:num])
+                rest = b"".join(stream)
+            assert head + rest == expected
+            # Buffered readers build on readinto
+            with io.BufferedReader(repo.open_blob(oid), 517) as reader:
+                lines = reader.readlines()
+            assert b"".join(lines) == expected
+
+def test_close(blob_case):
+    path, oids = blob_case
+    with mpygit.Repository(path) as repo:
+        stream = repo.open_blob(oids[0])
+        if stream.size > 0:
+            assert len(stream.read(1)) == 1
+        file = stream._file
+        stream.close()
+        assert stream.closed
+        if file is not None:
+            assert file.closed
+        with pytest.raises(ValueError):
+            stream.read()
+        # Closing twice is fine
+        stream.close()
+
+def test_other_objects(many_packs_repo):
+    tree = git(many_packs_repo, "rev-parse", "main^{tree}").strip()
+    with mpygit.Repository(many_packs_repo) as repo:
+        assert repo.open_blob(tree) is None
+        assert repo.open_blob("0" * 40) is None
@@ -0,0 +1,175 @@
+#
+# Part of mpygit - tests/test_diff.py - Comparing commits
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import concurrent.futures
+import random
+import shutil
+import tracemalloc
+import pytest
+from mpygit import gitutil, mpygit
+from mpygit.bench import repogen
+from mpygit.tests.conftest import git, git_objects
+
+def git_name_status(path, oid):
+    """Changed files of a commit compared to its first parent"""
+    out = git(path, "diff-tree", "-r", "--root", "--no-renames",
+              "--no-commit-id", "--name-status", oid)
+    return sorted((line.split("\t")[1], line.split("\t")[0])
+                  for line in out.splitlines())
+
+@pytest.fixture(scope="module")
+def wide_repo(tmp_path_factory):
+    """Wide directories whose entries change between files and directories,
+    names are chosen to sort differently as files and as directories
+    """
+    path = repogen.init(tmp_path_factory.mktemp("repos") / "wide.git")
+    fi = repogen.FastImport()
+    files = { f"dir/entry{i:04d}" : fi.blob(b"%d\n" % i) for i in range(500) }
+    files["dir/x"] = fi.blob(b"x\n")
+    files["dir/x.txt"] = fi.blob(b"x.txt\n")
+    first = fi.commit("refs/heads/main", "initial", files)
+    second = fi.commit("refs/heads/main", "file to directory",
+                       { "dir/x" : None,
+                         "dir/x/inner" : fi.blob(b"inner\n"),
+                         "dir/entry0007" : fi.blob(b"changed\n"),
+                         "dir/entry0300" : None,
+                         "dir/new" : fi.blob(b"new\n") }, [first])
+    fi.commit("refs/heads/main", "directory to file",
+              { "dir/x/inner" : None, "dir/x" : fi.blob(b"x again\n"),
+                "dir/entry0499" : None }, [second])
+    fi.run(path)
+    return path
+
+def check_history(path):
+    with mpygit.Repository(path) as repo:
+        for commit in gitutil.walk(repo, "main"):
+            parent = repo[commit.parents[0]] if commit.parents else None
+            found = sorted(gitutil.diff_name_status(repo, parent,
+                                                    repo[commit.oid]))
+            assert found == git_name_status(path, commit.oid), commit.oid
+
+def test_name_status_matches_git(linear_repo):
+    check_history(linear_repo)
+
+def test_wide_tree_type_changes(wide_repo):
+    check_history(wide_repo)
+
+def test_patches_follow_name_status(wide_repo):
+    with mpygit.Repository(wide_repo) as repo:
+        commit = repo["main~1"]
+        diffs = gitutil.diff_commits(repo, repo[commit.parents[0]],
+                                     repo[commit.oid])
+        assert [ (path, status) for path, _, status in diffs ] == \
+            list(gitutil.diff_name_status(repo, repo[commit.parents[0]],
+                                          repo[commit.oid]))
+
+@pytest.fixture(scope="module")
+def large_files_repo(tmp_path_factory):
+    """A commit editing many large files"""
+    rng = random.Random(0)
+    path = repogen.init(tmp_path_factory.mktemp("repos") / "large.git")
+    fi = repogen.FastImport()
+    files = { f"file{i}.txt" : repogen.text_file(rng, 3000)
+              for i in range(12) }
+    first = fi.commit("refs/heads/main", "initial",
+                      { name : fi.blob(data) for name, data in files.items() })
+    fi.commit("refs/heads/main", "edit everything",
+              { name : fi.blob(repogen.edit_lines(rng, data, 3))
+                for name, data in files.items() }, [first])
+    fi.run(path)
+    return path
+
+def test_blobs_are_loaded_in_batches(large_files_repo):
+    def diff_peak(**kwargs):
+        tracemalloc.start()
+        try:
+            diffs = gitutil.diff_commits(repo, parent, commit, **kwargs)
+            return diffs, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    with mpygit.Repository(large_files_repo) as repo:
+        commit = repo["main"]
+        parent = repo[commit.parents[0]]
+        total = sum(len(data) for obj_type, data in
+                    git_objects(large_files_repo).values()
+                    if obj_type == "blob")
+
+        at_once, at_once_peak = diff_peak(batch_bytes=total)
+        batched, batched_peak = diff_peak(batch_bytes=total // 6)
+        assert batched == at_once
+        assert batched_peak < at_once_peak / 2
+        assert gitutil.diff_commits(repo, parent, commit,
+                                    batch_size=1) == at_once
+
+def test_missing_blobs_raise(linear_repo):
+    with mpygit.Repository(linear_repo) as repo:
+        commit = repo["main"]
+        diff = next(gitutil.iter_diffs(repo, repo[commit.parents[0]],
+                                       commit))
+        diff.new = mpygit.TreeEntry(diff.new.name, diff.new.mode,
+                                    b"\x00" * 20)
+        with pytest.raises(mpygit.MissingObjectError):
+            diff.patch
+
+def test_executor_sees_repacked_objects(linear_repo, tmp_path):
+    path = tmp_path / "repack.git"
+    shutil.copytree(linear_repo, path)
+    def check():
+        with mpygit.Repository(path) as repo:
+            commit = repo["main"]
+            parent = repo[commit.parents[0]]
+            assert gitutil.diff_commits(repo, parent, commit, executor) == \
+                gitutil.diff_commits(repo, parent, commit)
+
+    with concurrent.futures.ProcessPoolExecutor(1) as executor:
+
+        check()
+        # New objects go to a new pack, that the worker hasn't seen yet
+        fi = repogen.FastImport()
+        fi.chunks.append(b"commit refs/heads/main\n"
+            b"committer Bench Committer <committer@example.com> "
+            b"2000000000 +0000\n"
+            b"data 4\nnew\n\nfrom refs/heads/main^0\n"
+            b"M 100644 inline src/mod0/file0.txt\ndata 9\nnew file\n\n")
+        fi.run(path)
+        git(path, "repack", "-adq")
+        check()
+
+def test_thread_pool_executor(linear_repo):
+    with mpygit.Repository(linear_repo) as repo:
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            for commit in gitutil.walk(repo, "main", limit=10):
+                parent = repo[commit.parents[0]]
+                assert gitutil.diff_commits(repo, parent, commit, executor,
+                                            batch_size=1) == \
+                    gitutil.diff_commits(repo, parent, commit)
+
+def test_worker_repos_are_closed_when_unused(linear_repo):
+    path = str(linear_repo)
+    with gitutil.worker_repo(path) as first:
+        with gitutil.worker_repo(path, reopen=True) as second:
+            assert second is not first
+            # Still in use by the outer batch
+            assert first["main"] is not None
+        assert first["main"] is not None
+        with gitutil.worker_repo(path) as third:
+            assert third is second
+    assert first.packs == []
+    assert second["main"] is not None
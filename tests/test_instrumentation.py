@@ -0,0 +1,106 @@
+#
+# Part of mpygit - tests/test_instrumentation.py - Hot path instrumentation
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from mpygit import mpygit
+from mpygit.tests.conftest import git
+
+def delta_depths(path):
+    """Length of the delta chain of every packed object, according to git"""
+    out = git(path, "cat-file", "--batch-all-objects",
+              "--batch-check=%(objectname) %(deltabase)")
+    bases = dict(line.split() for line in out.splitlines())
+    depths = {}
+    for oid in bases:
+        depth, cur = 0, oid
+        while bases[cur] != "0" * 40:
+            depth += 1
+            cur = bases[cur]
+        depths[oid] = depth
+    return depths
+
+def test_delta_chain_depth(deltas_repo):
+    depths = delta_depths(deltas_repo)
+    oid = max(depths, key=depths.__getitem__)
+    depth = depths[oid]
+    assert depth > 10
+
+    instrumentation = mpygit.Instrumentation()
+    # Without a delta base cache the whole chain gets resolved
+    with mpygit.Repository(deltas_repo, delta_base_cache_limit=0,
+                           instrumentation=instrumentation) as repo:
+        blob = repo[oid]
+    stats = instrumentation.stats
+    assert stats["delta_chain"] == { "count" : 1, "depth" : depth,
+                                     "max_depth" : depth }
+    assert stats["apply_delta"]["count"] == depth
+    assert stats["apply_delta"]["max_bytes"] >= len(blob.data)
+    assert stats["inflate"]["count"] == depth + 1
+    assert stats["parse_blob"]["count"] == 1
+    assert stats["parse_blob"]["bytes"] == len(blob.data)
+    assert stats["lookup_packed"]["count"] == 1
+
+def test_lookups(many_packs_repo):
+    loose = next(path.parent.name + path.name for path in
+                 (many_packs_repo / "objects").glob("[0-9a-f][0-9a-f]/*"))
+    commit = git(many_packs_repo, "rev-parse", "main~3").strip()
+
+    instrumentation = mpygit.Instrumentation()
+    with mpygit.Repository(many_packs_repo,
+                           instrumentation=instrumentation) as repo:
+        assert repo[loose] is not None
+        assert repo[commit] is not None
+        assert repo[commit] is not None
+        assert repo["0" * 40] is None
+    stats = instrumentation.stats
+    assert stats["lookup_loose"]["count"] == 1
+    assert stats["lookup_packed"]["count"] == 2
+    assert stats["lookup_missing"]["count"] == 1
+    assert stats["index_search"]["count"] == 4
+    assert stats["parse_commit"]["count"] == 2
+    for event in ("lookup_loose", "lookup_packed", "lookup_missing",
+                  "index_search"):
+        assert stats[event]["seconds"] > 0
+        assert 0 < stats[event]["max_seconds"] <= stats[event]["seconds"]
+
+def test_subscribe(many_packs_repo):
+    commit = git(many_packs_repo, "rev-parse", "main").strip()
+    events = []
+
+    def callback(event, fields):
+        events.append((event, sorted(fields)))
+
+    instrumentation = mpygit.Instrumentation()
+    with mpygit.Repository(many_packs_repo,
+                           instrumentation=instrumentation) as repo:
+        instrumentation.subscribe(callback)
+        repo[commit]
+        assert ("lookup_packed", [ "seconds" ]) in events
+        assert ("parse_commit", [ "bytes", "seconds" ]) in events
+        assert ("index_search", [ "seconds" ]) in events
+        assert len(events) == sum(stat["count"] for stat in
+                                  instrumentation.stats.values())
+
+        instrumentation.unsubscribe(callback)
+        num_events = len(events)
+        repo[commit]
+        assert len(events) == num_events
+        assert instrumentation.stats["lookup_packed"]["count"] == 2
+
+    instrumentation.reset()
+    assert instrumentation.stats == {}
@@ -0,0 +1,45 @@
+#
+# Part of mpygit - tests/test_latest_change.py - Latest change of paths
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from mpygit import gitutil, mpygit
+from mpygit.tests.conftest import git
+
+def directories(path, rev):
+    """Every directory at a commit, as lists of names"""
+    names = git(path, "ls-tree", "-r", "-d", "--name-only", rev).split()
+    return [ [] ] + [ name.split("/") for name in names ]
+
+def test_latest_changes_match_git_log(history_repo):
+    starts = git(history_repo, "rev-list", "--date-order", "main").split()
+    # Spread over the history, so some entries were changed long ago
+    starts = starts[::max(1, len(starts) // 10)][:10]
+    with mpygit.Repository(history_repo) as repo:
+        for start in starts:
+            for dir_path in directories(history_repo, start):
+                changes = gitutil.get_latest_changes(repo, start, dir_path)
+                tree = git(history_repo, "ls-tree", "--name-only",
+                           start + ":" + "/".join(dir_path)).split()
+                assert sorted(changes) == tree
+                for name, commit in changes.items():
+                    path = dir_path + [ name ]
+                    expected = git(history_repo, "log", "-1", "--format=%H",
+                                   start, "--", "/".join(path)).strip()
+                    assert commit.oid == expected, (start, path)
+                    assert gitutil.get_latest_change(repo, start,
+                                                     path).oid == expected
@@ -0,0 +1,127 @@
+#
+# Part of mpygit - tests/test_linediff.py - Line diff engine
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import random
+import re
+import subprocess
+import pytest
+from mpygit import gitutil, linediff, mpygit
+from mpygit.tests.conftest import git
+
+GIT_DIFF = [ "--histogram", "--no-indent-heuristic", "--no-color" ]
+
+def git_hunks(patch):
+    """The hunks of a patch generated by git, without its headers"""
+    # Only newlines end lines, see test_separators_are_not_newlines
+    lines = re.findall(r"[^\n]*\n|[^\n]+$", patch)
+    for i, line in enumerate(lines):
+        if line.startswith("@@"):
+            return lines[i:]
+    return []
+
+def git_diff_files(tmp_path, a, b):
+    (tmp_path / "a").write_bytes("".join(a).encode())
+    (tmp_path / "b").write_bytes("".join(b).encode())
+    # --no-index exits with 1 if the files differ
+    out = subprocess.run(["git", "diff", "--no-index"] + GIT_DIFF +
+                         [str(tmp_path / "a"), str(tmp_path / "b")],
+                         capture_output=True, check=False).stdout
+    return git_hunks(out.decode())
+
+def random_edit(rng, alphabet):
+    a = [ rng.choice(alphabet) for _ in range(rng.randint(0, 40)) ]
+    b = list(a)
+    for _ in range(rng.randint(1, 8)):
+        pos = rng.randint(0, len(b))
+        op = rng.randrange(3)
+        if op == 0:
+            b[pos:pos] = [ rng.choice(alphabet)
+                           for _ in range(rng.randint(1, 4)) ]
+        elif op == 1:
+            del b[pos:pos+rng.randint(1, 4)]
+        elif len(b) > 0:
+            b[min(pos, len(b) - 1)] = rng.choice(alphabet)
+    return a, b
+
+def test_split_lines():
+    assert linediff.split_lines("") == []
+    assert linediff.split_lines("a\nb") == [ "a\n", "b" ]
+    assert linediff.split_lines("a\fb\r\nc\x85d \n") == \
+        [ "a\fb\r\n", "c\x85d \n" ]
+
+@pytest.mark.parametrize("seed", range(200))
+def test_matches_git(tmp_path, seed):
+    rng = random.Random(seed)
+    # Few distinct lines, so there are plenty of ties between anchors
+    alphabet = [ f"{c}\n" for c in "abcdefgh" ] + [ "{\n", "}\n", "\n" ]
+    a, b = random_edit(rng, alphabet[:rng.randint(2, len(alphabet))])
+    assert list(linediff.unified_diff(a, b))[2:] == \
+        git_diff_files(tmp_path, a, b)
+
+def test_separators_are_not_newlines(tmp_path):
+    a = linediff.split_lines("intro\nsection\fone\ntwo\rthree\nfour\n"
+                             "five\nsix\n")
+    b = linediff.split_lines("intro\nsection\fone\ntwo\rthree\nfour\n"
+                             "changed\nsix")
+    assert list(linediff.unified_diff(a, b))[2:] == \
+        git_diff_files(tmp_path, a, b)
+
+def test_commit_patches_match_git(linear_repo):
+    with mpygit.Repository(linear_repo) as repo:
+        for commit in gitutil.walk(repo, "main", limit=20):
+            parent = repo[commit.parents[0]]
+            for path, patch, _ in gitutil.diff_commits(repo, parent,
+                                                       commit):
+                expected = git(linear_repo, "diff", *GIT_DIFF, parent.oid,
+                               commit.oid, "--", path)
+                assert git_hunks(patch) == git_hunks(expected)
+
+def apply_opcodes(a, b, opcodes):
+    """Rebuild b from a and the opcodes, checking they cover both sides"""
+    out = []
+    i = j = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        assert (i1, j1) == (i, j)
+        if tag == "equal":
+            assert a[i1:i2] == b[j1:j2]
+            out.extend(a[i1:i2])
+        else:
+            out.extend(b[j1:j2])
+        i, j = i2, j2
+    assert (i, j) == (len(a), len(b))
+    return out
+
+def test_many_changes_fall_back_to_myers():
+    # Every anchor splits off a single line, with git's choice of anchors
+    # this takes quadratic time without a budget
+    a = [ f"line {i}\n" for i in range(20000) ]
+    b = [ f"edited {i}\n" if i % 4 == 0 else line
+          for i, line in enumerate(a) ]
+    opcodes = linediff.diff_lines(a, b)
+    assert apply_opcodes(a, b, opcodes) == b
+    assert sum(i2 - i1 for tag, i1, i2, _, _ in opcodes
+               if tag != "equal") == 5000
+
+@pytest.mark.parametrize("seed", range(20))
+def test_histogram_without_budget_is_myers(seed):
+    rng = random.Random(seed)
+    a, b = random_edit(rng, [ f"{c}\n" for c in "abcdef" ])
+    opcodes = linediff.diff_lines(a, b, max_work=0)
+    assert opcodes == linediff.diff_lines(a, b, algorithm="myers")
+    assert apply_opcodes(a, b, opcodes) == b
@@ -0,0 +1,150 @@
+#
+# Part of mpygit - tests/test_metadata_cache.py - Persistent metadata cache
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import multiprocessing
+import sqlite3
+import time
+import pytest
+from mpygit import gitutil, mpygit
+from mpygit.tests.conftest import git
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = mpygit.MetadataCache(tmp_path / "cache.sqlite")
+    yield cache
+    cache.close()
+
+def keys(cache):
+    return { key for key, in cache._db().execute("SELECT key FROM entries") }
+
+def test_compaction_evicts_least_recently_used(cache):
+    now = int(time.time())
+    for i in range(10):
+        cache.put("test", f"key{i}", bytes(96))
+    # key0 is the least recently used, key9 the most recently used one
+    for i in range(10):
+        cache._db().execute("UPDATE entries SET atime = ? WHERE key = ?",
+                            (now - 100000 + i * 1000, f"key{i}"))
+    # Hits on entries not used for a while make them recent again
+    assert cache.get("test", "key0") == bytes(96)
+
+    cache.limit = 500
+    cache.compact()
+    assert cache.stats["size"] <= cache.limit * cache.COMPACT_TARGET
+    assert keys(cache) == { "key0", "key8", "key9" }
+
+def test_puts_stay_under_the_limit(cache):
+    cache.limit = 1600
+    for i in range(100):
+        cache.put("test", f"key{i:02}", bytes(96))
+        assert cache.stats["size"] <= cache.limit
+    assert "key99" in keys(cache)
+    # Entries larger than the whole cache are never stored
+    cache.put("test", "huge", bytes(2000))
+    assert cache.get("test", "huge") is None
+
+def put_entries(cache, start):
+    for i in range(start, start + 50):
+        cache.put("test", f"key{i}", b"%d" % i)
+
+def put_entries_at(path, start):
+    cache = mpygit.MetadataCache(path)
+    put_entries(cache, start)
+    cache.close()
+
+def test_shared_between_processes(cache):
+    cache.put("test", "parent", b"value")
+    # Forked children inherit the cache, spawned ones open the same file
+    procs = [ multiprocessing.get_context("fork").Process(
+                  target=put_entries, args=(cache, 0)),
+              multiprocessing.get_context("spawn").Process(
+                  target=put_entries_at, args=(cache.path, 50)) ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        assert proc.exitcode == 0
+    for i in range(100):
+        assert cache.get("test", f"key{i}") == b"%d" % i
+    other = mpygit.MetadataCache(cache.path)
+    assert other.get("test", "parent") == b"value"
+    other.close()
+
+def test_locked_database_is_a_miss(tmp_path):
+    cache = mpygit.MetadataCache(tmp_path / "cache.sqlite", timeout=0.1)
+    cache.put("test", "key", b"value")
+    cache.close()
+    locker = sqlite3.connect(cache.path, isolation_level=None)
+    locker.execute("PRAGMA locking_mode=EXCLUSIVE")
+    locker.execute("BEGIN EXCLUSIVE")
+    try:
+        assert cache.get("test", "key") is None
+        assert cache.misses == 1
+        cache.put("test", "other", b"value")
+        cache.compact()
+    finally:
+        locker.execute("ROLLBACK")
+        locker.close()
+    assert cache.get("test", "key") == b"value"
+    assert cache.get("test", "other") is None
+    cache.close()
+
+def directories(path):
+    files = git(path, "ls-tree", "-r", "--name-only", "main").split()
+    dirs = { tuple(name.split("/")[:i]) for name in files
+             for i in range(name.count("/") + 1) }
+    return files, sorted(dirs)
+
+def cached_answers(path, cache):
+    """Answers of every cached query, as plain object IDs"""
+    files, dirs = directories(path)
+    commits = git(path, "rev-list", "main").split()[:10]
+    answers = []
+    with mpygit.Repository(path, metadata_cache=cache) as repo:
+        for oid in commits[::3]:
+            for name in files[::4]:
+                commit = gitutil.get_latest_change(repo, oid, name.split("/"))
+                answers.append(None if commit is None else commit.oid)
+            for dir_path in dirs:
+                answers.append({ name : commit.oid for name, commit in
+                                 gitutil.get_latest_changes(
+                                     repo, oid, list(dir_path)).items() })
+        for oid in commits:
+            commit = repo.get_commit(oid)
+            parent = repo.get_commit(commit.parents[0]) \
+                if commit.parents else None
+            answers.append(list(gitutil.diff_name_status(repo, parent,
+                                                         commit)))
+    return answers
+
+@pytest.mark.parametrize("fixture", [ "linear_repo", "merges_repo" ])
+def test_cached_answers_round_trip(request, tmp_path, fixture):
+    path = request.getfixturevalue(fixture)
+    expected = cached_answers(path, None)
+
+    cache = mpygit.MetadataCache(tmp_path / "cache.sqlite")
+    assert cached_answers(path, cache) == expected
+    assert cache.misses > 0
+    cache.close()
+
+    # A fresh process would see the same file
+    cache = mpygit.MetadataCache(tmp_path / "cache.sqlite")
+    assert cached_answers(path, cache) == expected
+    assert cache.misses == 0 and cache.hits == len(expected)
+    cache.close()
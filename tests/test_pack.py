@@ -0,0 +1,86 @@
+#
+# Part of mpygit - tests/test_pack.py - Pack and index reading
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import binascii
+import tracemalloc
+import pytest
+from mpygit import mpygit
+from mpygit.tests.conftest import git, git_bytes, git_oids
+
+def test_oid_table_is_a_sequence():
+    oids = [ bytes([i]) * 20 for i in range(5) ]
+    table = mpygit.OidTable(b"header" + b"".join(oids) + b"trailer", 6, 5)
+    assert list(table) == oids
+    assert table[-1] == oids[-1]
+    with pytest.raises(IndexError):
+        table[5]
+    with pytest.raises(IndexError):
+        table[-6]
+
+def test_index_oids_match_git(many_packs_repo):
+    packed = set(git(many_packs_repo, "cat-file", "--batch-all-objects",
+                     "--batch-check=%(objectname)", "--unordered").split())
+    with mpygit.Repository(many_packs_repo) as repo:
+        found = set()
+        for index in repo.indexes:
+            found.update(binascii.hexlify(oid).decode()
+                         for oid in index.oids)
+    loose = { path.parent.name + path.name for path in
+              (many_packs_repo / "objects").glob("[0-9a-f][0-9a-f]/*") }
+    assert found == packed - loose
+
+def test_objects_match_git(many_packs_repo):
+    with mpygit.Repository(many_packs_repo) as repo:
+        for oid in git_oids(many_packs_repo):
+            obj_type = git(many_packs_repo, "cat-file", "-t", oid).strip()
+            info = repo.object_info(oid)
+            assert info.type == obj_type
+            if obj_type == "blob":
+                assert repo[oid].data == git_bytes(many_packs_repo, "cat-file",
+                                                   "blob", oid)
+
+def varint(num):
+    out = bytearray()
+    while num >= 0x80:
+        out.append((num & 0x7f) | 0x80)
+        num >>= 7
+    out.append(num)
+    return bytes(out)
+
+def test_apply_delta():
+    base = bytes(range(256)) * 4096
+    # Copy the second half of the base (offset 0x80000 and size 0x80000,
+    # only their third bytes are present), insert a literal, then copy the
+    # first 0x10000 bytes (no bytes present, a size of zero means 0x10000)
+    half = len(base) // 2
+    ops = bytes([ 0x80 | 0x04 | 0x40, 0x08, 0x08 ]) + \
+        bytes([ 5 ]) + b"hello" + bytes([ 0x80 ])
+    expected = base[half:] + b"hello" + base[:0x10000]
+    delta = varint(len(base)) + varint(len(expected)) + ops
+
+    assert mpygit.apply_delta(base, delta) == expected
+    # The result is only copied into place once
+    tracemalloc.start()
+    try:
+        result = mpygit.apply_delta(base, delta)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert isinstance(result, bytes)
+    assert peak < len(expected) * 1.1
@@ -0,0 +1,75 @@
+#
+# Part of mpygit - tests/test_reachability.py - Merge bases and
+#  reachability queries
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import random
+import subprocess
+from mpygit import gitutil, mpygit
+from mpygit.bench import repogen
+from mpygit.tests.conftest import git
+
+def sample_pairs(path, num=40):
+    """Random pairs of commits, from all the branches"""
+    commits = git(path, "rev-list", "--all").split()
+    rng = random.Random(0)
+    return [ (rng.choice(commits), rng.choice(commits)) for _ in range(num) ]
+
+def test_merge_bases_match_git(history_repo):
+    with mpygit.Repository(history_repo) as repo:
+        for one, two in sample_pairs(history_repo):
+            found = [ commit.oid for commit in
+                      gitutil.merge_bases(repo, one, two) ]
+            expected = git(history_repo, "merge-base", "--all", one,
+                           two).split()
+            assert sorted(found) == sorted(expected), (one, two)
+            base = gitutil.merge_base(repo, one, two)
+            assert (base is None and not expected) or base.oid in expected
+
+def test_is_ancestor_matches_git(history_repo):
+    with mpygit.Repository(history_repo) as repo:
+        for one, two in sample_pairs(history_repo):
+            # Exits with 0 if it is an ancestor and 1 if not
+            expected = subprocess.run(["git", "-C", str(history_repo),
+                                       "merge-base", "--is-ancestor", one,
+                                       two]).returncode == 0
+            assert gitutil.is_ancestor(repo, one, two) == expected
+
+def test_branches_containing_match_git(history_repo):
+    commits = git(history_repo, "rev-list", "--all").split()
+    with mpygit.Repository(history_repo) as repo:
+        for oid in commits[::7]:
+            expected = git(history_repo, "branch", "--contains", oid,
+                           "--format=%(refname:short)").split()
+            assert gitutil.branches_containing(repo, oid) == sorted(expected)
+
+def test_criss_cross_merge_bases(tmp_path):
+    path = repogen.init(tmp_path / "criss-cross.git")
+    fi = repogen.FastImport()
+    base = fi.commit("refs/heads/a", "base", { "f" : fi.blob(b"base\n") })
+    a1 = fi.commit("refs/heads/a", "a1", { "a" : fi.blob(b"a1\n") }, [base])
+    b1 = fi.commit("refs/heads/b", "b1", { "b" : fi.blob(b"b1\n") }, [base])
+    fi.commit("refs/heads/a", "a2", { "a" : fi.blob(b"a2\n") }, [a1, b1])
+    fi.commit("refs/heads/b", "b2", { "b" : fi.blob(b"b2\n") }, [b1, a1])
+    fi.run(path)
+
+    expected = git(path, "merge-base", "--all", "a", "b").split()
+    assert len(expected) == 2
+    with mpygit.Repository(path) as repo:
+        assert sorted(commit.oid for commit in
+                      gitutil.merge_bases(repo, "a", "b")) == sorted(expected)
@@ -0,0 +1,80 @@
+#
+# Part of mpygit - tests/test_refs.py - References
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import shutil
+import pytest
+from mpygit import mpygit
+from mpygit.tests.conftest import git
+
+@pytest.fixture
+def repo_path(linear_repo, tmp_path):
+    """Copy of the linear repository the tests can change the refs of"""
+    path = tmp_path / "refs.git"
+    shutil.copytree(linear_repo, path)
+    return path
+
+def git_refs(path, namespace):
+    out = git(path, "for-each-ref", "--format=%(refname) %(objectname)",
+              namespace)
+    return { name[len(namespace) + 1:] : oid for name, oid in
+             (line.split() for line in out.splitlines()) }
+
+def check_refs(repo, path):
+    assert dict(repo.heads) == git_refs(path, "refs/heads")
+    assert dict(repo.tags) == git_refs(path, "refs/tags")
+
+def test_updates_are_noticed(repo_path):
+    commits = git(repo_path, "rev-list", "main").split()
+    with mpygit.Repository(repo_path, ref_check_interval=0) as repo:
+        check_refs(repo, repo_path)
+
+        git(repo_path, "update-ref", "refs/heads/topic/nested/one",
+            commits[3])
+        git(repo_path, "tag", "v1", commits[5])
+        check_refs(repo, repo_path)
+        assert repo.resolve("topic/nested/one") == commits[3]
+        assert repo.resolve("v1") == commits[5]
+
+        git(repo_path, "pack-refs", "--all")
+        check_refs(repo, repo_path)
+        git(repo_path, "update-ref", "refs/heads/main", commits[1])
+        git(repo_path, "update-ref", "-d", "refs/heads/topic/nested/one")
+        git(repo_path, "tag", "-a", "-m", "annotated", "v2", commits[2])
+        check_refs(repo, repo_path)
+        assert repo.resolve("main") == commits[1]
+        assert repo.resolve("topic/nested/one") is None
+
+def test_symbolic_refs(repo_path):
+    head = git(repo_path, "rev-parse", "main").strip()
+    git(repo_path, "symbolic-ref", "refs/heads/alias", "refs/heads/main")
+    with mpygit.Repository(repo_path, ref_check_interval=0) as repo:
+        assert repo.heads["alias"] == head
+        assert repo.resolve("alias") == head
+        assert repo.resolve("HEAD") == head
+
+def test_checks_are_rate_limited(repo_path):
+    commits = git(repo_path, "rev-list", "main").split()
+    with mpygit.Repository(repo_path, ref_check_interval=3600) as repo:
+        assert repo.heads["main"] == commits[0]
+        git(repo_path, "update-ref", "refs/heads/main", commits[1])
+        assert repo.heads["main"] == commits[0]
+        assert repo.resolve("main") == commits[0]
+        repo.refs.check_interval = 0
+        assert repo.heads["main"] == commits[1]
+        assert repo.resolve("main") == commits[1]
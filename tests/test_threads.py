@@ -0,0 +1,96 @@
+#
+# Part of mpygit - tests/test_threads.py - Sharing repositories between
+#  threads
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import random
+import sys
+import threading
+import pytest
+from mpygit import gitutil, mpygit
+from mpygit.tests.conftest import git, git_objects
+
+THREADS = 16
+OPERATIONS = 300
+
+# Caches this small only hold a few objects of the test repositories, so
+# the threads keep evicting each other's entries
+TINY_LIMITS = { "commit" : 4096, "tree" : 4096, "blob" : 1024 * 1024 }
+TINY_DELTA_BASE_CACHE = 1024 * 1024
+
+@pytest.fixture(autouse=True)
+def short_switch_interval():
+    """Switch threads as often as possible to provoke races"""
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+def stress(repo, objects, history, seed):
+    """Random lookups, object info and walks, checked against git"""
+    rng = random.Random(seed)
+    oids = sorted(objects)
+    for _ in range(OPERATIONS):
+        op = rng.random()
+        oid = rng.choice(oids)
+        obj_type, data = objects[oid]
+        if op < 0.6:
+            obj = repo[oid]
+            if obj_type == "blob":
+                assert obj.data == data
+            elif obj_type in ("tree", "commit"):
+                assert obj._data == data
+        elif op < 0.9:
+            assert repo.object_info(oid) == (obj_type, len(data))
+        else:
+            start = rng.randrange(len(history))
+            walked = [ commit.oid for commit in
+                       gitutil.walk(repo, history[start], limit=20) ]
+            assert walked == history[start:start+20]
+
+@pytest.mark.parametrize("repo_fixture", ["deltas_repo", "many_packs_repo"])
+def test_concurrent_lookups(request, repo_fixture):
+    path = request.getfixturevalue(repo_fixture)
+    objects = git_objects(path)
+    history = git(path, "rev-list", "main").split()
+
+    errors = []
+    def worker(seed):
+        try:
+            stress(repo, objects, history, seed)
+        except BaseException as exc:
+            errors.append(exc)
+
+    repo = mpygit.Repository(path,
+                             delta_base_cache_limit=TINY_DELTA_BASE_CACHE,
+                             object_cache=mpygit.ObjectCache(TINY_LIMITS))
+    with repo:
+        threads = [ threading.Thread(target=worker, args=(seed,))
+                    for seed in range(THREADS) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        # The caches were busy evicting, yet stayed within their limits
+        assert 0 < repo.delta_base_cache.size <= TINY_DELTA_BASE_CACHE
+        for name, stats in repo.object_cache.stats.items():
+            if name != "misses":
+                assert stats["size"] <= stats["limit"]
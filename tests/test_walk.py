@@ -0,0 +1,168 @@
+#
+# Part of mpygit - tests/test_walk.py - History walks
+#
+# Copyright (C) 2021  Mate Kukri
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import base64
+import struct
+import zlib
+import pytest
+from mpygit import gitutil, mpygit
+from mpygit.tests.conftest import git
+
+def sample_paths(path):
+    """Some files and directories of the repository, and a missing path"""
+    files = git(path, "ls-tree", "-r", "--name-only", "main").split()
+    dirs = sorted({ name.rsplit("/", 1)[0] for name in files if "/" in name })
+    return files[::5] + dirs[::2] + [ "no/such/path" ]
+
+def test_walk_matches_git(history_repo):
+    with mpygit.Repository(history_repo) as repo:
+        assert [ commit.oid for commit in gitutil.walk(repo, "main") ] == \
+            git(history_repo, "rev-list", "--date-order", "main").split()
+
+def test_path_limited_walk_matches_git_log(history_repo):
+    with mpygit.Repository(history_repo) as repo:
+        for path in sample_paths(history_repo):
+            walked = [ commit.oid for commit in
+                       gitutil.walk(repo, "main", paths=[path]) ]
+            assert walked == git(history_repo, "log", "--format=%H", "main",
+                                 "--", path).split(), path
+
+def test_path_limited_walk_with_several_paths(history_repo):
+    paths = sample_paths(history_repo)[:3]
+    with mpygit.Repository(history_repo) as repo:
+        walked = [ commit.oid for commit in
+                   gitutil.walk(repo, "main", paths=paths) ]
+    assert walked == git(history_repo, "log", "--format=%H", "main", "--",
+                         *paths).split()
+
+@pytest.mark.parametrize("graph", [False, True], ids=["plain", "graph"])
+def test_mode_changes_are_changes(tmp_path, graph):
+    (tmp_path / "d").mkdir()
+    (tmp_path / "d" / "f").write_text("f\n")
+    (tmp_path / "g").write_text("g\n")
+    git(tmp_path, "init", "--quiet", "--initial-branch=main")
+    git(tmp_path, "add", ".")
+    git(tmp_path, "commit", "--quiet", "-m", "one")
+    (tmp_path / "g").write_text("changed\n")
+    git(tmp_path, "commit", "--quiet", "-am", "other")
+    git(tmp_path, "update-index", "--chmod=+x", "d/f")
+    git(tmp_path, "commit", "--quiet", "-m", "chmod")
+    if graph:
+        git(tmp_path, "commit-graph", "write", "--reachable",
+            "--changed-paths")
+
+    with mpygit.Repository(tmp_path / ".git") as repo:
+        for path in ("d/f", "d"):
+            walked = [ commit.message.strip() for commit in
+                       gitutil.walk(repo, "main", paths=[path]) ]
+            assert walked == git(tmp_path, "log", "--format=%s", "main",
+                                 "--", path).split()
+            assert walked == [ "chmod", "one" ]
+
+def test_commit_graph_is_used(history_repo):
+    has_graph = (history_repo / "objects" / "info" / "commit-graph").exists()
+    with mpygit.Repository(history_repo) as repo:
+        commit = repo.get_commit("main")
+        assert isinstance(commit, mpygit.GraphCommit) == has_graph
+        if has_graph:
+            pos = repo.commit_graph.find(bytes.fromhex(commit.oid))
+            assert repo.commit_graph.changed_paths(pos) is not None
+
+def resume_walk(repo, page_size):
+    """Walk the history page by page, saving and restoring the state after
+    each page, returns the commits and the saved states
+    """
+    cursor = gitutil.WalkCursor(repo, "main")
+    walked = []
+    states = []
+    while True:
+        page = cursor.take(page_size)
+        walked.extend(commit.oid for commit in page)
+        if len(page) < page_size:
+            break
+        states.append(cursor.dumps())
+        cursor = gitutil.WalkCursor.loads(repo, states[-1])
+        assert cursor.position == len(walked)
+    return walked, states
+
+@pytest.mark.parametrize("max_saved", [ 64, 4, 0 ])
+def test_resumed_walk_matches_git(history_repo, monkeypatch, max_saved):
+    monkeypatch.setattr(gitutil.WalkCursor, "MAX_SAVED_COMMITS", max_saved)
+    expected = git(history_repo, "rev-list", "--date-order", "main").split()
+    with mpygit.Repository(history_repo) as repo:
+        walked, states = resume_walk(repo, 7)
+    assert walked == expected
+    assert all(len(state) < 3072 for state in states)
+
+def test_saved_states_are_pruned(linear_repo, monkeypatch):
+    # The generated commits are a minute apart, with no clock skew at all
+    # only the next commit can still be reached
+    monkeypatch.setattr(gitutil, "CLOCK_SKEW", 0)
+    expected = git(linear_repo, "rev-list", "--date-order", "main").split()
+    with mpygit.Repository(linear_repo) as repo:
+        walked, states = resume_walk(repo, 5)
+        assert walked == expected
+        for state in states:
+            cursor = gitutil.WalkCursor.loads(repo, state)
+            assert len(cursor._heap) <= 1 and len(cursor._visited) <= 1
+
+HEADER = gitutil.WalkCursor.HEADER
+VERSION = gitutil.WalkCursor.VERSION
+NO_START = bytes(20)
+
+def encode_state(data):
+    return base64.urlsafe_b64encode(zlib.compress(data)).decode()
+
+@pytest.mark.parametrize("state", [
+    "",
+    "not base64!",
+    base64.urlsafe_b64encode(b"not zlib").decode(),
+    encode_state(b"short"),
+    encode_state(HEADER.pack(99, 0, NO_START, 0, 0, 0, 0)),
+    encode_state(HEADER.pack(VERSION, 0, NO_START, 0, 0, 5, 0)),
+    encode_state(HEADER.pack(VERSION, 0, NO_START, 0, 0, 0, 0) +
+                 b"trailing"),
+    encode_state(HEADER.pack(VERSION, 0, NO_START, 0, 0, 1, 0) +
+                 b"\xab" * 20 + struct.pack(">Q", 0)),
+    encode_state(HEADER.pack(VERSION, 1, b"\xab" * 20, 3, 0, 0, 0)),
+    # Inflates to far more than MAX_STATE_SIZE
+    encode_state(HEADER.pack(VERSION, 0, NO_START, 0, 0, 0, 1 << 20) +
+                 bytes(32 << 20)),
+], ids=["empty", "base64", "zlib", "header", "version", "truncated",
+        "trailing", "unknown-commit", "unknown-start", "too-large"])
+def test_invalid_cursor_states(linear_repo, state):
+    with mpygit.Repository(linear_repo) as repo:
+        with pytest.raises(ValueError):
+            gitutil.WalkCursor.loads(repo, state)
+
+def test_restart_past_the_end(linear_repo):
+    head = git(linear_repo, "rev-parse", "main").strip()
+    state = encode_state(HEADER.pack(VERSION, gitutil.WalkCursor.RESTART,
+                                     bytes.fromhex(head), 1000, 0, 0, 0))
+    with mpygit.Repository(linear_repo) as repo:
+        with pytest.raises(ValueError):
+            gitutil.WalkCursor.loads(repo, state)
+
+def test_cursor_state_of_other_objects(linear_repo):
+    tree = git(linear_repo, "rev-parse", "main^{tree}").strip()
+    state = encode_state(HEADER.pack(VERSION, 0, NO_START, 0, 0, 1, 0) +
+                         bytes.fromhex(tree) + struct.pack(">Q", 0))
+    with mpygit.Repository(linear_repo) as repo:
+        with pytest.raises(ValueError):
+            gitutil.WalkCursor.loads(repo, state)